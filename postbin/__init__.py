@@ -7,22 +7,35 @@
 # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 import typing
-
-try:
-    import requests
-    RR = requests.Response
-except ImportError:
-    requests = None
-    RR = None
-
-try:
-    import aiohttp
-    CR = aiohttp.ClientResponse
-except ImportError:
-    aiohttp = None
-    CR = None
+import logging
+import re
 import time
-import asyncio
+
+from postbin import capabilities, health, tracing
+from postbin.lazy import LazyModule
+from postbin.retry import RetryPolicy, RetryState, start as retry_start
+from postbin.dedupe import DedupeCache
+from postbin.payload import Payload
+from postbin.spool import Spool
+
+# every message is logged to the "postbin" logger, with the host (and event) as extra fields.
+# To silence it: logging.getLogger("postbin").disabled = True
+log = logging.getLogger("postbin")
+log.addHandler(logging.NullHandler())
+
+# imported on first use, so importing postbin (e.g. for the CLI) doesn't pay for backends it won't use.
+requests = LazyModule("requests")
+aiohttp = LazyModule("aiohttp")
+asyncio = LazyModule("asyncio")
+
+
+def __getattr__(name):
+    # RR and CR (the response types) used to be set at import time, which meant importing both backends.
+    if name == "RR":
+        return requests.Response if requests else None
+    if name == "CR":
+        return aiohttp.ClientResponse if aiohttp else None
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 _FALLBACKS = [
     "https://haste.clicksminuteper.net",
@@ -33,80 +46,267 @@ _FALLBACKS = [
     "https://hst.sh",
     "https://hasteb.in"
 ]
-#_HASTE_URLS_FOR_REGEX = '|'.join(_FALLBACKS[8:]).replace(".", "\\.")
-# _HASTE_URLS_RAW = "(https://|http://)?({})/(raw/)?(?P<key>.+)".format(_HASTE_URLS_FOR_REGEX)
-# _HASTE_REGEX = re.compile(_HASTE_URLS_RAW)
+# a haste's URL: the service's base URL, then raw/ (or documents/) if it is the API's, then the key. The key may have
+# an extension, which the page only uses for highlighting.
+_HASTE_REGEX = re.compile(r"^(?P<url>https?://[^/]+(?:/.*?)??)/(?:raw/|documents/)?(?P<key>[^/.]+)(?:\.[^/]*)?/?$",
+                          re.IGNORECASE)
+
 
-# we don't need the above anymore - Will be removed in the future.
+def _split_key(key: str, url: str = "auto"):
+    """
+    Turns a haste's URL (e.g. ``https://hst.sh/raw/abcdef.py``) into the service's base URL and the key.
+
+    :return: ``(url, key)``. A bare key is returned as it is, with :param:`url`.
+    """
+    match = _HASTE_REGEX.match(key.strip())
+    if match is None:
+        return url, key
+    return match.group("url"), match.group("key")
 
 
 class ResponseError(Exception):
     """Generic class raised when contacting the server failed."""
-    def __init__(self, response: typing.Union[RR,CR]):
+    def __init__(self, response: typing.Union["requests.Response", "aiohttp.ClientResponse"]):
         self.raw_response = response
         if isinstance(response, requests.Response):
             self.status = response.status_code
         else:
             self.status = response.status
 
+
+class PayloadTooLarge(ResponseError):
+    """
+    Raised when a payload is larger than the host accepts.
+
+    If the host refused it, :attr:`raw_response` is its response. If it is None, the host (and every fallback that
+    could have been used) was already known to refuse anything that large, so nothing was sent.
+    Only the payload's size and the start of it are kept, never the payload itself.
+    """
+    def __init__(self, response=None, *, size: int = None, limit: int = None, preview: str = None):
+        if response is not None:
+            super().__init__(response)
+        else:
+            self.raw_response = None
+            self.status = 413
+        self.size = size
+        self.limit = limit
+        self.preview = preview
+        Exception.__init__(self, "%s bytes is too large%s. Text: %s" % (
+            "?" if size is None else size, "" if limit is None else " (the limit is %d bytes)" % limit, preview
+        ))
+
+
+class RateLimitedError(ResponseError):
+    """Raised when a host was still rate limiting us (429) after every retry we were allowed."""
+
+
+def _is_too_large(status: int, body: bytes) -> bool:
+    # haste-server refuses a document over its maxLength with a 400, and its body parser refuses one with a 413.
+    return status == 413 or (status == 400 and b"exceeds maximum length" in body.lower())
+
+
 class NoFallbacks(Exception):
     """Raised when no fallback could be contacted."""
 
 class NoMoreRetries(NoFallbacks):
     """Raised when we ran out of attempts to post."""
+    def __init__(self, *args, retry_state: RetryState = None):
+        super().__init__(*args)
+        self.retry_state = retry_state
+
+
+def _logFallback(url: str, reason: str):
+    log.warning("%s %s. Finding a fallback...", url, reason, extra={"host": url, "event": "fallback"})
+
+
+def _logRetry(url: str, error: Exception):
+    log.warning("Exception while POSTing to %s/documents: %s", url, error, extra={"host": url, "event": "retry"})
+
+
+def _probeSync(url: str, timeout: float = None) -> bool:
+    if not health.registry.allow(url):
+        return False
+    try:
+        with tracing.trace("POST", url + "/documents") as trace:
+            response = requests.post(url+"/documents", data="", timeout=timeout,
+                                     hooks={"response": trace.requests_hook})
+    except:
+        health.registry.record_failure(url, offline=True)
+        return False
+    return _recordProbe(url, response.status_code, response.elapsed.total_seconds())
+
+
+def _recordProbe(url: str, status: int, latency: float = None) -> bool:
+    if status == 200:
+        health.registry.record_success(url, latency=latency)
+        return True
+    health.registry.record_failure(url, offline=status == 503)
+    return False
+
 
+def findFallBackSync(verbose: bool = True, *, concurrent: bool = False, max_concurrency: int = None,
+                     deadline: float = None, exclude: list = ()):
+    """
+    Tries to find a fallback URL, if haste.clicksminuteper.net isn't working.
 
-def findFallBackSync(verbose: bool = True):
-    """Tries to find a fallback URL, if haste.clicksminuteper.net isn't working."""
+    :param verbose: Whether to print progress.
+    :keyword concurrent: If True, probe every fallback at once and use the first one to answer.
+    :keyword max_concurrency: The maximum number of probes in flight at once. Defaults to all of them.
+    :keyword deadline: How long (in seconds) to look for a working URL before raising NoFallbacks.
+    :keyword exclude: URLs not to use, even if they work.
+    """
     if not requests:
         raise RuntimeError("You need to install requests to be able to use findFallBackSync.")
+    urls = [url for url in _FALLBACKS if url not in exclude]
+    healthy = health.registry.healthy(urls)
+    if healthy:
+        return healthy[0]
+    candidates = health.registry.candidates(urls)
+    if concurrent:
+        return _raceFallBacksSync(candidates, verbose, max_concurrency, deadline)
+    started = time.monotonic()
     with requests.Session() as session:
         n = 0
-        for n, url in enumerate(_FALLBACKS, 1):
+        for n, url in enumerate(candidates, 1):
+            if deadline is not None and time.monotonic() - started >= deadline:
+                if verbose:
+                    log.info("Ran out of time after %d/%d services.", n - 1, len(candidates))
+                raise NoFallbacks()
+            if not health.registry.allow(url):
+                continue  # another caller is already probing it.
             if verbose:
-                print(f"Trying service {n}/{len(_FALLBACKS)}",end="\r")
+                log.debug("Trying service %d/%d (URL %s)", n, len(candidates), url, extra={"host": url})
             try:
-                response = session.post(url+"/documents", data="")
+                timeout = None if deadline is None else max(0.001, deadline - (time.monotonic() - started))
+                with tracing.trace("POST", url + "/documents") as trace:
+                    response = session.post(url+"/documents", data="", timeout=timeout,
+                                            hooks={"response": trace.requests_hook})
             except:
+                health.registry.record_failure(url, offline=True)
                 if verbose:
-                    print(f"Service {n}/{len(_FALLBACKS)} failed. trying again.", end="\r")
+                    log.debug("Service %d/%d failed. trying again.", n, len(candidates), extra={"host": url})
                 continue
-            if response.status_code != 200:
+            if not _recordProbe(url, response.status_code, response.elapsed.total_seconds()):
                 continue
             else:
                 if verbose:
-                    print(f"{url} ({n}) worked. Using that.")
+                    log.info("%s (%d) worked. Using that.", url, n, extra={"host": url})
                 break
         else:
             if verbose:
-                print("No functional URLs could be found. Are you sure you're online?")
+                log.warning("No functional URLs could be found. Are you sure you're online?")
             raise NoFallbacks()
         return url
 
-async def findFallBackAsync(verbose: bool = True):
+
+def _raceFallBacksSync(urls: list, verbose: bool = True, max_concurrency: int = None, deadline: float = None):
+    from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
+    if not urls:
+        if verbose:
+            log.warning("Every service is marked offline. Are you sure you're online?")
+        raise NoFallbacks()
+    if verbose:
+        log.debug("Trying %d services at once", len(urls))
+    executor = ThreadPoolExecutor(max_workers=max_concurrency or len(urls))
+    futures = {executor.submit(_probeSync, url, deadline): url for url in urls}
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            if future.result():
+                if verbose:
+                    log.info("%s worked. Using that.", futures[future], extra={"host": futures[future]})
+                return futures[future]
+    except FutureTimeout:
+        pass
+    finally:
+        # Probes that are already running can't be interrupted, but they are not waited on either.
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+    if verbose:
+        log.warning("No functional URLs could be found. Are you sure you're online?")
+    raise NoFallbacks()
+
+
+async def _probeAsync(session, url: str) -> bool:
+    if not health.registry.allow(url):
+        return False
+    try:
+        sent = time.monotonic()
+        async with session.post(url+"/documents", data="") as response:
+            return _recordProbe(url, response.status, time.monotonic() - sent)
+    except asyncio.CancelledError:
+        raise
+    except:
+        health.registry.record_failure(url, offline=True)
+        return False
+
+
+async def findFallBackAsync(verbose: bool = True, *, concurrent: bool = False, max_concurrency: int = None,
+                            deadline: float = None, exclude: list = ()):
     """Same as findFallBackSync, but just async."""
     if not aiohttp:
         raise RuntimeError("You need to install aiohttp to be able to use findFallBackAsync.")
-    async with aiohttp.ClientSession() as session:
-        for n, url in enumerate(_FALLBACKS, 1):
-            if verbose:
-                print(f"Trying service {n}/{len(_FALLBACKS)} (URL {url})",end="\r")
-            try:
-                async with session.post(url+"/documents", data="") as response:
-                    if response.status != 200:
-                        continue
-                    else:
-                        if verbose:
-                            print(f"{url} ({n}) worked. Using that.")
-                        return url
-            except:
+    urls = [url for url in _FALLBACKS if url not in exclude]
+    healthy = health.registry.healthy(urls)
+    if healthy:
+        return healthy[0]
+    candidates = health.registry.candidates(urls)
+    async with aiohttp.ClientSession(trace_configs=[tracing.aiohttp_trace_config()]) as session:
+        if concurrent:
+            url = await _raceFallBacksAsync(session, candidates, max_concurrency, deadline)
+            if url:
                 if verbose:
-                    print(f"Service {n}/{len(_FALLBACKS)} failed. trying again.", end="\r")
-                continue
+                    log.info("%s worked. Using that.", url, extra={"host": url})
+                return url
         else:
+            try:
+                return await asyncio.wait_for(_firstFallBackAsync(session, candidates, verbose), timeout=deadline)
+            except asyncio.TimeoutError:
+                pass
+        if verbose:
+            log.warning("No functional URLs could be found. Are you sure you're online?")
+        raise NoFallbacks()
+
+
+async def _firstFallBackAsync(session, urls: list, verbose: bool = True):
+    for n, url in enumerate(urls, 1):
+        if verbose:
+            log.debug("Trying service %d/%d (URL %s)", n, len(urls), url, extra={"host": url})
+        if await _probeAsync(session, url):
             if verbose:
-                print("No functional URLs could be found. Are you sure you're online?")
-            raise NoFallbacks()
+                log.info("%s (%d) worked. Using that.", url, n, extra={"host": url})
+            return url
+        if verbose:
+            log.debug("Service %d/%d failed. trying again.", n, len(urls), extra={"host": url})
+    if verbose:
+        log.warning("No functional URLs could be found. Are you sure you're online?")
+    raise NoFallbacks()
+
+
+async def _raceFallBacksAsync(session, urls: list, max_concurrency: int = None, deadline: float = None):
+    if not urls:
+        return None
+    semaphore = asyncio.Semaphore(max_concurrency or len(urls))
+
+    async def probe(url):
+        async with semaphore:
+            return url if await _probeAsync(session, url) else None
+
+    loop = asyncio.get_event_loop()
+    end = None if deadline is None else loop.time() + deadline
+    pending = {asyncio.ensure_future(probe(url)) for url in urls}
+    try:
+        while pending:
+            timeout = None if end is None else max(0, end - loop.time())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                return None
+            for task in done:
+                if task.result():
+                    return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
 
 
 def post(sync: bool = False, *, content: str, url: str = None, retry: int = 5, find_fallback: bool = True):
@@ -131,94 +331,234 @@ def post(sync: bool = False, *, content: str, url: str = None, retry: int = 5, f
         return postAsync(content, url=url, retry=retry, find_fallback_on_unavailable=find_fallback)
 
 
+def _retry_defaults(retry: int, find_fallback: bool) -> dict:
+    # retry has always counted the retries of each host (and a fallback got as many again), so the policy used
+    # when none is given says the same. A negative retry used to mean no retries, and still does.
+    per_host = max(1, retry + 1)
+    return {"max_attempts": per_host * (1 + len(_FALLBACKS)) if find_fallback else per_host,
+            "max_attempts_per_host": per_host}
+
+
+def _preflight(payload: Payload, url: str, find_fallback: bool, state: RetryState) -> bool:
+    """
+    Checks the payload against the size limits hosts are known to have (see :mod:`postbin.capabilities`).
+
+    :return: whether :param:`url` refuses it, so a fallback has to be found before anything is sent.
+    :raise PayloadTooLarge: the URL (and, if fallbacks may be used, every fallback) is known to refuse it.
+    """
+    hosts = [url] + (_FALLBACKS if find_fallback else [])
+    refusing = capabilities.registry.refusing(hosts, payload.size)
+    if set(refusing) >= set(hosts):
+        limit = max(capabilities.registry.get(host).max_size for host in hosts)
+        raise PayloadTooLarge(size=payload.size, limit=limit, preview=payload.preview())
+    for host in refusing:
+        state.give_up(host)
+    return url in refusing
+
+
+def _spool(spool: Spool, payload: Payload, url: str, find_fallback: bool):
+    host = "auto" if url is None or find_fallback else url
+    ticket = spool.put(payload, host)
+    log.warning("No host could take a post, so it was spooled as ticket %s.", ticket.id,
+                extra={"host": host, "event": "spool"})
+    return ticket
+
+
 # noinspection PyIncorrectDocstring
 def postSync(content:  str, *, url: str = None, retry: int = 5, find_fallback_on_unavailable: bool = True,
-             find_fallback_on_retry_runout: bool = False):
+             find_fallback_on_retry_runout: bool = False, dedupe: DedupeCache = None,
+             retry_policy: typing.Union[RetryPolicy, RetryState] = None, spool: Spool = None):
     """
     Creates a new haste
 
-    :param content: Union[str, Iterable] - the content to post to hastebin. If this is a list, it will join with a newline.
+    :param content: the content to post to hastebin. Text, bytes, memoryviews, paths, file objects and iterators of
+        chunks are streamed without being read into memory (see :class:`postbin.payload.Payload`); anything else is
+        posted as its repr(). A one-shot iterator can't be re-sent, so it only gets one attempt.
     :keyword url: the custom URL to post to. Defaults to CMP Haste.
-    :keyword retry: the number of times to retry. Pass `0` to disable
+    :keyword retry: the number of times to retry each host (a fallback gets as many). Pass `0` to disable. Ignored
+        if retry_policy is given.
     :keyword find_fallback_on_unavailable: Whether or not to find a fallback or give up if the url fails to return.
     :keyword find_fallback_on_retry_runout: if True, instead of raising NoMoreRetries(), find a fallback instead.
-    :raise RuntimeError: requests is not installed or you provided a retry value above 1000 (which would raise recursion error)
+    :keyword dedupe: a cache of content already posted. If the same content was posted before, its URL is returned
+        without any network I/O.
+    :keyword retry_policy: how many attempts (in total and per host) the call may make, and its deadline, which
+        covers finding fallbacks too. Pass a started :class:`postbin.retry.RetryState` to read how many attempts
+        were used and how much of the deadline was spent afterwards.
+    :keyword spool: if given, content that couldn't be posted because no host was available (NoFallbacks or
+        NoMoreRetries) is written to this :class:`postbin.spool.Spool`, and its :class:`postbin.spool.Ticket` is
+        returned instead of a URL. A :class:`postbin.spool.Drainer` posts it once a host recovers.
+    :raise RuntimeError: requests is not installed.
+    :raise NoMoreRetries: the attempts (or the time) allowed ran out.
+    :raise PayloadTooLarge: the content is larger than the host accepts. If the host's limit was already known (see
+        :mod:`postbin.capabilities`), this is raised before anything is sent.
     :raise TypeError: Either the provided `content` was not string/iterable, or you disabled find_..._unavailable.
     :return: the returned URL
     """
     if not requests:
         raise RuntimeError("requests must be installed if you want to be able to run postSync.")
-    if not isinstance(content, str):
-        content = repr(content)
+    state = retry_start(retry_policy, **_retry_defaults(retry, find_fallback_on_unavailable or
+                                                        find_fallback_on_retry_runout))
+    if not isinstance(content, Payload) or spool is not None or dedupe is not None:
+        payload = Payload.wrap(content)
+        try:
+            def upload():
+                return postSync(payload, url=url, find_fallback_on_unavailable=find_fallback_on_unavailable,
+                                find_fallback_on_retry_runout=find_fallback_on_retry_runout, retry_policy=state)
+            key = DedupeCache.key(payload, url) if dedupe is not None else None
+            try:
+                return upload() if key is None else dedupe.run(key, upload)
+            except NoFallbacks:
+                if spool is None or not payload.replayable:
+                    raise
+                return _spool(spool, payload, url, find_fallback_on_unavailable)
+        finally:
+            if payload is not content:
+                payload.close()
     url = url or "https://haste.clicksminuteper.net"
+    switch = find_fallback_on_unavailable and not health.registry.available(url)
+    switch = _preflight(content, url, find_fallback_on_unavailable, state) or switch
     with requests.Session() as session:
-        try:
-            response = session.post(url+"/documents", data=content)
-            if response.status_code == 503:
-                print(url, "is unavailable. Finding a fallback...")
-                return postSync(content, url=findFallBackSync(True), find_fallback_on_retry_runout=True)
-            if response.status_code != 200:
-                raise ResponseError(response)
-            if response.headers.get("Content-Type", "").lower() != "application/json":
-                print(url, "is returning an invalid response. Finding a Fallback")
-                return postSync(content, url=findFallBackSync(True), find_fallback_on_retry_runout=True)
-            key = response.json()["key"]
-        except (requests.ConnectionError, ConnectionError):
-            print(url, "is unable. Finding a fallback...")
-            return postSync(content, url=findFallBackSync(True), find_fallback_on_retry_runout=True)
-        except Exception as e:
-            print(f"Exception while POSTing to {url}/documents: {e}\nFinding a fallback...")
-            if retry <= 0:
-                if find_fallback_on_retry_runout:
-                    print(url, "is unavailable. Finding a fallback...")
-                    return postSync(content, url=findFallBackSync(True), find_fallback_on_retry_runout=True)
-                raise NoMoreRetries()
-            print(f"Error posting. {retry-1} retries left.")
-            retry -= 1
-            if find_fallback_on_unavailable:
-                return postSync(content, url=url, retry=retry, find_fallback_on_unavailable=True,
-                                find_fallback_on_retry_runout=True)
-            raise TypeError("Unable to create a haste with the provided URL.")
-    return url+"/"+key
+        while True:
+            if not state.allows():
+                raise NoMoreRetries(f"Gave up after {state.attempts} attempts in {state.elapsed:.2f}s.",
+                                    retry_state=state)
+            if switch or not state.allows(url):
+                if not switch and not find_fallback_on_retry_runout:
+                    raise NoMoreRetries(f"Gave up on {url} after {state.hosts[url]} attempts.", retry_state=state)
+                url = findFallBackSync(True, deadline=state.remaining(), exclude=state.exhausted())
+                switch = False
+            if find_fallback_on_unavailable and not health.registry.allow(url):
+                state.give_up(url)  # another caller is already probing it.
+                switch = True
+                continue
+            state.wait(url)
+            data = content.for_requests()  # a one-shot payload raises here if it has already been sent.
+            state.record(url)
+            try:
+                with tracing.trace("POST", url + "/documents", retries=state.retries(url), hops=state.hops) as trace:
+                    response = session.post(url+"/documents", data=data, timeout=state.remaining(),
+                                            hooks={"response": trace.requests_hook})
+                if response.status_code == 503:
+                    health.registry.record_failure(url, offline=True)
+                    _logFallback(url, "is unavailable")
+                    state.give_up(url)
+                    switch = True
+                    continue
+                if _is_too_large(response.status_code, response.content):
+                    capabilities.registry.record_too_large(url, content.size)
+                    raise PayloadTooLarge(response, size=content.size, preview=content.preview())
+                if response.status_code != 200:
+                    raise ResponseError(response)
+                if response.headers.get("Content-Type", "").lower() != "application/json":
+                    health.registry.record_failure(url)
+                    _logFallback(url, "is returning an invalid response")
+                    state.give_up(url)
+                    switch = True
+                    continue
+                key = response.json()["key"]
+                health.registry.record_success(url, latency=response.elapsed.total_seconds())
+                capabilities.registry.record_accepted(url, content.size)
+            except PayloadTooLarge:
+                raise  # every other host would have to be sent it too, just to refuse it.
+            except (requests.ConnectionError, ConnectionError):
+                health.registry.record_failure(url, offline=True)
+                if not find_fallback_on_unavailable:
+                    raise TypeError("Unable to create a haste with the provided URL.")
+                _logFallback(url, "is unavailable")
+                state.give_up(url)
+                switch = True
+                continue
+            except Exception as e:
+                _logRetry(url, e)
+                continue
+            return url+"/"+key
+
 
 async def postAsync(content: str, *, url: str = None, retry: int = 5, find_fallback_on_unavailable: bool = True,
-                    find_fallback_on_retry_runout: bool = False):
+                    find_fallback_on_retry_runout: bool = False, dedupe: DedupeCache = None,
+                    retry_policy: typing.Union[RetryPolicy, RetryState] = None, spool: Spool = None):
     """The same as :func:postSync, but async."""
     if not aiohttp:
         raise RuntimeError("aiohttp must be installed if you want to be able to run postAsync.")
-    if not isinstance(content, str):
-        content = repr(content)
-    url = url or "https://haste.clicksminuteper.net"
-    async with aiohttp.ClientSession() as session:
+    state = retry_start(retry_policy, **_retry_defaults(retry, find_fallback_on_unavailable or
+                                                        find_fallback_on_retry_runout))
+    if not isinstance(content, Payload) or spool is not None or dedupe is not None:
+        payload = Payload.wrap(content)
         try:
-            async with session.post(url+"/documents", data=content) as response:
-                if response.status == 503:
-                    print(url, "is unavailable. Finding a fallback...")
-                    return await postAsync(content, url=await findFallBackAsync(True), find_fallback_on_retry_runout=True)
-                if response.status != 200:
-                    raise ResponseError(response)
-                if response.headers.get("Content-Type", "").lower() != "application/json":
-                    print(url, "is returning an invalid response. Finding a Fallback")
-                    return await postAsync(content, url=await findFallBackAsync(True), find_fallback_on_retry_runout=True)
-                key = (await response.json())["key"]
-                return f"{url}/{key}"
-        except aiohttp.ClientConnectionError:
-            if find_fallback_on_unavailable:
-                print(url, "is unavailable. Finding a fallback...")
-                return await postAsync(content, url=await findFallBackAsync(True), find_fallback_on_retry_runout=True)
-            raise TypeError("Unable to create a haste with the provided URL")
-        except Exception as e:
-            print(e)
-            if retry <= 0:
-                if find_fallback_on_retry_runout:
-                    print(url, "is unavailable. Finding a fallback...")
-                    return await postAsync(content, url=await findFallBackAsync(True), find_fallback_on_retry_runout=True)
-                raise NoMoreRetries()
-            print(f"Error posting. {retry-1} retries left.")
-            retry -= 1
-            # return await postAsync(content, url=url, retry=retry, find_fallback_on_retry_runout=True)
-            if find_fallback_on_unavailable:
-                return await postAsync(content, url=url, retry=retry, find_fallback_on_unavailable=True,
-                                find_fallback_on_retry_runout=True)
-            raise TypeError("Unable to create a haste with the provided URL.")
-    return url+"/"+key
+            def upload():
+                return postAsync(payload, url=url, find_fallback_on_unavailable=find_fallback_on_unavailable,
+                                 find_fallback_on_retry_runout=find_fallback_on_retry_runout, retry_policy=state)
+            key = await DedupeCache.key_async(payload, url) if dedupe is not None else None
+            try:
+                return await (upload() if key is None else dedupe.run_async(key, upload))
+            except NoFallbacks:
+                if spool is None or not payload.replayable:
+                    raise
+                # the journal is synced to disk, which mustn't block the loop.
+                return await asyncio.get_event_loop().run_in_executor(
+                    None, _spool, spool, payload, url, find_fallback_on_unavailable
+                )
+        finally:
+            if payload is not content:
+                payload.close()
+    url = url or "https://haste.clicksminuteper.net"
+    switch = find_fallback_on_unavailable and not health.registry.available(url)
+    switch = _preflight(content, url, find_fallback_on_unavailable, state) or switch
+    async with aiohttp.ClientSession(trace_configs=[tracing.aiohttp_trace_config()]) as session:
+        while True:
+            if not state.allows():
+                raise NoMoreRetries(f"Gave up after {state.attempts} attempts in {state.elapsed:.2f}s.",
+                                    retry_state=state)
+            if switch or not state.allows(url):
+                if not switch and not find_fallback_on_retry_runout:
+                    raise NoMoreRetries(f"Gave up on {url} after {state.hosts[url]} attempts.", retry_state=state)
+                url = await findFallBackAsync(True, deadline=state.remaining(), exclude=state.exhausted())
+                switch = False
+            if find_fallback_on_unavailable and not health.registry.allow(url):
+                state.give_up(url)  # another caller is already probing it.
+                switch = True
+                continue
+            await state.wait_async(url)
+            data = content.for_aiohttp()
+            state.record(url)
+            try:
+                timeout = aiohttp.ClientTimeout(total=state.remaining())
+                sent = time.monotonic()
+                with tracing.trace("POST", url + "/documents", retries=state.retries(url), hops=state.hops) as trace:
+                    async with session.post(url+"/documents", data=data, timeout=timeout,
+                                            trace_request_ctx=trace) as response:
+                        if response.status == 503:
+                            health.registry.record_failure(url, offline=True)
+                            _logFallback(url, "is unavailable")
+                            state.give_up(url)
+                            switch = True
+                            continue
+                        if response.status in (400, 413) and _is_too_large(response.status, await response.read()):
+                            capabilities.registry.record_too_large(url, content.size)
+                            raise PayloadTooLarge(response, size=content.size, preview=content.preview())
+                        if response.status != 200:
+                            raise ResponseError(response)
+                        if response.headers.get("Content-Type", "").lower() != "application/json":
+                            health.registry.record_failure(url)
+                            _logFallback(url, "is returning an invalid response")
+                            state.give_up(url)
+                            switch = True
+                            continue
+                        key = (await response.json())["key"]
+                        health.registry.record_success(url, latency=time.monotonic() - sent)
+                        capabilities.registry.record_accepted(url, content.size)
+                        return f"{url}/{key}"
+            except PayloadTooLarge:
+                raise
+            except aiohttp.ClientConnectionError:
+                health.registry.record_failure(url, offline=True)
+                if not find_fallback_on_unavailable:
+                    raise TypeError("Unable to create a haste with the provided URL")
+                _logFallback(url, "is unavailable")
+                state.give_up(url)
+                switch = True
+            except Exception as e:
+                _logRetry(url, e)
+
+
+from postbin.sync import SyncHaste  # noqa: E402 (needs the exceptions above)
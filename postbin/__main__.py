@@ -1,29 +1,207 @@
-from os import path
-from sys import argv
+"""
+Posts files (or text, or stdin) to a haste service, or downloads a haste.
 
-from postbin import postSync
+    python -m postbin build.log "reports/*.xml" coverage/ --no-browser --json
+    some-command | python -m postbin
+    python -m postbin --raw abcdef -o abcdef.txt
 
-if len(argv) >= 2:
-    text = ' '.join(argv[1:])
-else:
-    text = input(
-        "What text would you like to put on hastebin?\nIf you provide a filepath, it will post that file's content\n\n> ")
-if path.exists(text):
+Any number of files, globs and directories can be given, and they are uploaded in parallel. If none of the
+arguments is a file (or a glob that matches one), they are joined and posted as text, as older versions did. With no arguments, stdin is
+streamed (or, at a terminal, you're asked for the text).
+
+Exit status: 0 if everything was uploaded (or downloaded), 1 if nothing was, 2 for bad usage, and 3 if only some
+uploads failed.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+from pathlib import Path
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_PARTIAL = 3  # argparse exits with 2 for bad usage.
+
+_STDIN = "-"
+_TEXT = "<text>"
+_GLOB = "*?["
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m postbin", description=__doc__.split("\n\n")[0],
+                                     epilog=__doc__.split("\n\n", 1)[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sources", nargs="*", metavar="source",
+                        help='Files, globs (e.g. "logs/**/*.log") or directories to upload. "-" is stdin.')
+    parser.add_argument("--url", default="auto", help='The haste service to use. Defaults to "auto", which uses '
+                                                      "the first working fallback.")
+    parser.add_argument("--concurrency", "-c", type=int, default=8, help="How many uploads run at once.")
+    parser.add_argument("--retries", type=int, default=10, help="How many times each upload may be retried.")
+    parser.add_argument("--timeout", type=float, default=60.0, help="How long (in seconds) each upload may take.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print one JSON object per upload (NDJSON) as it finishes: "
+                             '{"source": ..., "url": ...} or {"source": ..., "error": ...}.')
+    parser.add_argument("--no-browser", action="store_true", help="Don't open the new haste in a browser.")
+    parser.add_argument("--raw", metavar="KEY", help="Download a haste (by key or URL) instead of uploading.")
+    parser.add_argument("--output", "-o", metavar="FILE", help="With --raw, where to save it. Defaults to stdout.")
+    return parser
+
+
+def _expand(arguments: list):
+    """
+    Resolves arguments to the files to upload.
+
+    :return: the files (and ``"-"`` for stdin), and the arguments that matched nothing.
+    """
+    files, unmatched = [], []
+    for argument in arguments:
+        if argument == _STDIN:
+            files.append(_STDIN)
+            continue
+        if os.path.isfile(argument) or os.path.isdir(argument):
+            matches = [argument]
+        elif any(char in argument for char in _GLOB):
+            matches = sorted(glob.glob(argument, recursive=True))
+        else:
+            matches = []
+        if not matches:
+            unmatched.append(argument)
+        for match in matches:
+            if os.path.isdir(match):
+                for root, dirs, names in os.walk(match):
+                    dirs.sort()
+                    files.extend(os.path.join(root, name) for name in sorted(names))
+            else:
+                files.append(match)
+    return files, unmatched
+
+
+class _Reporter:
+    def __init__(self, as_json: bool):
+        self.as_json = as_json
+        self.succeeded = []
+        self.failed = []
+
+    def __call__(self, source: str, result):
+        if isinstance(result, BaseException):
+            self.failed.append(source)
+            error = str(result) or type(result).__name__
+            if self.as_json:
+                self._print({"source": source, "error": error})
+            else:
+                print("%s: error: %s" % (source, error), file=sys.stderr)
+        else:
+            self.succeeded.append(result)
+            if self.as_json:
+                self._print({"source": source, "url": result})
+            else:
+                print("%s: %s" % (source, result) if source not in (_STDIN, _TEXT) else "URL: " + result)
+
+    @staticmethod
+    def _print(record: dict):
+        print(json.dumps(record), flush=True)  # flushed, so a pipe sees each record as soon as it is done.
+
+    @property
+    def exit_code(self) -> int:
+        if not self.failed:
+            return EXIT_OK
+        return EXIT_PARTIAL if self.succeeded else EXIT_FAILED
+
+
+async def _upload(sources: list, contents: list, args, report: _Reporter):
+    from postbin import health
+    from postbin.retry import RetryPolicy
+    from postbin.selection import RoundRobin
+    from postbin.v2 import AsyncHaste
+
+    policy = RetryPolicy(args.retries + 1)
+    strategy = health.registry.strategy
+    if len(contents) > 1:
+        health.registry.strategy = RoundRobin()  # spread the files across the fallbacks; each can still fall back.
+    try:
+        async with AsyncHaste() as paster:
+            async for index, result in paster.post_iter(contents, concurrency=args.concurrency, url=args.url,
+                                                        timeout=args.timeout, retry_policy=policy):
+                report(sources[index], result)
+    finally:
+        health.registry.strategy = strategy  # main() may be called from a program with a strategy of its own.
+
+
+async def _download(args) -> int:
+    from postbin import _split_key
+    from postbin.v2 import AsyncHaste
+
+    url, key = _split_key(args.raw, args.url)
+    async with AsyncHaste() as paster:
+        try:
+            if args.output:
+                await paster.raw_to_file(key, args.output, url=url)
+            else:
+                async for chunk in paster.iter_raw(key, url=url):
+                    sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+        except Exception as e:
+            print("error: %s" % (str(e) or type(e).__name__), file=sys.stderr)
+            return EXIT_FAILED
+    return EXIT_OK
+
+
+def _run(coroutine):
+    import asyncio
+
+    # asyncio.run() is new in Python 3.7.
+    loop = asyncio.new_event_loop()
     try:
-        with open(text) as rfile:
-            text = rfile.read()
-    except:
-        print("Attempted to open a file, but was unable to. Assuming you didn't want to.")
-print("\nPosting...")
-url = postSync(text, retry=10)
-try:
-    import webbrowser
-
-    webbrowser.open(url, 0)
-except ImportError:
-    webbrowser = None
-    print("Tried to open in browser, but webbrowser was not installed.")
-    print()
-print("URL:", url)
-exit(0)
-#
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def main(argv: list = None) -> int:
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1.")
+    if args.raw is not None:
+        if args.sources:
+            parser.error("--raw can't be combined with files to upload.")
+        return _run(_download(args))
+    if args.output:
+        parser.error("--output is only used with --raw.")
+
+    report = _Reporter(args.json)
+    files, unmatched = _expand(args.sources)
+    if args.sources and not files:
+        # none of the arguments is a file (or a glob that matched one), e.g. "why?": post them as text, like older
+        # versions did.
+        sources, contents, unmatched = [_TEXT], [" ".join(args.sources)], []
+    elif not args.sources and sys.stdin.isatty():
+        text = input("What text would you like to put on hastebin?\n"
+                     "If you provide a filepath, it will post that file's content\n\n> ")
+        if os.path.isfile(text):
+            sources, contents = [text], [Path(text)]
+        else:
+            sources, contents = [_TEXT], [text]
+    else:
+        sources = files if args.sources else [_STDIN]
+        # stdin is streamed (through its binary buffer), files are opened and streamed by the client.
+        contents = [sys.stdin if source == _STDIN else Path(source) for source in sources]
+    for argument in unmatched:
+        report(argument, FileNotFoundError("No such file, directory or glob match."))
+
+    if sources:
+        _run(_upload(sources, contents, args, report))
+
+    if len(report.succeeded) == 1 and not (args.no_browser or args.json):
+        try:
+            import webbrowser
+        except ImportError:
+            print("Tried to open in browser, but webbrowser was not installed.", file=sys.stderr)
+        else:
+            webbrowser.open(report.succeeded[0], 0)
+    return report.exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
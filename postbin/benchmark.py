@@ -0,0 +1,261 @@
+"""
+Benchmarks of every client, against a local :class:`postbin.testing.HasteServer`, so no network is needed.
+
+Each benchmark reports throughput, latency percentiles and the peak memory it allocated, and the results can be
+saved as JSON and compared with an earlier run to catch regressions:
+
+    python -m postbin.benchmark --output new.json --compare old.json
+
+Peak memory is measured with tracemalloc (so it only counts Python allocations, and the stand-in server runs in
+the same process, so its copies of the documents are counted too), except for the CLI, which runs in a
+subprocess and reports that process's peak resident set size.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from .testing import HasteServer
+
+__all__ = ("BENCHMARKS", "run", "compare")
+
+
+def _run(coroutine):
+    # unlike asyncio.run(), this leaves the current event loop alone, for callers (and tests) still using it.
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def _timed(call, *args, **kwargs):
+    started = time.perf_counter()
+    call(*args, **kwargs)
+    return time.perf_counter() - started
+
+
+async def _timed_async(call, *args):
+    started = time.perf_counter()
+    await call(*args)
+    return time.perf_counter() - started
+
+
+async def _gather(calls, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(call, *args):
+        async with semaphore:
+            return await _timed_async(call, *args)
+
+    return await asyncio.gather(*(limited(*call) for call in calls))
+
+
+def v1_post_sync(url, documents, concurrency):
+    from . import postSync
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        return list(executor.map(lambda document: _timed(postSync, document, url=url), documents))
+
+
+def v1_post_async(url, documents, concurrency):
+    from . import postAsync
+
+    async def post(document):
+        await postAsync(document, url=url)
+
+    return _run(_gather([(post, document) for document in documents], concurrency))
+
+
+def v2_post(url, documents, concurrency):
+    from .v2 import AsyncHaste
+
+    async def main():
+        async with AsyncHaste() as paster:
+            async def post(document):
+                await paster.post(document, url=url)
+
+            return await _gather([(post, document) for document in documents], concurrency)
+
+    return _run(main())
+
+
+def v2_raw(url, keys, concurrency):
+    from .v2 import AsyncHaste
+
+    async def main():
+        async with AsyncHaste() as paster:
+            async def raw(key):
+                await paster.raw(key, url=url)
+
+            return await _gather([(raw, key) for key in keys], concurrency)
+
+    return _run(main())
+
+
+def cli(url, documents, concurrency):
+    command = [sys.executable, "-m", "postbin", "--url", url, "--no-browser"]
+    return [_timed(subprocess.run, command + [document], check=True, stdout=subprocess.DEVNULL)
+            for document in documents]
+
+
+BENCHMARKS = {
+    "v1.postSync": v1_post_sync,
+    "v1.postAsync": v1_post_async,
+    "v2.AsyncHaste.post": v2_post,
+    "v2.AsyncHaste.raw": v2_raw,
+    "cli": cli,
+}
+# starting an interpreter per post is slow, so the CLI makes fewer.
+_SCALE = {"cli": 0.05}
+
+
+def _percentile(ordered, percentile):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile))]
+
+
+def _child_peak_memory():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    # ru_maxrss is the largest of any child so far, so this is only exact for the first (or largest) run.
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure(name: str, server: HasteServer, *, count: int = 200, concurrency: int = 16, size: int = 1024) -> dict:
+    """Runs one benchmark against a running :param:`server`, returning its results."""
+    count = max(1, int(count * _SCALE.get(name, 1)))
+    documents = [("%08d" % i).ljust(size, ".") for i in range(count)]
+    if name == "v2.AsyncHaste.raw":
+        # the documents to fetch are stored directly, so posting them isn't part of the measurement.
+        server.documents.update(("d%07d" % i, document.encode()) for i, document in enumerate(documents))
+        documents = sorted(server.documents)
+    subprocess_only = name == "cli"
+    if not subprocess_only:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        latencies = sorted(BENCHMARKS[name](server.url, documents, concurrency))
+        elapsed = time.perf_counter() - started
+        peak = _child_peak_memory() if subprocess_only else tracemalloc.get_traced_memory()[1]
+    finally:
+        if not subprocess_only:
+            tracemalloc.stop()
+    return {
+        "operations": count,
+        "seconds": elapsed,
+        "throughput": count / elapsed,
+        "latency": {
+            "mean": sum(latencies) / count,
+            "p50": _percentile(latencies, 0.5),
+            "p90": _percentile(latencies, 0.9),
+            "p99": _percentile(latencies, 0.99),
+            "max": latencies[-1],
+        },
+        "peak_memory": peak,
+    }
+
+
+def run(names=None, *, count: int = 200, concurrency: int = 16, size: int = 1024, latency: float = 0.0,
+        output: str = None) -> dict:
+    """
+    Runs benchmarks against a fresh local server.
+
+    :param names: the benchmarks to run (keys of :data:`BENCHMARKS`). Defaults to all of them.
+    :param count: how many operations each benchmark makes. The CLI makes a twentieth of that.
+    :param concurrency: how many operations may run at once.
+    :param size: the size (in bytes) of each document.
+    :param latency: how long (in seconds) the server waits before answering each request.
+    :param output: a path to save the results to, as JSON.
+    :return: the results, with the options and environment they were measured with.
+    """
+    from .v2 import __version__
+
+    results = {}
+    with HasteServer(latency=latency) as server:
+        for name in names or BENCHMARKS:
+            if name not in BENCHMARKS:
+                raise ValueError("Unknown benchmark %r. Choose from: %s" % (name, ", ".join(BENCHMARKS)))
+            results[name] = measure(name, server, count=count, concurrency=concurrency, size=size)
+            server.reset()
+    report = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "options": {"count": count, "concurrency": concurrency, "size": size, "latency": latency},
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+    return report
+
+
+def compare(baseline: dict, current: dict) -> dict:
+    """
+    Compares two reports from :func:`run`, benchmark by benchmark.
+
+    :return: for each benchmark in both, the ratio (current / baseline) of its throughput, p50 and p99 latency and
+        peak memory. Throughput going down, or anything else going up, is a regression.
+    """
+    ratios = {}
+    for name, new in current["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        pairs = {
+            "throughput": (old["throughput"], new["throughput"]),
+            "p50": (old["latency"]["p50"], new["latency"]["p50"]),
+            "p99": (old["latency"]["p99"], new["latency"]["p99"]),
+            "peak_memory": (old["peak_memory"], new["peak_memory"]),
+        }
+        ratios[name] = {key: (b / a if a and b is not None else None) for key, (a, b) in pairs.items()}
+    return ratios
+
+
+def _format(report: dict, ratios: dict = None) -> str:
+    lines = ["%-20s %10s %10s %10s %10s %12s" % ("benchmark", "ops/s", "p50 ms", "p90 ms", "p99 ms", "peak KiB")]
+    for name, result in report["results"].items():
+        latency = result["latency"]
+        peak = result["peak_memory"]
+        lines.append("%-20s %10.1f %10.2f %10.2f %10.2f %12s" % (
+            name, result["throughput"], latency["p50"] * 1000, latency["p90"] * 1000, latency["p99"] * 1000,
+            "-" if peak is None else "%.0f" % (peak / 1024)
+        ))
+        if ratios and name in ratios:
+            lines.append("%-20s %s" % ("  vs baseline", "  ".join(
+                "%s x%.2f" % (key, ratio) for key, ratio in ratios[name].items() if ratio is not None
+            )))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m postbin.benchmark", description=__doc__.split("\n\n")[0])
+    parser.add_argument("names", nargs="*", metavar="benchmark", help="Any of: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--count", type=int, default=200, help="Operations per benchmark.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Operations in flight at once.")
+    parser.add_argument("--size", type=int, default=1024, help="Document size in bytes.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Server latency in seconds.")
+    parser.add_argument("--output", "-o", help="Save the results to this JSON file.")
+    parser.add_argument("--compare", help="A JSON file from an earlier run to compare against.")
+    args = parser.parse_args(argv)
+
+    report = run(args.names, count=args.count, concurrency=args.concurrency, size=args.size,
+                 latency=args.latency, output=args.output)
+    ratios = None
+    if args.compare:
+        with open(args.compare) as file:
+            ratios = compare(json.load(file), report)
+    print(_format(report, ratios))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+A read-through cache of haste documents.
+
+Documents never change once created, so a document fetched from a host can be served from memory (or disk)
+forever. Documents that were not found are cached too, briefly, since they may still be created later.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ("DocumentCache", "NOT_FOUND")
+
+NOT_FOUND = object()  # returned by DocumentCache.get for a key that is known not to exist.
+
+
+def _normalise(host: str) -> str:
+    return host.rstrip("/").lower()
+
+
+class DocumentCache:
+    """
+    A two-tier (memory, then disk) cache of raw documents, keyed by ``(host, key)``.
+
+    The memory tier is an LRU bounded by total size in bytes. The optional disk tier stores one file per
+    document in a directory, also bounded by total size, evicting the least recently read files.
+
+    Attributes:
+        hits - int: lookups answered from either tier (including cached "not found"s).
+        misses - int: lookups that had to go to the network.
+    """
+    def __init__(self, max_bytes: int = 64 * 2 ** 20, *, max_item_bytes: int = 4 * 2 ** 20, directory: str = None,
+                 max_disk_bytes: int = 1024 * 2 ** 20, negative_ttl: float = 30.0):
+        """
+        :param max_bytes: the total size of documents kept in memory.
+        :param max_item_bytes: documents larger than this are never cached (in either tier).
+        :param directory: a directory to also keep documents in, one file each. Defaults to memory only.
+        :param max_disk_bytes: the total size of documents kept on disk.
+        :param negative_ttl: how long (in seconds) a "not found" is remembered for. 0 disables it.
+        """
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._size = 0
+        self._missing = {}
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, host: str, key: str) -> str:
+        name = hashlib.sha256((host + "\n" + key).encode()).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def get(self, host: str, key: str):
+        """
+        Looks up a document.
+
+        :return: the document's bytes, :data:`NOT_FOUND` if it is known not to exist, or None on a miss.
+        """
+        body = self._lookup(_normalise(host), key)
+        with self._lock:
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return body
+
+    def find(self, hosts, key: str):
+        """
+        Looks up a document on any of several hosts.
+
+        :return: ``(host, body)`` for the first host with the document cached, ``("*", NOT_FOUND)`` if it is known
+            not to exist anywhere, or ``(None, None)``.
+        """
+        for host in ("*", *hosts):
+            body = self._lookup(_normalise(host), key)
+            if body is not None and (body is not NOT_FOUND or host == "*"):
+                with self._lock:
+                    self.hits += 1
+                return host, body
+        with self._lock:
+            self.misses += 1
+        return None, None
+
+    def _lookup(self, host: str, key: str):
+        with self._lock:
+            body = self._memory.get((host, key))
+            if body is not None:
+                self._memory.move_to_end((host, key))
+                return body
+            expires = self._missing.get((host, key))
+            if expires is not None:
+                if expires > time.monotonic():
+                    return NOT_FOUND
+                del self._missing[(host, key)]
+        body = self._read_disk(host, key)
+        if body is not None:
+            with self._lock:
+                self._remember(host, key, body)
+        return body
+
+    def put(self, host: str, key: str, body: bytes):
+        """Caches a document. Documents larger than ``max_item_bytes`` are ignored."""
+        if len(body) > self.max_item_bytes:
+            return
+        host = _normalise(host)
+        with self._lock:
+            self._missing.pop((host, key), None)
+            self._remember(host, key, bytes(body))
+        if self.directory:
+            self._write_disk(host, key, body)
+
+    def put_missing(self, host: str, key: str):
+        """
+        Remembers that a document was not found, for ``negative_ttl`` seconds.
+
+        A host of ``"*"`` means the document was not found on any host.
+        """
+        if self.negative_ttl > 0:
+            with self._lock:
+                self._missing[(_normalise(host), key)] = time.monotonic() + self.negative_ttl
+
+    def is_missing(self, host: str, key: str) -> bool:
+        """Whether a document is known not to exist on a host. This doesn't count as a hit or a miss."""
+        with self._lock:
+            expires = self._missing.get((_normalise(host), key))
+        return expires is not None and expires > time.monotonic()
+
+    def _remember(self, host: str, key: str, body: bytes):
+        old = self._memory.pop((host, key), None)
+        if old is not None:
+            self._size -= len(old)
+        self._memory[(host, key)] = body
+        self._size += len(body)
+        while self._size > self.max_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _read_disk(self, host: str, key: str):
+        if not self.directory:
+            return None
+        path = self._path(host, key)
+        try:
+            with open(path, "rb") as rfile:
+                body = rfile.read()
+            os.utime(path)  # the mtime is used as the "last read" time for eviction.
+        except OSError:
+            return None
+        return body
+
+    def _write_disk(self, host: str, key: str, body: bytes):
+        path = self._path(host, key)
+        temp = path + ".%d.tmp" % threading.get_ident()
+        with open(temp, "wb") as wfile:
+            wfile.write(body)
+        os.replace(temp, path)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        """Forgets every document in memory. Files on disk are left alone."""
+        with self._lock:
+            self._memory.clear()
+            self._missing.clear()
+            self._size = 0
@@ -0,0 +1,143 @@
+"""
+Process-wide knowledge of what each host accepts, shared between v1 and v2.
+
+Hosts start from known defaults, and what they answer is recorded: a 413 (or haste-server's "Document exceeds
+maximum length.") lowers the host's size limit, a 405 to a HEAD request marks it as not supporting HEAD, and a
+gzipped upload that was refused (or stored without being decoded) marks it as not accepting gzip.
+Clients check the limit before sending anything, so a payload the host is known to refuse is rejected locally
+instead of being uploaded (and re-uploaded to every fallback) just to be refused.
+"""
+import threading
+
+__all__ = ("HostCapabilities", "CapabilityRegistry", "registry")
+
+# haste-server's default maxLength is 400,000 characters, and UTF-8 spends at most 4 bytes on a character, so a
+# larger body is refused whatever it contains.
+HASTE_SERVER_MAX_SIZE = 400_000 * 4
+
+_FIELDS = ("max_size", "head", "raw_path", "format", "gzip")
+DEFAULTS = {"max_size": None, "head": True, "raw_path": "/raw/", "format": "json", "gzip": None}
+# the fallbacks (see postbin._FALLBACKS) all run haste-server, or a clone of its API. haste-server stores a gzipped
+# body as it is, instead of decoding it.
+KNOWN_HOSTS = {
+    url: {"max_size": HASTE_SERVER_MAX_SIZE, "gzip": False}
+    for url in ("https://haste.clicksminuteper.net", "https://paste.pythondiscord.com",
+                "https://haste.unbelievaboat.com", "https://mystb.in", "https://hastebin.com", "https://hst.sh",
+                "https://hasteb.in")
+}
+
+
+def _key(url: str) -> str:
+    return url.rstrip("/").lower()
+
+
+class HostCapabilities:
+    """
+    What a single host accepts.
+
+    Attributes:
+        url - str: the (normalised) base URL of the host.
+        max_size - Optional[int]: the largest document (in bytes) the host is believed to accept, or None if unknown.
+        head - bool: whether the host answers HEAD requests (rather than 405).
+        raw_path - str: the path raw documents are served from, e.g. "/raw/".
+        format - str: how the host answers a post; "json" (``{"key": ...}``) or "text" (the key or URL, as text).
+        gzip - Optional[bool]: whether the host decodes gzipped request bodies, or None if that isn't known yet.
+    """
+    __slots__ = ("url",) + _FIELDS
+
+    def __init__(self, url: str, **fields):
+        self.url = url
+        for name in _FIELDS:
+            setattr(self, name, fields.get(name, DEFAULTS[name]))
+
+    def fits(self, size: int) -> bool:
+        """Whether a body of :param:`size` bytes is within the limit. A size of None (unknown) always fits."""
+        return size is None or self.max_size is None or size <= self.max_size
+
+    def __repr__(self):
+        return "HostCapabilities(url={0.url!r} max_size={0.max_size!r} head={0.head!r})".format(self)
+
+
+class CapabilityRegistry:
+    """A thread-safe record of every host's capabilities, learnt from the responses it sends."""
+    def __init__(self, known: dict = None):
+        """
+        :param known: the capabilities to start from, as ``{url: {field: value}}``. Defaults to
+            :data:`KNOWN_HOSTS`. Fields left out (and hosts not listed) get :data:`DEFAULTS`.
+        """
+        self.known = {_key(url): fields for url, fields in (KNOWN_HOSTS if known is None else known).items()}
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> HostCapabilities:
+        """Returns the capabilities of a host, starting from its known defaults if it has not been seen before."""
+        key = _key(url)
+        with self._lock:
+            host = self._hosts.get(key)
+            if host is None:
+                host = self._hosts[key] = HostCapabilities(key, **self.known.get(key, {}))
+            return host
+
+    def update(self, url: str, **fields):
+        """Sets a host's capabilities, e.g. ``update(url, max_size=10 * 2 ** 20)`` for a host you configured."""
+        unknown = set(fields) - set(_FIELDS)
+        if unknown:
+            raise TypeError("Unknown capabilities: " + ", ".join(sorted(unknown)))
+        host = self.get(url)
+        with self._lock:
+            for name, value in fields.items():
+                setattr(host, name, value)
+
+    def fits(self, url: str, size: int) -> bool:
+        """Whether the host is believed to accept a body of :param:`size` bytes."""
+        return self.get(url).fits(size)
+
+    def refusing(self, urls, size: int) -> list:
+        """Filters :param:`urls` down to the hosts believed to refuse a body of :param:`size` bytes."""
+        return [url for url in urls if not self.fits(url, size)]
+
+    def record_too_large(self, url: str, size: int):
+        """Records that the host refused a body of :param:`size` bytes as too large, lowering its limit."""
+        if size is None:
+            return
+        host = self.get(url)
+        with self._lock:
+            if host.max_size is None or size <= host.max_size:
+                host.max_size = size - 1
+
+    def record_accepted(self, url: str, size: int):
+        """Records that the host accepted a body of :param:`size` bytes, raising its limit if it was lower."""
+        if size is None:
+            return
+        host = self.get(url)
+        with self._lock:
+            if host.max_size is not None and size > host.max_size:
+                host.max_size = size
+
+    def record_no_head(self, url: str):
+        """Records that the host answered a HEAD request with 405, so it is probed with GET from now on."""
+        host = self.get(url)
+        with self._lock:
+            host.head = False
+
+    def record_gzip(self, url: str, accepted: bool):
+        """Records whether the host decodes gzipped request bodies."""
+        host = self.get(url)
+        with self._lock:
+            host.gzip = accepted
+
+    def reset(self, url: str = None):
+        """Forgets everything learnt about one host, or every host if no URL is given."""
+        with self._lock:
+            if url is None:
+                self._hosts.clear()
+            else:
+                self._hosts.pop(_key(url), None)
+
+    def snapshot(self) -> dict:
+        """Returns a copy of every recorded host's capabilities, keyed by URL."""
+        with self._lock:
+            return {key: {name: getattr(host, name) for name in _FIELDS} for key, host in self._hosts.items()}
+
+
+registry = CapabilityRegistry()
@@ -0,0 +1,172 @@
+"""
+Compressed uploads and downloads.
+
+Raw documents are asked for with ``Accept-Encoding`` (gzip, and br if the brotli package is installed), and decoded
+a chunk at a time as they arrive. Uploads are only gzipped when a :class:`CompressionPolicy` says so, and only to
+hosts known to accept gzipped bodies (see :mod:`postbin.capabilities`): haste-server doesn't decode them, and
+would store the compressed bytes as the document.
+
+The bytes compression saved are added to each request's trace, and counted in
+``postbin_compression_saved_bytes_total`` (see :mod:`postbin.tracing`).
+"""
+import gzip
+import zlib
+
+from postbin.lazy import LazyModule
+
+__all__ = ("CompressionPolicy", "Decoder", "DecodedStream", "ACCEPT_ENCODING")
+
+brotli = LazyModule("brotli")
+
+# br is only asked for when it can be decoded.
+ACCEPT_ENCODING = "gzip, br" if brotli else "gzip"
+
+
+class Decoder:
+    """Decodes a response body a chunk at a time, as given by its ``Content-Encoding``."""
+    def __init__(self, encoding: str = None):
+        """
+        :param encoding: the Content-Encoding header. None (or "identity") passes chunks through unchanged.
+        :raise ValueError: the encoding isn't supported.
+        """
+        self.encoding = (encoding or "identity").strip().lower()
+        if self.encoding == "identity":
+            self._decoder = None
+        elif self.encoding in ("gzip", "x-gzip"):
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == "deflate":
+            self._decoder = zlib.decompressobj()
+        elif self.encoding == "br" and brotli:
+            self._decoder = brotli.Decompressor()
+        else:
+            raise ValueError("Unsupported Content-Encoding: %r" % encoding)
+        self.received = 0
+        self.decoded = 0
+
+    @property
+    def saved(self) -> int:
+        """How many bytes compression saved so far."""
+        return self.decoded - self.received
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Decodes the next chunk of the body."""
+        self.received += len(chunk)
+        if self._decoder is None:
+            data = chunk
+        elif self.encoding == "br":
+            data = self._decoder.process(chunk)
+        else:
+            data = self._decoder.decompress(chunk)
+        self.decoded += len(data)
+        return data
+
+    def flush(self) -> bytes:
+        """Returns whatever is left once the whole body was fed."""
+        if self._decoder is None or self.encoding == "br":
+            return b""
+        data = self._decoder.flush()
+        self.decoded += len(data)
+        return data
+
+
+class CompressionPolicy:
+    """
+    When to gzip an upload.
+
+    Bodies smaller than :param:`threshold` aren't worth compressing. Bodies of :param:`executor_threshold` bytes
+    or more are compressed on a worker thread, so compressing them doesn't block the event loop.
+    Only bodies held in memory are compressed: files and streams are sent as they are.
+    """
+    def __init__(self, *, threshold: int = 1024, executor_threshold: int = 256 * 1024, level: int = 6):
+        """
+        :param threshold: the smallest body (in bytes) to compress.
+        :param executor_threshold: the smallest body (in bytes) to compress on a worker thread.
+        :param level: the gzip compression level, from 1 (fastest) to 9 (smallest).
+        """
+        self.threshold = threshold
+        self.executor_threshold = executor_threshold
+        self.level = level
+
+    def wants(self, size: int) -> bool:
+        """Whether a body of :param:`size` bytes should be compressed."""
+        return size is not None and size >= self.threshold
+
+    def compress(self, data) -> bytes:
+        return gzip.compress(data, self.level)
+
+    async def compress_async(self, data) -> bytes:
+        """Compresses :param:`data`, on a worker thread if it is large."""
+        if memoryview(data).nbytes < self.executor_threshold:
+            return self.compress(data)
+        import asyncio
+
+        return await asyncio.get_event_loop().run_in_executor(None, self.compress, data)
+
+    def __repr__(self):
+        return "CompressionPolicy(threshold=%d executor_threshold=%d level=%d)" % (
+            self.threshold, self.executor_threshold, self.level
+        )
+
+
+class DecodedStream:
+    """
+    Reads an aiohttp response body decoded, through the same ``read()`` and ``iter_chunked()`` its ``content`` has.
+
+    The response has to be requested with ``auto_decompress=False``, so that the body is decoded here, a chunk at a
+    time, and the bytes compression saved can be counted.
+    """
+    def __init__(self, content, encoding: str = None, chunk_size: int = 2 ** 16):
+        """
+        :param content: the response's ``content`` (an ``aiohttp.StreamReader``).
+        :param encoding: the response's Content-Encoding header.
+        :param chunk_size: how much of the encoded body to read at a time.
+        """
+        self.content = content
+        self.decoder = Decoder(encoding)
+        self.chunk_size = chunk_size
+        self._buffer = b""
+        self._offset = 0
+        self._done = False
+
+    @property
+    def received(self) -> int:
+        """How many (encoded) bytes were read so far."""
+        return self.decoder.received
+
+    @property
+    def saved(self) -> int:
+        """How many bytes compression saved so far."""
+        return self.decoder.saved
+
+    async def _fill(self):
+        while self._offset >= len(self._buffer) and not self._done:
+            chunk = await self.content.read(self.chunk_size)
+            if chunk:
+                self._buffer = self.decoder.feed(chunk)
+            else:
+                self._buffer = self.decoder.flush()
+                self._done = True
+            self._offset = 0
+
+    async def read(self, n: int = -1) -> bytes:
+        """Reads up to :param:`n` decoded bytes, or (if n is negative) the rest of the body."""
+        if n < 0:
+            parts = []
+            while True:
+                await self._fill()
+                if self._offset >= len(self._buffer):
+                    return b"".join(parts)
+                parts.append(self._buffer[self._offset:] if self._offset else self._buffer)
+                self._offset = len(self._buffer)
+        await self._fill()
+        data = self._buffer[self._offset:self._offset + n]
+        self._offset += len(data)
+        return data
+
+    async def iter_chunked(self, n: int):
+        """Yields the rest of the body, decoded, in chunks of at most :param:`n` bytes."""
+        while True:
+            data = await self.read(n)
+            if not data:
+                return
+            yield data
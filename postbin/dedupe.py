@@ -0,0 +1,215 @@
+"""
+Content-addressed de-duplication of posts.
+
+A :class:`DedupeCache` maps the SHA-256 digest of what was posted to the URL it was posted to, so posting the
+same content again returns the same URL without any network I/O. Concurrent posts of the same content are
+coalesced into a single upload.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from postbin.lazy import LazyModule
+from postbin.payload import Payload, size_of
+
+# only needed by async callers, and by caches kept on disk.
+asyncio = LazyModule("asyncio")
+sqlite3 = LazyModule("sqlite3")
+
+__all__ = ("DedupeCache", "digest")
+
+_STR_SLICE = 2 ** 20  # characters of a str hashed at a time, so it is never encoded all at once.
+_EXECUTOR_THRESHOLD = 256 * 1024  # bytes. Async callers hash anything larger (or of unknown size) on a worker thread.
+
+
+def digest(content):
+    """
+    Returns the hex SHA-256 digest of something to post, or None if it can't be hashed without consuming it.
+
+    Text is hashed as utf-8, a slice at a time. Files are read in chunks, then rewound.
+    """
+    hasher = hashlib.sha256()
+    if isinstance(content, str):
+        for start in range(0, len(content), _STR_SLICE):
+            hasher.update(content[start:start + _STR_SLICE].encode("utf-8"))
+        return hasher.hexdigest()
+    if not Payload.wrap(content).update_hash(hasher):
+        return None
+    return hasher.hexdigest()
+
+
+class _DiskStore:
+    """An SQLite table of digest -> URL, evicting the least recently used rows beyond max_entries."""
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS documents (digest TEXT PRIMARY KEY, url TEXT, created REAL, used REAL)"
+        )
+        self._db.commit()
+
+    def get(self, key: str, ttl: float = None):
+        row = self._db.execute("SELECT url, created FROM documents WHERE digest = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if ttl is not None and time.time() - row[1] > ttl:
+            self._db.execute("DELETE FROM documents WHERE digest = ?", (key,))
+            self._db.commit()
+            return None
+        self._db.execute("UPDATE documents SET used = ? WHERE digest = ?", (time.time(), key))
+        self._db.commit()
+        return row[0]
+
+    def put(self, key: str, url: str):
+        now = time.time()
+        self._db.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)", (key, url, now, now))
+        self._db.execute(
+            "DELETE FROM documents WHERE digest NOT IN (SELECT digest FROM documents ORDER BY used DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+class DedupeCache:
+    """
+    Remembers the URL every piece of content was posted to.
+
+    Entries are kept in an in-memory LRU and, if a path is given, an SQLite database that survives restarts.
+    This class is thread-safe, and can be shared between AsyncHaste, SyncHaste and postSync/postAsync.
+    """
+    def __init__(self, max_entries: int = 1024, *, path: str = None, ttl: float = None,
+                 max_disk_entries: int = 100_000):
+        """
+        :param max_entries: how many URLs to keep in memory.
+        :param path: the path of an SQLite database to also keep URLs in. Defaults to memory only.
+        :param ttl: how long (in seconds) a URL is re-used for, for hosts that expire documents. Defaults to forever.
+        :param max_disk_entries: how many URLs to keep in the database.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._disk = _DiskStore(path, max_disk_entries) if path else None
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(content, url: str = "auto"):
+        """
+        Returns the cache key for posting :param:`content` to :param:`url`, or None if it can't be de-duplicated.
+
+        Posts to an explicit URL are only ever de-duplicated against posts to that same URL.
+        """
+        content_digest = digest(content)
+        return None if content_digest is None else content_digest + " " + (url or "auto")
+
+    @staticmethod
+    async def key_async(content, url: str = "auto"):
+        """The same as :meth:`key`, but large content (and files) are hashed on a worker thread."""
+        size = size_of(content)
+        if size is not None and size < _EXECUTOR_THRESHOLD:
+            return DedupeCache.key(content, url)
+        return await asyncio.get_event_loop().run_in_executor(None, DedupeCache.key, content, url)
+
+    def get(self, key: str):
+        """Returns the URL stored for a key, or None."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and (self.ttl is None or time.monotonic() - entry[1] <= self.ttl):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            url = self._disk.get(key, self.ttl) if self._disk else None
+            if url is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, url)
+            return url
+
+    def put(self, key: str, url: str):
+        """Stores the URL some content was posted to."""
+        with self._lock:
+            self._remember(key, url)
+            if self._disk:
+                self._disk.put(key, url)
+
+    def _remember(self, key: str, url: str):
+        self._memory[key] = (url, time.monotonic())
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _claim(self, key: str):
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future, False
+            future = self._in_flight[key] = Future()
+            return future, True
+
+    def _settle(self, key: str, future: Future, url: str = None, error: BaseException = None):
+        if url:
+            self.put(key, url)  # stored before the claim is released, so no one re-posts in between.
+        with self._lock:
+            self._in_flight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(url)
+
+    def run(self, key: str, post):
+        """
+        Returns the cached URL for a key, or calls :param:`post` to create one.
+
+        If another thread is already posting the same key, this waits for its result instead of posting again.
+        """
+        url = self.get(key)
+        if url is not None:
+            return url
+        future, owner = self._claim(key)
+        if not owner:
+            return future.result()
+        try:
+            url = post()
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, url)
+        return url
+
+    async def run_async(self, key: str, post):
+        """
+        The same as :meth:`run`, but :param:`post` returns an awaitable.
+
+        If the cache is kept on disk, the database is queried (and committed to) on a worker thread, so it
+        doesn't block the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        url = await loop.run_in_executor(None, self.get, key) if self._disk else self.get(key)
+        if url is not None:
+            return url
+        future, owner = self._claim(key)
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            url = await post()
+        except BaseException as e:
+            self._settle(key, future, error=e)  # nothing is stored, so there's nothing to wait for.
+            raise
+        if self._disk:
+            await loop.run_in_executor(None, self._settle, key, future, url)
+        else:
+            self._settle(key, future, url)
+        return url
+
+    def close(self):
+        """Closes the database, if there is one."""
+        if self._disk:
+            self._disk.close()
@@ -0,0 +1,178 @@
+"""
+A logging handler that posts batches of log records to a haste service, in the background.
+
+Logging through a :class:`HasteHandler` never waits on the network: records are formatted into a bounded buffer,
+and a worker thread posts them as one haste when enough have built up, when enough time has passed, or when a
+severe enough record arrives. Each batch's URL is handed to ``on_flush`` (e.g. to link it from an alert).
+
+    handler = HasteHandler(flush_level=logging.ERROR, on_flush=lambda url, count: alert("Logs: " + url))
+    logging.getLogger().addHandler(handler)
+"""
+import atexit
+import collections
+import logging
+import threading
+
+__all__ = ("HasteHandler",)
+
+_DEFAULT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class HasteHandler(logging.Handler):
+    """
+    Buffers log records and posts them to haste in batches, from a background thread.
+
+    When records arrive faster than they can be posted, the buffer (a ring of :param:`capacity` records) drops
+    the oldest ones. Dropped records are counted, and summarised at the top of the next batch.
+
+    Attributes:
+        urls - collections.deque: the URLs of the most recent batches, newest last.
+        batches - int: how many batches were posted.
+        dropped - int: how many records were dropped because the buffer was full.
+        failed - int: how many records were lost because their batch couldn't be posted.
+    """
+    def __init__(self, level=logging.NOTSET, *, capacity: int = 10000, batch_size: int = 500,
+                 flush_interval: float = 60.0, flush_level: int = logging.ERROR, url: str = "auto",
+                 timeout: float = 30.0, haste=None, on_flush=None):
+        """
+        :param level: the lowest level of record to handle.
+        :param capacity: the most records to buffer. Beyond this, the oldest are dropped.
+        :param batch_size: post a batch once this many records are buffered.
+        :param flush_interval: post a batch (if any records are buffered) this often, in seconds. None to disable.
+        :param flush_level: post a batch as soon as a record of this level (or higher) arrives. None to disable.
+        :param url: the haste service to post to. If "auto", the first working fallback is used.
+        :param timeout: how long (in seconds) posting a batch may take.
+        :param haste: a :class:`postbin.v2.ThreadedHaste` to post through. Defaults to a new one, with its own
+            session, on the shared background loop.
+        :param on_flush: called as ``on_flush(url, count)`` from the worker thread after each batch is posted.
+        """
+        super().__init__(level)
+        self._owns_haste = haste is None
+        if haste is None:
+            from postbin.v2 import ThreadedHaste
+            haste = ThreadedHaste()
+        self.haste = haste
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.url = url
+        self.timeout = timeout
+        self.on_flush = on_flush
+        self.urls = collections.deque(maxlen=100)
+        self.batches = 0
+        self.dropped = 0
+        self.failed = 0
+        self._buffer = collections.deque()
+        self._dropped_levels = collections.Counter()
+        self._buffer_lock = threading.Lock()
+        self._ship_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._worker = threading.Thread(target=self._work, name="PostBin-HasteHandler", daemon=True)
+        self._worker.start()
+        # logging.shutdown() would also close us, but only after the shared loop has been stopped at exit.
+        atexit.register(self.close)
+
+    @property
+    def last_url(self):
+        """The URL of the most recent batch, or None if none was posted yet."""
+        return self.urls[-1] if self.urls else None
+
+    @property
+    def pending(self) -> int:
+        """How many records are buffered, waiting to be posted."""
+        return len(self._buffer)
+
+    def _ignored(self, record: logging.LogRecord) -> bool:
+        # records logged while posting (e.g. by postbin's own tracing) would otherwise trigger batches of their own.
+        return record.thread in (self._worker.ident, self.haste.runner.ident)
+
+    def emit(self, record: logging.LogRecord):
+        if self._closed or self._ignored(record):
+            return
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self._buffer_lock:
+            if len(self._buffer) >= self.capacity:
+                _, levelname = self._buffer.popleft()
+                self.dropped += 1
+                self._dropped_levels[levelname] += 1
+            self._buffer.append((line, record.levelname))
+            full = len(self._buffer) >= self.batch_size
+        if full or (self.flush_level is not None and record.levelno >= self.flush_level):
+            self._wake.set()
+
+    def format(self, record: logging.LogRecord) -> str:
+        if self.formatter is None:
+            self.formatter = logging.Formatter(_DEFAULT_FORMAT)
+        return super().format(record)
+
+    def _take(self):
+        with self._buffer_lock:
+            batch, self._buffer = self._buffer, collections.deque()
+            dropped, self._dropped_levels = self._dropped_levels, collections.Counter()
+        return batch, dropped
+
+    def _ship(self):
+        batch, dropped = self._take()
+        if not batch:
+            return None
+        lines = [line for line, _ in batch]
+        if dropped:
+            summary = ", ".join("%s: %d" % item for item in sorted(dropped.items()))
+            lines.insert(0, "[postbin] %d records were dropped before this batch (%s)" % (sum(dropped.values()),
+                                                                                         summary))
+        try:
+            url = self.haste.post("\n".join(lines) + "\n", url=self.url, timeout=self.timeout)
+        except Exception:
+            self.failed += len(batch)
+            return None
+        self.batches += 1
+        self.urls.append(url)
+        if self.on_flush is not None:
+            try:
+                self.on_flush(url, len(batch))
+            except Exception:
+                pass  # a broken callback mustn't stop the worker.
+        return url
+
+    def _work(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._closed:
+                return
+            with self._ship_lock:
+                self._ship()
+
+    def flush(self):
+        """
+        Posts whatever is buffered now, in the calling thread, and returns its URL.
+
+        :return: the URL of the batch, or None if there was nothing to post (or posting it failed).
+        """
+        posted = self.batches
+        with self._ship_lock:
+            url = self._ship()
+        if url is None and self.batches > posted:
+            return self.last_url  # the worker posted what was buffered while we waited for it.
+        return url
+
+    def close(self):
+        """Posts whatever is still buffered, and stops the worker (and closes the session, if it is ours)."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self.flush()
+        if self._owns_haste:
+            self.haste.close()
+        super().close()
+
+    def __repr__(self):
+        return "<%s (%s) pending=%d dropped=%d>" % (self.__class__.__name__, logging.getLevelName(self.level),
+                                                    self.pending, self.dropped)
@@ -0,0 +1,222 @@
+"""
+Process-wide host health tracking, shared between v1 and v2.
+
+Every post, probe and raw fetch records its outcome here, so a host that is known to be dead is skipped
+instead of being re-probed on every call, and a host that recently worked is used without probing at all.
+"""
+import threading
+import time
+
+from postbin.selection import Ordered, Strategy
+
+__all__ = ("HostHealth", "HealthRegistry", "registry")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+def _key(url: str) -> str:
+    return url.rstrip("/").lower()
+
+
+class HostHealth:
+    """
+    The recorded health of a single host.
+
+    Attributes:
+        url - str: the (normalised) base URL of the host.
+        state - str: the circuit state; one of "closed" (healthy), "open" (skipped) or "half-open" (being tested).
+        successes - int: total successful requests.
+        failures - int: total failed requests.
+        consecutive_failures - int: failures since the last success.
+        last_success - float: monotonic time of the last success, or 0.
+        opened_at - float: monotonic time the circuit was last opened, or 0.
+        latency - Optional[float]: the moving average of successful requests' latency in seconds, or None.
+        error_rate - float: the moving average of the fraction of requests that failed, from 0 to 1.
+    """
+    __slots__ = ("url", "state", "successes", "failures", "consecutive_failures", "last_success", "opened_at",
+                 "probing", "latency", "error_rate")
+
+    def __init__(self, url: str):
+        self.url = url
+        self.state = CLOSED
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_success = 0.0
+        self.opened_at = 0.0
+        self.probing = False
+        self.latency = None
+        self.error_rate = 0.0
+
+    def __repr__(self):
+        return "HostHealth(url={0.url!r} state={0.state!r} successes={0.successes} failures={0.failures})".format(
+            self
+        )
+
+
+class HealthRegistry:
+    """
+    A thread-safe circuit breaker for every host PostBin talks to.
+
+    A host's circuit opens after ``failure_threshold`` consecutive failures (or immediately if the host was
+    reported offline), and stays open for ``cooldown`` seconds. After that, a single caller is allowed through
+    as a half-open probe: if it succeeds the circuit closes, otherwise it opens again.
+
+    It also keeps a moving average of each host's latency and error rate, which :attr:`strategy` uses to order
+    the hosts returned by :meth:`healthy` and :meth:`candidates`.
+    """
+    def __init__(self, *, failure_threshold: int = 3, cooldown: float = 30.0, ttl: float = 60.0, alpha: float = 0.3,
+                 strategy: Strategy = None):
+        """
+        :param failure_threshold: how many consecutive failures open a circuit.
+        :param cooldown: how long (in seconds) an open circuit stays open before a half-open probe is allowed.
+        :param ttl: how long (in seconds) a success is trusted for, meaning the host needs no probing.
+        :param alpha: how much weight the moving averages give to the newest request, from 0 to 1.
+        :param strategy: how to order hosts (see :mod:`postbin.selection`). Defaults to the order given.
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.ttl = ttl
+        self.alpha = alpha
+        self.strategy = strategy or Ordered()
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> HostHealth:
+        """Returns the health record of a host, creating it if it has not been seen before."""
+        key = _key(url)
+        with self._lock:
+            host = self._hosts.get(key)
+            if host is None:
+                host = self._hosts[key] = HostHealth(key)
+            return host
+
+    def record_success(self, url: str, *, latency: float = None):
+        """
+        Records that a request to the host succeeded, closing its circuit.
+
+        :param url: the host's base URL.
+        :param latency: how long (in seconds) the request took, if it was timed.
+        """
+        host = self.get(url)
+        with self._lock:
+            if latency is not None:
+                host.latency = latency if host.latency is None else self._average(host.latency, latency)
+            host.error_rate = self._average(host.error_rate, 0.0)
+            host.successes += 1
+            host.consecutive_failures = 0
+            host.last_success = time.monotonic()
+            host.state = CLOSED
+            host.probing = False
+
+    def record_failure(self, url: str, *, offline: bool = False):
+        """
+        Records that a request to the host failed.
+
+        :param url: the host's base URL.
+        :param offline: whether the host was unreachable or reported itself unavailable (503). This opens the
+            circuit immediately instead of waiting for the failure threshold.
+        """
+        host = self.get(url)
+        with self._lock:
+            host.error_rate = self._average(host.error_rate, 1.0)
+            host.failures += 1
+            host.consecutive_failures += 1
+            host.probing = False
+            if offline or host.state == HALF_OPEN or host.consecutive_failures >= self.failure_threshold:
+                host.state = OPEN
+                host.opened_at = time.monotonic()
+
+    def _average(self, average: float, value: float) -> float:
+        return average + self.alpha * (value - average)
+
+    def available(self, url: str) -> bool:
+        """
+        Whether :meth:`allow` would let a request through to the host right now. Unlike :meth:`allow`, this
+        doesn't claim the half-open probe, so it can be used to pick hosts that may never be sent anything.
+        """
+        host = self.get(url)
+        now = time.monotonic()
+        with self._lock:
+            if host.state == CLOSED:
+                return True
+            if host.state == OPEN:
+                return now - host.opened_at >= self.cooldown
+            return not host.probing or now - host.opened_at >= self.cooldown
+
+    def allow(self, url: str) -> bool:
+        """
+        Whether a request should be sent to the host right now. Call this just before sending one.
+
+        If the host's cooldown has expired, the first caller is let through as a half-open probe and every
+        other caller is turned away until that probe's result is recorded.
+        """
+        host = self.get(url)
+        now = time.monotonic()
+        with self._lock:
+            if host.state == CLOSED:
+                return True
+            if host.state == OPEN and now - host.opened_at >= self.cooldown:
+                host.state = HALF_OPEN
+                host.probing = False
+            # a probe that never reported back (e.g. it was cancelled) expires after another cooldown.
+            if host.state == HALF_OPEN and (not host.probing or now - host.opened_at >= self.cooldown):
+                host.probing = True
+                host.opened_at = now
+                return True
+            return False
+
+    def is_healthy(self, url: str) -> bool:
+        """
+        Whether the host's last request succeeded, recently enough (within ``ttl``) that it does not need to be
+        probed.
+        """
+        host = self.get(url)
+        with self._lock:
+            if host.state != CLOSED or host.consecutive_failures or not host.last_success:
+                return False
+            return time.monotonic() - host.last_success < self.ttl
+
+    def order(self, urls) -> list:
+        """Puts :param:`urls` in the order :attr:`strategy` says they should be tried in."""
+        return self.strategy.order(list(urls), self)
+
+    def healthy(self, urls) -> list:
+        """Filters :param:`urls` down to the hosts that are known to be healthy, ordered by :attr:`strategy`."""
+        return self.order(url for url in urls if self.is_healthy(url))
+
+    def candidates(self, urls) -> list:
+        """
+        Filters :param:`urls` down to the hosts whose circuit allows a request, ordered by :attr:`strategy`.
+
+        Nothing is claimed: :meth:`allow` must still be called before a request is sent to any of them.
+        """
+        return self.order(url for url in urls if self.available(url))
+
+    def reset(self, url: str = None):
+        """Forgets everything about one host, or every host if no URL is given."""
+        with self._lock:
+            if url is None:
+                self._hosts.clear()
+            else:
+                self._hosts.pop(_key(url), None)
+
+    def snapshot(self) -> dict:
+        """Returns a copy of every recorded host, keyed by URL."""
+        with self._lock:
+            return {
+                key: {
+                    "state": host.state,
+                    "successes": host.successes,
+                    "failures": host.failures,
+                    "consecutive_failures": host.consecutive_failures,
+                    "latency": host.latency,
+                    "error_rate": host.error_rate,
+                }
+                for key, host in self._hosts.items()
+            }
+
+
+registry = HealthRegistry()
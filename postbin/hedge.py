@@ -0,0 +1,104 @@
+"""
+Hedged requests, to cut tail latency.
+
+If a host is slow to answer, the same request is also sent to the next host, and whichever answers first wins.
+A budget bounds how many extra requests hedging may send, so it can never more than double the load.
+"""
+import threading
+from collections import deque
+
+__all__ = ("HedgePolicy",)
+
+
+class HedgePolicy:
+    """
+    When to hedge a request, and how many hedges may be sent.
+
+    The budget is a token bucket: every request that is not a hedge earns :param:`budget` tokens (up to
+    :param:`burst`), and every hedge spends one. With a budget of 0.1, at most about one request in ten is
+    hedged. The budget is capped at 1, which would allow one hedge per request, doubling the load.
+
+    Attributes:
+        hedges - int: how many hedges were sent.
+        wins - int: how many hedges answered before the request they hedged.
+        duplicates - int: how many hedged posts may have created a second document.
+    """
+    def __init__(self, delay: float = None, *, percentile: float = 0.95, default_delay: float = 1.0,
+                 min_samples: int = 20, window: int = 512, budget: float = 0.1, burst: float = 5.0,
+                 on_duplicate=None):
+        """
+        :param delay: how long (in seconds) to wait for a host before hedging. Defaults to the
+            :param:`percentile` of recent latencies.
+        :param percentile: which percentile of recent latencies to use as the delay, from 0 to 1.
+        :param default_delay: the delay used until :param:`min_samples` latencies have been seen.
+        :param min_samples: how many latencies to see before trusting their percentile.
+        :param window: how many of the most recent latencies to keep, per kind of request.
+        :param budget: how many hedges each normal request pays for, from 0 to 1.
+        :param burst: the most hedges that may be saved up.
+        :param on_duplicate: called as ``on_duplicate(url, duplicate, host)`` when a post was hedged and the
+            losing request may also have created a document. ``url`` is the URL returned to the caller.
+            ``duplicate`` is the URL of the other document, or None if the request was cancelled before its
+            answer arrived (the document may or may not exist). ``host`` is the host the duplicate was sent to.
+        """
+        self.delay = delay
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.window = window
+        self.budget = min(1.0, max(0.0, budget))
+        self.burst = burst
+        self.on_duplicate = on_duplicate
+        self.hedges = 0
+        self.wins = 0
+        self.duplicates = 0
+        self._tokens = 0.0
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, kind: str, latency: float):
+        """Records the latency of a successful request of a kind (e.g. "post" or "raw")."""
+        with self._lock:
+            samples = self._samples.get(kind)
+            if samples is None:
+                samples = self._samples[kind] = deque(maxlen=self.window)
+            samples.append(latency)
+
+    def delay_for(self, kind: str) -> float:
+        """How long to wait on a request of a kind before hedging it."""
+        if self.delay is not None:
+            return self.delay
+        with self._lock:
+            samples = sorted(self._samples.get(kind, ()))
+        if len(samples) < self.min_samples:
+            return self.default_delay
+        return samples[min(len(samples) - 1, int(len(samples) * self.percentile))]
+
+    def earn(self):
+        """Adds the budget of one normal request."""
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.budget)
+
+    def spend(self) -> bool:
+        """Takes one hedge from the budget, returning False if there isn't one left."""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.hedges += 1
+            return True
+
+    def record_win(self):
+        """Counts a hedge that answered first."""
+        with self._lock:
+            self.wins += 1
+
+    def report_duplicate(self, url: str, duplicate: str = None, host: str = None):
+        """Counts (and reports to :param:`on_duplicate`) a post that may have been created twice."""
+        with self._lock:
+            self.duplicates += 1
+        if self.on_duplicate is not None:
+            self.on_duplicate(url, duplicate, host)
+
+    def __repr__(self):
+        return "<HedgePolicy delay=%r budget=%r hedges=%d wins=%d>" % (self.delay, self.budget, self.hedges,
+                                                                      self.wins)
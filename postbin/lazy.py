@@ -0,0 +1,51 @@
+"""
+Modules that are only imported when they are first used.
+
+requests and aiohttp take most of the time it takes to import postbin, and most programs (and the CLI) only use
+one of them, so they are bound as :class:`LazyModule` s and imported by the first attribute lookup instead.
+"""
+import importlib
+import importlib.util
+import sys
+
+__all__ = ("LazyModule",)
+
+
+class LazyModule:
+    """
+    Stands in for a module until one of its attributes is used, at which point the module is imported.
+
+    A lazy module is falsy if the module is not installed (checked without importing it), so
+    ``if not requests: ...`` still works as it did with ``try: import requests except ImportError: requests = None``.
+    """
+    def __init__(self, name: str):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the module has been imported (by anything, not just this stand-in)."""
+        return self._module is not None or sys.modules.get(self._name) is not None
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            module = self.__dict__["_module"] = importlib.import_module(self._name)
+        return module
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __setattr__(self, key, value):
+        setattr(self._load(), key, value)
+
+    def __bool__(self):
+        if self.loaded:
+            return True
+        try:
+            return importlib.util.find_spec(self._name) is not None
+        except (ImportError, ValueError):
+            return False
+
+    def __repr__(self):
+        return "<LazyModule %r%s>" % (self._name, " (loaded)" if self.loaded else "")
@@ -0,0 +1,216 @@
+"""
+Request bodies that are streamed to the server instead of being loaded into memory.
+
+A :class:`Payload` wraps whatever the caller wants to post (text, bytes, a file, a path or an iterator of
+chunks) and hands requests or aiohttp a body they can stream, without ever joining it into one string.
+"""
+import io
+import os
+
+__all__ = ("Payload", "size_of", "preview")
+
+
+def _is_ascii(text: str) -> bool:
+    if hasattr(text, "isascii"):
+        return text.isascii()
+    try:  # str.isascii is new in Python 3.7.
+        text.encode("ascii")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def size_of(content, encoding: str = "utf-8"):
+    """
+    The size of what posting :param:`content` would send, in bytes, without encoding (or copying) it.
+
+    :return: the size, or None if it can't be known without reading it (a file object or an iterator).
+    """
+    if isinstance(content, Payload):
+        return content.size
+    if isinstance(content, str):
+        if encoding.replace("-", "").lower() in ("utf8", "ascii", "latin1") and _is_ascii(content):
+            return len(content)
+        return len(content.encode(encoding))
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        return memoryview(content).nbytes
+    if isinstance(content, os.PathLike):
+        return os.stat(content).st_size
+    return None
+
+
+def preview(content, limit: int = 64) -> str:
+    """
+    Describes :param:`content` for error messages and logs, without copying more than :param:`limit` characters.
+
+    :return: the repr of its first characters if it is in memory, otherwise the file's name or "<stream>".
+    """
+    if isinstance(content, Payload):
+        return content.preview(limit)
+    if isinstance(content, str):
+        return repr(content[:limit]) + ("..." if len(content) > limit else "")
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        return Payload(content).preview(limit)
+    if isinstance(content, os.PathLike):
+        return "<file %s>" % os.fspath(content)
+    return "<stream>"
+
+
+class Payload:
+    """
+    Something to post, that can be streamed.
+
+    Accepted content:
+        - str: encoded once, with :param:`encoding`.
+        - bytes, bytearray or memoryview: sent as-is, without copying.
+        - os.PathLike (e.g. pathlib.Path): the file is opened and streamed.
+        - a binary or text file object: streamed from its current position.
+        - a sync or async iterator of str/bytes chunks: streamed with chunked transfer encoding.
+
+    Anything else is posted as its ``repr()``, like v1 always has.
+
+    Attributes:
+        size - Optional[int]: the size of the body in bytes, or None if it can't be known without reading it.
+        replayable - bool: whether the body can be sent more than once (e.g. to a fallback).
+    """
+    def __init__(self, content, *, encoding: str = "utf-8"):
+        self.encoding = encoding
+        self._file = None
+        self._owns_file = False
+        self._start = None
+        self._sent = False
+        self._chunks = False
+        self.size = None
+        self.replayable = True
+
+        if isinstance(content, str):
+            content = content.encode(encoding)
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            self.body = content
+            self.size = memoryview(content).nbytes
+        elif isinstance(content, os.PathLike):
+            self._file = open(content, "rb")
+            self._owns_file = True
+            self._prepare_file()
+        elif hasattr(content, "read"):
+            self._file = getattr(content, "buffer", content)  # text files are read through their binary buffer.
+            self._prepare_file()
+        elif hasattr(content, "__aiter__") or hasattr(content, "__next__"):
+            self.body = content
+            self._chunks = True
+            self.replayable = False
+        else:
+            self.body = repr(content).encode(encoding)
+            self.size = len(self.body)
+
+    @classmethod
+    def wrap(cls, content, **kwargs) -> "Payload":
+        """Returns :param:`content` if it is already a Payload, otherwise wraps it in one."""
+        if isinstance(content, cls):
+            return content
+        return cls(content, **kwargs)
+
+    @property
+    def in_memory(self) -> bool:
+        """Whether the body is held in memory, so it can be sent more than once at the same time."""
+        return self._file is None and not self._chunks
+
+    def _prepare_file(self):
+        self.body = self._file
+        try:
+            self._start = self._file.tell()
+            size = os.fstat(self._file.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            self.replayable = False
+        else:
+            self.size = size - self._start
+
+    def _rewind(self):
+        if self._sent:
+            if not self.replayable:
+                raise ValueError("This payload is a one-shot stream, and it has already been sent.")
+            if self._file is not None:
+                self._file.seek(self._start)
+        self._sent = True
+
+    def _encoded(self, chunks):
+        for chunk in chunks:
+            yield chunk.encode(self.encoding) if isinstance(chunk, str) else chunk
+
+    async def _encoded_async(self, chunks):
+        if hasattr(chunks, "__aiter__"):
+            async for chunk in chunks:
+                yield chunk.encode(self.encoding) if isinstance(chunk, str) else chunk
+        else:
+            for chunk in self._encoded(chunks):
+                yield chunk
+
+    def for_requests(self):
+        """Returns a body that requests can stream. A one-shot stream can only be requested once."""
+        self._rewind()
+        if self._chunks and hasattr(self.body, "__aiter__"):
+            raise TypeError("Async iterators can only be posted with the async functions.")
+        if self._chunks:
+            return self._encoded(self.body)
+        return self.body
+
+    def for_aiohttp(self):
+        """Returns a body that aiohttp can stream. A one-shot stream can only be requested once."""
+        self._rewind()
+        if self._chunks:
+            return self._encoded_async(self.body)
+        return self.body
+
+    def chunks(self, chunk_size: int = 2 ** 16):
+        """
+        Yields the whole body, a chunk at a time, without marking it as sent.
+
+        :raise ValueError: the body is a one-shot stream, which can only be read by sending it.
+        """
+        if not self.replayable:
+            raise ValueError("This payload is a one-shot stream, so it can't be read without sending it.")
+        if self._file is None:
+            yield self.body
+            return
+        self._file.seek(self._start)
+        try:
+            for chunk in iter(lambda: self._file.read(chunk_size), b""):
+                yield chunk
+        finally:
+            self._file.seek(self._start)
+
+    def preview(self, limit: int = 64) -> str:
+        """
+        Describes the body for error messages and logs, without copying (or reading) more than :param:`limit` bytes.
+
+        :return: the repr of the body's first characters if it is in memory, otherwise the file's name or "<stream>".
+        """
+        if self._chunks:
+            return "<stream>"
+        if self._file is not None:
+            return "<file %s>" % getattr(self._file, "name", "?")
+        head = bytes(memoryview(self.body).cast("B")[:limit]).decode(self.encoding, "replace")
+        return repr(head) + ("..." if self.size > limit else "")
+
+    def update_hash(self, hasher) -> bool:
+        """
+        Feeds the whole body to a hashlib object, a chunk at a time.
+
+        :return: False (without reading anything) if the body is a one-shot stream that can't be read twice.
+        """
+        if not self.replayable:
+            return False
+        for chunk in self.chunks():
+            hasher.update(chunk)
+        return True
+
+    def close(self):
+        """Closes the file this payload opened, if any."""
+        if self._owns_file and self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
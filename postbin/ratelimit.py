@@ -0,0 +1,153 @@
+"""
+A per-host rate limit scheduler, shared by every AsyncHaste in the process.
+
+Each host gets a token bucket, which starts out unlimited. When a host answers 429 the bucket learns a rate
+from the response (``Retry-After``, ``X-RateLimit-*``), every request to that host waits for the host's
+cooldown, and requests are let through in the order they arrived instead of all retrying at once.
+"""
+import asyncio
+import threading
+import time
+from urllib.parse import urlsplit
+
+__all__ = ("HostLimiter", "RateLimitScheduler", "scheduler")
+
+
+def _host(url: str) -> str:
+    parts = urlsplit(url)
+    return (parts.scheme + "://" + parts.netloc).lower()
+
+
+def _header(headers, *names):
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                continue
+    return None
+
+
+class HostLimiter:
+    """
+    A token bucket for one host, implemented as a virtual schedule (GCRA).
+
+    Instead of waking queued requests one at a time, each request reserves the next free slot when it arrives,
+    then sleeps until that slot. This keeps requests first-come-first-served, and works from any event loop
+    (or several).
+
+    Attributes:
+        rate - Optional[float]: requests per second allowed, or None while no limit has been seen.
+        burst - int: how many requests may be sent back-to-back before the rate applies.
+        waiting - int: how many requests are currently queued for this host.
+    """
+    def __init__(self, *, burst: int = 5, min_rate: float = 0.2, increase: float = 0.05, default_backoff: float = 1.0):
+        self.rate = None
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase = increase
+        self.default_backoff = default_backoff
+        self.waiting = 0
+        self.limited = 0
+        self._tat = 0.0  # the "theoretical arrival time" of the next request.
+        self._blocked_until = 0.0
+        self._recent = []
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._recent = [started for started in self._recent if now - started < 1] + [now]
+            start = max(now, self._blocked_until)
+            if self.rate is None:
+                return start - now
+            interval = 1 / self.rate
+            tat = max(self._tat, start)
+            allowed_at = max(start, tat - (self.burst - 1) * interval)
+            self._tat = tat + interval
+            return allowed_at - now
+
+    async def acquire(self):
+        """Waits until this host may be sent another request."""
+        while True:
+            delay = self._reserve()
+            if delay <= 0:
+                return
+            with self._lock:
+                self.waiting += 1
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if time.monotonic() >= self._blocked_until:
+                return
+            # the host answered 429 while we slept, so queue up again behind its new cooldown.
+
+    def record_limited(self, headers) -> float:
+        """
+        Learns from a 429 response, slowing down every request to this host.
+
+        :return: how long (in seconds) the host asked us to wait.
+        """
+        retry_after = _header(headers, "Retry-After", "retry_after", "x-retry-after", "X-RateLimit-Reset-After")
+        with self._lock:
+            self.limited += 1
+            wait = retry_after if retry_after is not None else self.default_backoff
+            self._blocked_until = max(self._blocked_until, time.monotonic() + wait)
+            if not self._learn(headers):
+                # no explicit limit: halve whatever rate we were sending at when we got limited.
+                current = self.rate if self.rate is not None else len(self._recent)
+                self.rate = max(self.min_rate, current / 2)
+        return wait
+
+    def record_success(self, headers):
+        """Learns from a successful response, slowly raising the rate back up."""
+        with self._lock:
+            if not self._learn(headers) and self.rate is not None:
+                self.rate += self.increase
+
+    def _learn(self, headers) -> bool:
+        limit = _header(headers, "X-RateLimit-Limit")
+        window = _header(headers, "X-RateLimit-Reset-After", "X-RateLimit-Reset")
+        if not limit or not window or window > 3600:  # a large "reset" is a timestamp, not a duration.
+            return False
+        self.rate = max(self.min_rate, limit / window)
+        return True
+
+
+class RateLimitScheduler:
+    """Hands out a :class:`HostLimiter` per host (scheme and netloc), creating them on first use."""
+    def __init__(self, **limiter_options):
+        self.limiter_options = limiter_options
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, url: str) -> HostLimiter:
+        """Returns the limiter of the host :param:`url` is on."""
+        host = _host(url)
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = self._limiters[host] = HostLimiter(**self.limiter_options)
+            return limiter
+
+    async def acquire(self, url: str):
+        """Waits until the host :param:`url` is on may be sent another request."""
+        await self.limiter(url).acquire()
+
+    def queue_depth(self, url: str = None) -> int:
+        """How many requests are queued for one host, or for every host if no URL is given."""
+        if url is not None:
+            return self.limiter(url).waiting
+        with self._lock:
+            return sum(limiter.waiting for limiter in self._limiters.values())
+
+    def reset(self):
+        """Forgets every learned limit."""
+        with self._lock:
+            self._limiters.clear()
+
+
+scheduler = RateLimitScheduler()
@@ -0,0 +1,172 @@
+"""
+Retrying with exponential backoff, under one deadline.
+
+A :class:`RetryPolicy` says how hard a call may try. Each call starts a :class:`RetryState` from it, which counts
+the attempts made (in total, and per host) and holds the call's deadline, so finding a fallback, posting and
+retrying all spend the same time budget, instead of each getting a fresh timeout.
+"""
+import random
+import time
+
+from postbin.lazy import LazyModule
+
+__all__ = ("RetryPolicy", "RetryState", "start")
+
+asyncio = LazyModule("asyncio")  # only needed by wait_async.
+
+
+class RetryPolicy:
+    """
+    How many times, and for how long, a call may be retried.
+
+    Retrying the same host waits between attempts, doubling each time (with "full" jitter: a random delay between
+    zero and the doubled value, so clients that failed together don't retry together). Moving on to another host
+    does not wait.
+    """
+    def __init__(self, max_attempts: int = 6, *, max_attempts_per_host: int = 3, deadline: float = None,
+                 backoff: float = 0.1, max_backoff: float = 5.0, multiplier: float = 2.0, jitter: bool = True):
+        """
+        :param max_attempts: the most requests a call may make, over every host. Probes are not counted.
+        :param max_attempts_per_host: the most requests a call may make to a single host.
+        :param deadline: how long (in seconds) a call may take in total. Defaults to no limit.
+        :param backoff: the longest wait before the first retry of a host.
+        :param max_backoff: the longest wait between two attempts.
+        :param multiplier: how much the wait grows with each retry of a host.
+        :param jitter: whether to randomise waits. Without it, every wait is the longest allowed.
+        """
+        if max_attempts < 1 or max_attempts_per_host < 1:
+            raise ValueError("A call needs to be allowed at least one attempt.")
+        self.max_attempts = max_attempts
+        self.max_attempts_per_host = max_attempts_per_host
+        self.deadline = deadline
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def replace(self, **changes) -> "RetryPolicy":
+        """Returns a copy of this policy, with some options changed."""
+        options = {**vars(self), **changes}
+        return RetryPolicy(options.pop("max_attempts"), **options)
+
+    def delay(self, retry: int) -> float:
+        """How long to wait before the :param:`retry` th retry (starting at 1) of a host."""
+        if retry < 1:
+            return 0.0
+        longest = min(self.max_backoff, self.backoff * self.multiplier ** (retry - 1))
+        return random.uniform(0, longest) if self.jitter else longest
+
+    def start(self) -> "RetryState":
+        """Starts the clock on a new call."""
+        return RetryState(self)
+
+    def __repr__(self):
+        return "<RetryPolicy max_attempts=%d max_attempts_per_host=%d deadline=%r>" % (
+            self.max_attempts, self.max_attempts_per_host, self.deadline
+        )
+
+
+class RetryState:
+    """
+    The attempts made, and time spent, by one call.
+
+    Pass one (from :meth:`RetryPolicy.start`) as a call's ``retry_policy`` to see what the call used afterwards.
+
+    Attributes:
+        attempts - int: how many requests the call has made.
+        hosts - dict: how many requests the call has made to each host.
+    """
+    def __init__(self, policy: RetryPolicy):
+        self.policy = policy
+        self.attempts = 0
+        self.hosts = {}
+        self.started = time.monotonic()
+        self.ends = None if policy.deadline is None else self.started + policy.deadline
+
+    @property
+    def elapsed(self) -> float:
+        """How long (in seconds) the call has taken so far."""
+        return time.monotonic() - self.started
+
+    @property
+    def spent(self):
+        """The fraction of the time budget used so far, or None if there is no deadline."""
+        if not self.policy.deadline:
+            return None
+        return min(1.0, self.elapsed / self.policy.deadline)
+
+    def remaining(self, timeout: float = None):
+        """
+        How long (in seconds) is left until the deadline, or None if there is no deadline.
+
+        :param timeout: a shorter limit to apply, if it comes first (e.g. the timeout of a single request).
+        """
+        if self.ends is None:
+            return timeout
+        left = max(0.0, self.ends - time.monotonic())
+        return left if timeout is None else min(left, timeout)
+
+    @property
+    def expired(self) -> bool:
+        return self.ends is not None and time.monotonic() >= self.ends
+
+    def allows(self, url: str = None) -> bool:
+        """Whether another attempt may be made (to :param:`url`, if given)."""
+        if self.expired or self.attempts >= self.policy.max_attempts:
+            return False
+        return url is None or self.hosts.get(url, 0) < self.policy.max_attempts_per_host
+
+    def retries(self, url: str) -> int:
+        """How many attempts to :param:`url` were retries (every attempt to it after the first)."""
+        return max(0, self.hosts.get(url, 0) - 1)
+
+    @property
+    def hops(self) -> int:
+        """How many times the call moved on to another host."""
+        return max(0, len(self.hosts) - 1)
+
+    def exhausted(self) -> list:
+        """The hosts this call may not make any more attempts to."""
+        return [url for url, attempts in self.hosts.items() if attempts >= self.policy.max_attempts_per_host]
+
+    def give_up(self, url: str):
+        """Stops this call from making any more attempts to :param:`url`."""
+        self.hosts[url] = max(self.hosts.get(url, 0), self.policy.max_attempts_per_host)
+
+    def record(self, url: str = None):
+        """Counts an attempt (to :param:`url`, if given)."""
+        self.attempts += 1
+        if url is not None:
+            self.hosts[url] = self.hosts.get(url, 0) + 1
+
+    def delay(self, url: str = None) -> float:
+        """How long to wait before the next attempt to :param:`url`. Never longer than the time left."""
+        retry = self.hosts.get(url, 0) if url is not None else self.attempts
+        return self.remaining(self.policy.delay(retry))
+
+    def wait(self, url: str = None):
+        """Sleeps for :meth:`delay`."""
+        delay = self.delay(url)
+        if delay:
+            time.sleep(delay)
+
+    async def wait_async(self, url: str = None):
+        """The same as :meth:`wait`, but async."""
+        delay = self.delay(url)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def __repr__(self):
+        return "<RetryState attempts=%d elapsed=%.3fs spent=%r>" % (self.attempts, self.elapsed, self.spent)
+
+
+def start(retry_policy=None, **defaults) -> RetryState:
+    """
+    Starts the retry state of a call.
+
+    :param retry_policy: a RetryPolicy to start from, or a RetryState that was already started (which is used
+        as-is, so the caller can read it afterwards). If None, ``RetryPolicy(**defaults)`` is used.
+    """
+    if isinstance(retry_policy, RetryState):
+        return retry_policy
+    return (retry_policy or RetryPolicy(**defaults)).start()
@@ -0,0 +1,101 @@
+"""
+How ``url="auto"`` chooses between hosts.
+
+The health registry keeps an exponentially weighted moving average (EWMA) of each host's latency and error
+rate, taken from real requests and probes. A strategy uses those numbers to put the hosts a call may use in
+order, and the first one is tried first. Set one with ``postbin.health.registry.strategy = BestOfTwo()``.
+"""
+import itertools
+import random
+
+__all__ = ("Strategy", "Ordered", "RoundRobin", "BestOfTwo", "WeightedRandom", "score")
+
+
+def score(host, *, default_latency: float = 1.0, error_penalty: float = 10.0) -> float:
+    """
+    How bad a host is (lower is better): its average latency, inflated by its error rate.
+
+    :param host: the host's :class:`postbin.health.HostHealth`.
+    :param default_latency: the latency assumed for a host that has never been timed.
+    :param error_penalty: how much a 100% error rate multiplies the latency by (plus one).
+    """
+    latency = host.latency if host.latency is not None else default_latency
+    return latency * (1 + error_penalty * host.error_rate)
+
+
+class Strategy:
+    """The base class of host selection strategies. Subclasses override :meth:`order`."""
+    def order(self, urls: list, registry) -> list:
+        """
+        Returns :param:`urls` in the order they should be tried.
+
+        :param urls: the hosts a call may use, in the order of the fallback list.
+        :param registry: the :class:`postbin.health.HealthRegistry` to read the hosts' statistics from.
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "<%s>" % type(self).__name__
+
+
+class Ordered(Strategy):
+    """Always tries hosts in the order of the fallback list. This is the default."""
+    def order(self, urls: list, registry) -> list:
+        return list(urls)
+
+
+class RoundRobin(Strategy):
+    """
+    Starts each call one host further along the fallback list than the last, so many posts (e.g. from
+    :meth:`postbin.v2.AsyncHaste.post_iter`) are spread evenly across the hosts. The others follow in order, so a
+    call still falls back to every host.
+    """
+    def __init__(self):
+        self._calls = itertools.count()
+
+    def order(self, urls: list, registry) -> list:
+        urls = list(urls)
+        if not urls:
+            return urls
+        first = next(self._calls) % len(urls)
+        return urls[first:] + urls[:first]
+
+
+class BestOfTwo(Strategy):
+    """
+    Picks two hosts at random and tries the better scoring one first ("the power of two choices").
+
+    This sends most traffic to fast hosts without sending all of it to the fastest one. The other hosts follow
+    in the order of the fallback list.
+    """
+    def __init__(self, **score_options):
+        """:param score_options: passed to :func:`score`."""
+        self.score_options = score_options
+
+    def order(self, urls: list, registry) -> list:
+        urls = list(urls)
+        if len(urls) < 2:
+            return urls
+        first, second = random.sample(range(len(urls)), 2)
+        if score(registry.get(urls[second]), **self.score_options) < score(registry.get(urls[first]),
+                                                                             **self.score_options):
+            first = second
+        return [urls[first]] + urls[:first] + urls[first + 1:]
+
+
+class WeightedRandom(Strategy):
+    """
+    Shuffles hosts at random, weighting each by the inverse of its score, so a host twice as fast is twice as
+    likely to be tried first.
+    """
+    def __init__(self, **score_options):
+        """:param score_options: passed to :func:`score`."""
+        self.score_options = score_options
+
+    def order(self, urls: list, registry) -> list:
+        # a weighted shuffle: sorting by u ** (1 / weight) picks each host first with probability weight / total.
+        keys = {
+            url: random.random() ** score(registry.get(url), **self.score_options)
+            for url in urls
+        }
+        return sorted(urls, key=keys.__getitem__, reverse=True)
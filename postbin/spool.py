@@ -0,0 +1,452 @@
+"""
+A durable on-disk spool, for posts made while every host is unavailable.
+
+A client given a :class:`Spool` doesn't lose a post when no host can take it: the payload is appended to the
+spool's journal, and the caller gets a :class:`Ticket` instead of a URL. A :class:`Drainer` replays the journal
+(at a limited rate, and only once a host passes a health check) and records each ticket's final URL, which
+:meth:`Spool.lookup` returns.
+
+The journal is a directory of append-only segment files. Each record is a line of JSON, followed (for a spooled
+payload) by the payload's bytes. A record that was only partly written when the process died is discarded when
+the spool is next opened.
+"""
+import json
+import mmap
+import os
+import threading
+import time
+import uuid
+
+from postbin import health
+from postbin.payload import Payload
+from postbin.retry import RetryPolicy
+
+__all__ = ("Spool", "Ticket", "Drainer")
+
+_SUFFIX = ".journal"
+_FSYNC_POLICIES = ("always", "interval", "never")
+
+
+class Ticket:
+    """
+    A post that was spooled, instead of being posted.
+
+    Attributes:
+        id - str: identifies the post, for :meth:`Spool.lookup`.
+        host - str: the URL it is to be posted to, or "auto" for whichever host works.
+        size - int: the size of the payload, in bytes.
+        created - float: when it was spooled (a UNIX timestamp).
+        url - Optional[str]: the URL of the haste, once it was posted.
+    """
+    __slots__ = ("id", "host", "size", "created", "url", "_segment", "_offset")
+
+    def __init__(self, id: str, host: str, size: int, created: float, url: str = None):
+        self.id = id
+        self.host = host
+        self.size = size
+        self.created = created
+        self.url = url
+        self._segment = None
+        self._offset = None
+
+    @property
+    def posted(self) -> bool:
+        return self.url is not None
+
+    def __repr__(self):
+        return "<Ticket id=%r host=%r %s>" % (self.id, self.host, self.url or "pending")
+
+
+class Spool:
+    """
+    An append-only journal of posts waiting to be made.
+
+    It is safe to share one spool between threads, but not between processes.
+    """
+    def __init__(self, directory, *, segment_size: int = 64 * 2 ** 20, fsync: str = "always",
+                 fsync_interval: float = 1.0):
+        """
+        :param directory: where to keep the journal. It is created if it doesn't exist, and replayed if it does.
+        :param segment_size: start a new segment file once the current one is this large (in bytes).
+        :param fsync: when to force writes to disk. "always" (after every record), "interval" (at most once every
+            :param:`fsync_interval` seconds, so a crash may lose the last records written) or "never" (leave it
+            to the OS).
+        :param fsync_interval: how often (in seconds) to sync with ``fsync="interval"``.
+        """
+        if fsync not in _FSYNC_POLICIES:
+            raise ValueError("fsync must be one of: " + ", ".join(_FSYNC_POLICIES))
+        self.directory = os.fspath(directory)
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.tickets = {}
+        self._file = None
+        self._synced = time.monotonic()
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+
+    def _segments(self) -> list:
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(_SUFFIX))
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        segments = self._segments()
+        for name in segments:
+            end = self._replay(name)
+            if os.path.getsize(self._path(name)) > end:
+                # the tail was torn by a crash. Only whole records are kept, so appends start cleanly.
+                with open(self._path(name), "r+b") as file:
+                    file.truncate(end)
+        self._open(segments[-1] if segments else self._next_segment())
+
+    def _replay(self, name: str) -> int:
+        """Reads one segment into :attr:`tickets`, returning the offset after its last whole record."""
+        end = 0
+        with open(self._path(name), "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            while True:
+                line = file.readline()
+                if not line.endswith(b"\n"):
+                    return end
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    return end
+                if record["op"] == "put":
+                    offset = file.tell()
+                    if offset + record["size"] + 1 > size:
+                        return end
+                    file.seek(record["size"], os.SEEK_CUR)
+                    if file.read(1) != b"\n":
+                        return end
+                    ticket = self.tickets.get(record["ticket"])
+                    if ticket is None:
+                        ticket = self.tickets[record["ticket"]] = Ticket(record["ticket"], record["host"],
+                                                                         record["size"], record["created"])
+                    ticket._segment, ticket._offset = name, offset
+                elif record["op"] == "done":
+                    ticket = self.tickets.get(record["ticket"])
+                    if ticket is None:  # compaction keeps only the outcome of posted tickets.
+                        ticket = self.tickets[record["ticket"]] = Ticket(record["ticket"], record["host"],
+                                                                         record["size"], record["created"])
+                    ticket.url = record["url"]
+                end = file.tell()
+
+    def _next_segment(self) -> str:
+        segments = self._segments()
+        number = int(segments[-1][:-len(_SUFFIX)]) + 1 if segments else 1
+        return "%08d%s" % (number, _SUFFIX)
+
+    def _open(self, name: str):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self._path(name), "ab")
+        self._segment = name
+
+    def _sync(self, force: bool = False):
+        self._file.flush()
+        now = time.monotonic()
+        due = self.fsync == "interval" and now - self._synced >= self.fsync_interval
+        if force or self.fsync == "always" or due:
+            os.fsync(self._file.fileno())
+            self._synced = now
+
+    def _write_record(self, record: dict, chunks=()):
+        self._file.write(json.dumps(record).encode() + b"\n")
+        offset = self._file.tell()
+        if record["op"] == "put":
+            for chunk in chunks:
+                self._file.write(chunk)
+            self._file.write(b"\n")
+        return offset
+
+    def put(self, content, host: str = "auto") -> Ticket:
+        """
+        Spools a post, returning its ticket.
+
+        :param content: what to post. Anything :class:`postbin.payload.Payload` accepts, except one-shot streams.
+        :param host: the URL to post it to, or "auto" for whichever host works.
+        :raise ValueError: the content is a one-shot stream (which can't be read again once it was sent).
+        """
+        if not isinstance(content, Payload):
+            with Payload(content) as payload:  # closes the file, if the payload had to open one.
+                return self.put(payload, host)
+        payload = content
+        if not payload.replayable:
+            raise ValueError("One-shot streams can't be spooled, as they can't be read again.")
+        ticket = Ticket(uuid.uuid4().hex, host, payload.size, time.time())
+        with self._lock:
+            if self._file.tell() >= self.segment_size:
+                self._open(self._next_segment())
+            record = {"op": "put", "ticket": ticket.id, "host": host, "size": ticket.size, "created": ticket.created}
+            start = self._file.tell()
+            try:
+                ticket._offset = self._write_record(record, payload.chunks())
+                self._sync()
+            except BaseException:
+                self._file.truncate(start)  # never leave half a record for the next one to follow.
+                raise
+            ticket._segment = self._segment
+            self.tickets[ticket.id] = ticket
+        return ticket
+
+    def complete(self, ticket: Ticket, url: str):
+        """Records that a ticket was posted, as :param:`url`."""
+        with self._lock:
+            self._write_record({"op": "done", "ticket": ticket.id, "host": ticket.host, "size": ticket.size,
+                                "created": ticket.created, "url": url})
+            self._sync()
+            ticket.url = url
+            self._changed.notify_all()
+
+    def lookup(self, ticket_id: str):
+        """
+        Finds a ticket by its ID.
+
+        :return: the :class:`Ticket` (whose ``url`` is set once it was posted), or None if it isn't in the spool.
+        """
+        return self.tickets.get(getattr(ticket_id, "id", ticket_id))
+
+    def wait(self, ticket_id: str, timeout: float = None):
+        """
+        Waits for a ticket to be posted.
+
+        :return: the URL of the haste, or None if the timeout passed first.
+        """
+        ends = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while True:
+                ticket = self.lookup(ticket_id)
+                if ticket is not None and ticket.posted:
+                    return ticket.url
+                left = None if ends is None else ends - time.monotonic()
+                if left is not None and left <= 0:
+                    return None
+                self._changed.wait(left)
+
+    def pending(self) -> list:
+        """The tickets still waiting to be posted, oldest first."""
+        with self._lock:
+            return sorted((ticket for ticket in self.tickets.values() if not ticket.posted),
+                          key=lambda ticket: ticket.created)
+
+    def read(self, ticket: Ticket) -> Payload:
+        """
+        Returns the payload of a pending ticket, mapped from its segment rather than read into memory.
+
+        Close the payload (or use it as a context manager) when done with it.
+        """
+        with self._lock:
+            self._file.flush()
+            with open(self._path(ticket._segment), "rb") as file:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if ticket.size else None
+        if mapped is None:
+            return Payload(b"")
+        return _MappedPayload(mapped, ticket._offset, ticket.size)
+
+    def compact(self, forget_posted: bool = False):
+        """
+        Rewrites the journal without the payloads of posted tickets, and deletes the old segments.
+
+        :param forget_posted: also forget posted tickets, so they can no longer be looked up.
+        """
+        with self._lock:
+            old = self._segments()
+            name = self._next_segment()
+            temp = self._path(name + ".tmp")
+            self._file.flush()
+            kept = {}
+            with open(temp, "wb") as file:
+                for ticket in sorted(self.tickets.values(), key=lambda ticket: ticket.created):
+                    if ticket.posted and forget_posted:
+                        continue
+                    record = {"ticket": ticket.id, "host": ticket.host, "size": ticket.size,
+                              "created": ticket.created}
+                    if ticket.posted:
+                        record.update(op="done", url=ticket.url)
+                        file.write(json.dumps(record).encode() + b"\n")
+                        kept[ticket.id] = (ticket, None)
+                        continue
+                    record["op"] = "put"
+                    file.write(json.dumps(record).encode() + b"\n")
+                    kept[ticket.id] = (ticket, file.tell())
+                    with self.read(ticket) as payload:
+                        for chunk in payload.chunks():
+                            file.write(chunk)
+                    file.write(b"\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp, self._path(name))
+            _sync_directory(self.directory)
+            self._file.close()
+            self._file = None
+            for segment in old:
+                os.remove(self._path(segment))
+            self.tickets = {}
+            for ticket_id, (ticket, offset) in kept.items():
+                ticket._segment, ticket._offset = (name, offset) if offset is not None else (None, None)
+                self.tickets[ticket_id] = ticket
+            self._open(name)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync(force=self.fsync != "never")
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.pending())
+
+    def __repr__(self):
+        return "<Spool directory=%r pending=%d>" % (self.directory, len(self))
+
+
+class _MappedPayload(Payload):
+    """A payload that is a slice of a memory-mapped segment. Closing it unmaps the segment."""
+    def __init__(self, mapped: mmap.mmap, offset: int, size: int):
+        self._mapped = mapped
+        self._view = memoryview(mapped)
+        super().__init__(self._view[offset:offset + size])
+
+    def close(self):
+        if self._mapped is not None:
+            # every view has to be released before the map can be closed.
+            self.body.release()
+            self._view.release()
+            self._mapped.close()
+            self._mapped = None
+
+
+def _sync_directory(directory: str):
+    # makes the rename itself durable. Not every platform can open a directory.
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Drainer:
+    """
+    Replays a spool's pending posts in the background, once hosts are healthy again.
+
+    Posts are made at most :param:`rate` times a second. Before posting, the ticket's host has to pass a health
+    check (for "auto", a working fallback has to be found), and every failure doubles the wait before the next
+    try, so an outage isn't hammered with retries.
+
+    Attributes:
+        posted - int: how many tickets were posted.
+        failures - int: how many health checks or posts failed.
+    """
+    def __init__(self, spool: Spool, *, rate: float = 1.0, backoff: float = 1.0, max_backoff: float = 60.0,
+                 idle_interval: float = 5.0, compact: bool = True, haste=None):
+        """
+        :param spool: the spool to drain.
+        :param rate: the most posts to make a second.
+        :param backoff: how long (in seconds) to wait after the first failure.
+        :param max_backoff: the longest wait between failures.
+        :param idle_interval: how often (in seconds) to check for new tickets when the spool is empty.
+        :param compact: whether to compact the journal whenever it has been drained.
+        :param haste: the :class:`postbin.SyncHaste` to post (and check health) with. Defaults to a new one.
+        """
+        if haste is None:
+            from postbin.sync import SyncHaste
+            haste = SyncHaste()
+        self.spool = spool
+        self.rate = rate
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle_interval = idle_interval
+        self.compact = compact
+        self.haste = haste
+        self.posted = 0
+        self.failures = 0
+        self._delay = 0.0
+        self._next = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _target(self, ticket: Ticket):
+        if ticket.host == "auto":
+            return self.haste.find_working_fallback(1)  # raises NoFallbacks while every host is down.
+        if not health.registry.allow(ticket.host):
+            raise ConnectionError(ticket.host + " is cooling off after failing.")
+        return ticket.host
+
+    def drain_once(self) -> int:
+        """
+        Tries to post every pending ticket (at the configured rate), stopping at the first failure.
+
+        :return: how many tickets were posted.
+        """
+        posted = 0
+        for ticket in self.spool.pending():
+            if self._stop.is_set():
+                break
+            wait = self._next - time.monotonic()
+            if wait > 0 and self._stop.wait(wait):
+                break
+            self._next = time.monotonic() + 1 / self.rate
+            try:
+                target = self._target(ticket)
+                with self.spool.read(ticket) as payload:
+                    url = self.haste.post(payload, url=target, retry_policy=RetryPolicy(1))
+            except Exception:
+                self.failures += 1
+                self._delay = min(self.max_backoff, self._delay * 2 or self.backoff)
+                break
+            self._delay = 0.0
+            self.spool.complete(ticket, url)
+            self.posted += 1
+            posted += 1
+        if posted and self.compact and not self.spool.pending():
+            self.spool.compact()
+        return posted
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self.spool.pending():
+                self._stop.wait(self.idle_interval)
+                continue
+            self.drain_once()
+            if self._delay:
+                self._stop.wait(self._delay)
+
+    def start(self) -> "Drainer":
+        """Starts draining on a daemon thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="PostBin-Drainer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: float = None):
+        """Stops draining, waiting for the post in progress (if any) to finish."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def __repr__(self):
+        return "<Drainer spool=%r posted=%d failures=%d>" % (self.spool, self.posted, self.failures)
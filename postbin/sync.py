@@ -0,0 +1,323 @@
+"""
+A pooled, thread-safe synchronous haste client.
+
+Unlike :func:`postbin.postSync`, which opens a new session (and connection) for every call, a single
+:class:`SyncHaste` can be shared between any number of threads, which all post through one bounded pool of
+kept-alive connections.
+"""
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
+
+from postbin import (capabilities, health, tracing, requests, _FALLBACKS, _is_too_large, _split_key, NoFallbacks,
+                     NoMoreRetries, PayloadTooLarge, RateLimitedError, ResponseError)
+from postbin.compression import ACCEPT_ENCODING
+from postbin.dedupe import DedupeCache
+from postbin.payload import Payload
+from postbin.retry import RetryPolicy, RetryState, start as retry_start
+from postbin.spool import Spool
+
+__all__ = ("SyncHaste",)
+
+_RAW_HEADERS = {"Accept-Encoding": ACCEPT_ENCODING}
+
+
+def _retry_after(headers, default: float = 1.0) -> float:
+    # postbin.ratelimit reads the same headers, but importing it would import asyncio.
+    for name in ("Retry-After", "retry_after", "x-retry-after"):
+        try:
+            return float(headers[name])
+        except (KeyError, ValueError):
+            continue
+    return default
+
+
+class SyncHaste:
+    """
+    Haste operations, centralised, for synchronous (and threaded) programs.
+
+    This mirrors :class:`postbin.v2.AsyncHaste`: use it as a context manager (``with SyncHaste() as paster:``)
+    or call :meth:`close` when done.
+    """
+    def __init__(self, t: str = None, session: "requests.Session" = None, *, pool_connections: int = 10,
+                 pool_maxsize: int = 10, pool_block: bool = True, dedupe: DedupeCache = None,
+                 retry_policy: RetryPolicy = None, spool: Spool = None):
+        """
+        Creates the class.
+
+        :param t: The text to post by default.
+        :param session: A session to use instead of the one the class would create. It will not be closed by us.
+        :param pool_connections: How many hosts to keep connection pools for.
+        :param pool_maxsize: The maximum number of connections kept open to a single host.
+        :param pool_block: If True, threads wait for a free connection instead of opening one beyond pool_maxsize.
+        :param dedupe: A cache of content already posted. If given, posting the same content twice returns the
+            first URL (without any network I/O), and concurrent posts of the same content are only uploaded once.
+        :param retry_policy: How many attempts (in total and per host) a post may make, and how long it may take.
+            Defaults to one attempt per fallback, with no overall deadline.
+        :param spool: A :class:`postbin.spool.Spool` to write posts to when no host can take them. :meth:`post`
+            then returns a :class:`postbin.spool.Ticket` instead of raising.
+        :raise RuntimeError: requests is not installed.
+        """
+        if not requests:
+            raise RuntimeError("requests must be installed if you want to be able to use SyncHaste.")
+        self.text = t
+        self.session = session
+        self._owns_session = session is None
+        self.pool_options = {"pool_connections": pool_connections, "pool_maxsize": pool_maxsize,
+                             "pool_block": pool_block}
+        self.dedupe = dedupe
+        self.retry_policy = retry_policy
+        self.spool = spool
+        self.max_rate_limited_retries = 5
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._get_session()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Closes the session (and with it, every pooled connection) if this class created it."""
+        with self._lock:
+            if self._owns_session and self.session is not None:
+                self.session.close()
+                self.session = None
+
+    def _get_session(self) -> "requests.Session":
+        with self._lock:
+            if self.session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(**self.pool_options)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.session = session
+            return self.session
+
+    def _head(self, url: str, retries: int = 3, timeout: float = None):
+        session = self._get_session()
+        last_response = None
+        for _ in range(retries+1):
+            try:
+                response = None
+                if capabilities.registry.get(url).head:
+                    with tracing.trace("HEAD", url) as trace:
+                        response = session.head(url, timeout=timeout, hooks={"response": trace.requests_hook})
+                    if response.status_code == 405:
+                        capabilities.registry.record_no_head(url)
+                if response is None or response.status_code == 405:
+                    # some services may not support HEAD requests, so we can just GET if not.
+                    with tracing.trace("GET", url) as trace:
+                        response = session.get(url, timeout=timeout, stream=True,
+                                               hooks={"response": trace.requests_hook})
+                    response.close()
+                last_response = response
+                response.raise_for_status()
+            except requests.RequestException:
+                continue
+            health.registry.record_success(url, latency=response.elapsed.total_seconds())
+            return True
+        health.registry.record_failure(url, offline=last_response is None)
+        return last_response
+
+    def find_working_fallback(self, retries_per_url: int = 3, *, concurrent: bool = False,
+                              max_concurrency: int = None, deadline: float = None, exclude: list = ()) -> str:
+        """
+        Finds the first fallback URL that responds to a HEAD (or GET) request.
+
+        :param retries_per_url: How many times to retry each URL before moving on.
+        :param concurrent: If True, probe every fallback at once and return the first one to answer.
+        :param max_concurrency: The maximum number of probes in flight at once. Defaults to all of them.
+        :param deadline: How long (in seconds) to look for a working URL before giving up. Defaults to no limit.
+        :param exclude: URLs not to return, even if they work.
+        :return: the working URL.
+        :raise NoFallbacks: no URL could be contacted (or the deadline was hit).
+        """
+        urls = [url for url in _FALLBACKS if url not in exclude]
+        healthy = health.registry.healthy(urls)
+        if healthy:
+            return healthy[0]
+        candidates = health.registry.candidates(urls)
+        if not candidates:
+            raise NoFallbacks()
+        if not concurrent:
+            started = time.monotonic()
+            for url in candidates:
+                remaining = None if deadline is None else deadline - (time.monotonic() - started)
+                if remaining is not None and remaining <= 0:
+                    break
+                if health.registry.allow(url) and self._head(url, retries_per_url, remaining) is True:
+                    return url
+            raise NoFallbacks()
+        executor = ThreadPoolExecutor(max_workers=max_concurrency or len(candidates))
+        def probe(url):
+            return health.registry.allow(url) and self._head(url, retries_per_url, deadline)
+
+        futures = {executor.submit(probe, url): url for url in candidates}
+        try:
+            for future in as_completed(futures, timeout=deadline):
+                if future.result() is True:
+                    return futures[future]
+        except FutureTimeout:
+            pass
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+        raise NoFallbacks()
+
+    def _post(self, url: str, text, timeout: float = None) -> str:
+        session = self._get_session()
+        payload = Payload.wrap(text)
+        for _ in range(self.max_rate_limited_retries + 1):
+            with tracing.trace("POST", url) as trace:
+                response = session.post(url, data=payload.for_requests(), timeout=timeout,
+                                        hooks={"response": trace.requests_hook})
+            if response.status_code == 429:
+                if not payload.replayable:
+                    break  # a one-shot stream was used up by this attempt, so it can't be sent again.
+                retry_after = _retry_after(response.headers)
+                if timeout is not None and retry_after > timeout:
+                    break  # waiting would outlive the time we have left.
+                time.sleep(retry_after)
+                continue
+            if _is_too_large(response.status_code, response.content):
+                capabilities.registry.record_too_large(url[:-len("/documents")], payload.size)
+                raise PayloadTooLarge(response, size=payload.size, preview=payload.preview())
+            if response.status_code not in (200, 201):
+                raise ResponseError(response)
+            capabilities.registry.record_accepted(url[:-len("/documents")], payload.size)
+            return response.json()["key"]
+        raise RateLimitedError(response)
+
+    def post(self, text: str = None, *, timeout: float = 30.0, retries: int = 3, url: str = "auto",
+             return_full_url: bool = True, retry_policy: typing.Union[RetryPolicy, RetryState] = None) -> str:
+        """
+        Creates a haste, returning the URL of the new haste.
+
+        :param text: The text to post. Defaults to the text provided/set in self.__init__. Anything
+            :class:`postbin.payload.Payload` accepts (paths, files, iterators...) is streamed.
+        :param timeout: How long to wait on a single URL before giving up on it.
+        :param retries: How many times to attempt to contact each URL when looking for a fallback.
+        :param url: The BASE url to post to. If "auto" (default), this will try each url until it works.
+        :param return_full_url: Whether to return the full URL, or just the key.
+        :param retry_policy: How many attempts the post may make, in total and per host. Defaults to the class's.
+            Pass a started :class:`postbin.retry.RetryState` to read the attempts used and time spent afterwards.
+        :return: the completed URL or just the key. If the class has a spool and no host could take the post, the
+            :class:`postbin.spool.Ticket` it was spooled as.
+        :raise NoFallbacks: if url is "auto" and every fallback failed (or the attempts ran out).
+        :raise ResponseError: the server returned an error status.
+        :raise RateLimitedError: the host was still rate limiting us after ``max_rate_limited_retries`` retries.
+        :raise PayloadTooLarge: the text is larger than the host (or, for "auto", every fallback) accepts. If that
+            was already known (see :mod:`postbin.capabilities`), this is raised before anything is sent.
+        """
+        text = self.text if text is None else text
+        state = retry_start(retry_policy or self.retry_policy, max_attempts=len(_FALLBACKS), max_attempts_per_host=1)
+        if not isinstance(text, Payload):
+            # str is encoded as utf-8 here, as requests would otherwise encode it as latin-1.
+            with Payload(text) as payload:
+                return self.post(payload, timeout=timeout, retries=retries, url=url, return_full_url=return_full_url,
+                                 retry_policy=state)
+        key = DedupeCache.key(text, url) if self.dedupe is not None else None
+        try:
+            if key is not None:
+                full_url = self.dedupe.run(key, lambda: self._post_document(text, timeout, retries, url, state))
+            else:
+                full_url = self._post_document(text, timeout, retries, url, state)
+        except (NoFallbacks, requests.ConnectionError, requests.Timeout, ResponseError) as e:
+            if self.spool is None or not text.replayable or (isinstance(e, ResponseError) and e.status < 500):
+                raise
+            return self.spool.put(text, url)
+        return full_url if return_full_url else full_url.rsplit("/", 1)[1]
+
+    def _post_document(self, text: Payload, timeout: float, retries: int, url: str, state: RetryState) -> str:
+        hosts = _FALLBACKS if url == "auto" else [url]
+        refusing = capabilities.registry.refusing(hosts, text.size)
+        if len(refusing) == len(hosts):
+            limit = max(capabilities.registry.get(host).max_size for host in hosts)
+            raise PayloadTooLarge(size=text.size, limit=limit, preview=text.preview())
+        for host in refusing:
+            state.give_up(host)  # "auto" never picks a fallback that would refuse it.
+        while state.allows(None if url == "auto" else url):
+            target = url
+            if url == "auto":
+                target = self.find_working_fallback(retries, deadline=state.remaining(timeout),
+                                                    exclude=state.exhausted())
+            state.wait(target)
+            state.record(target)
+            try:
+                with tracing.attempt(state.retries(target), state.hops):
+                    key = self._post_to(target, text, state.remaining(timeout))
+            except (requests.ConnectionError, requests.Timeout):
+                if url != "auto" and not state.allows(url):
+                    raise
+                continue  # the failure was recorded, so the next search skips this host.
+            except ResponseError as e:
+                if e.status < 500 or (url != "auto" and not state.allows(url)):
+                    raise
+                continue
+            return target + "/" + key
+        raise NoMoreRetries("Gave up after %d attempts in %.2fs." % (state.attempts, state.elapsed), retry_state=state)
+
+    def _post_to(self, url: str, text, timeout: float = None) -> str:
+        sent = time.monotonic()
+        try:
+            key = self._post(url + "/documents", text, timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            health.registry.record_failure(url, offline=True)
+            raise
+        except ResponseError as e:
+            if e.status >= 500:
+                health.registry.record_failure(url, offline=e.status == 503)
+            raise
+        health.registry.record_success(url, latency=time.monotonic() - sent)
+        return key
+
+    def raw(self, key: str, *, url: str = "auto", timeout: float = 30.0, retries_per_url: int = 3,
+            encoding: str = "utf-8"):
+        """
+        Gets the raw text of a haste.
+
+        :param key: the key (after .tld/, e.g hastebin.com/{key}), or the haste's full URL.
+        :param url: the URL to find the haste from. if "auto" (default), will search all fallbacks for it.
+        :param timeout: The timeout to request a document from each server.
+        :param retries_per_url: how may times to retry a URL (unless it returned 404). set to 0 to disable.
+        :param encoding: The encoding to decode the text with.
+        :return: the found text, __or None if not found__.
+        """
+        url, key = _split_key(key, url)
+        session = self._get_session()
+
+        def get(base):
+            raw_url = base + capabilities.registry.get(base).raw_path + key
+            for _ in range(retries_per_url+1):
+                try:
+                    with tracing.trace("GET", raw_url) as trace:
+                        response = session.get(raw_url, timeout=timeout, headers=_RAW_HEADERS,
+                                               hooks={"response": trace.requests_hook})
+                        if response.headers.get("Content-Encoding"):
+                            # urllib3 decoded the body as it arrived. tell() is how much of it came over the wire.
+                            trace.saved_received = len(response.content) - response.raw.tell()
+                except requests.RequestException:
+                    continue
+                if response.status_code >= 500:
+                    health.registry.record_failure(base, offline=response.status_code == 503)
+                    return None
+                health.registry.record_success(base, latency=response.elapsed.total_seconds())
+                if response.status_code == 200:
+                    return response.content.decode(encoding or "utf-8", errors="replace")
+                return None
+            health.registry.record_failure(base, offline=True)
+            return None
+
+        if url.lower() != "auto":
+            return get(url)
+        for base in health.registry.candidates(_FALLBACKS):
+            if not health.registry.allow(base):
+                continue
+            res = get(base)
+            if res is not None:
+                return res
+        return None
@@ -0,0 +1,195 @@
+"""
+A local, haste-compatible server, for testing and benchmarking without the network.
+
+:class:`HasteServer` speaks enough of the haste API for every client in this package (``POST /documents``,
+``GET /raw/<key>``, ``GET /documents/<key>`` and HEAD), and can be told to be slow, to reject large documents, to
+compress what it serves (or refuse gzipped posts), or to answer with errors, so retries, fallbacks and rate limiting
+can be tested offline.
+
+The server runs on its own thread and event loop, so it can be used from sync and async code alike:
+
+    with HasteServer(latency=0.01, max_size=1024) as server:
+        postSync("Hello, world", url=server.url)
+"""
+import asyncio
+import collections
+import gzip
+import json
+import random
+import threading
+import uuid
+
+__all__ = ("HasteServer",)
+
+
+class HasteServer:
+    """
+    A haste server that keeps its documents in memory.
+
+    Attributes:
+        url - Optional[str]: the base URL of the server, once it has started.
+        documents - dict: the documents posted so far, by key.
+        requests - collections.Counter: how many requests were answered, by ``(method, status)``.
+    """
+    def __init__(self, *, host: str = "127.0.0.1", port: int = 0, latency=0.0, max_size: int = None,
+                 error_rates: dict = None, retry_after: float = 1.0, seed: int = None, compress: bool = False,
+                 gzip_bodies: str = "decode"):
+        """
+        :param host: the address to listen on.
+        :param port: the port to listen on. Defaults to any free port.
+        :param latency: how long (in seconds) to wait before answering each request. May also be a function,
+            called with the request, that returns the wait.
+        :param max_size: the largest document (in bytes) that can be posted. Larger posts get a 413.
+        :param error_rates: the chance (from 0 to 1) of answering any request with an error, by status code,
+            e.g. ``{503: 0.1, 429: 0.05}``.
+        :param retry_after: the Retry-After (in seconds) sent with injected 429 and 503 responses.
+        :param seed: seeds the random choice of injected errors, so runs can be repeated.
+        :param compress: whether to compress raw documents, for clients that accept it (see Accept-Encoding).
+        :param gzip_bodies: what to do with a gzipped post: "decode" it, "store" it without decoding it (as
+            haste-server does), or "refuse" it with a 415.
+        """
+        if gzip_bodies not in ("decode", "store", "refuse"):
+            raise ValueError("gzip_bodies must be one of decode, store or refuse.")
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.max_size = max_size
+        self.error_rates = dict(error_rates or {})
+        self.retry_after = retry_after
+        self.compress = compress
+        self.gzip_bodies = gzip_bodies
+        self.url = None
+        self.documents = {}
+        self.requests = collections.Counter()
+        self._random = random.Random(seed)
+        self._injected = collections.deque()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    def inject(self, status: int, count: int = 1, *, method: str = None):
+        """
+        Answers the next :param:`count` requests (of :param:`method`, if given) with :param:`status`, whatever
+        they asked for. Injected errors are used up before :attr:`error_rates` is consulted.
+        """
+        with self._lock:
+            self._injected.extend([(status, method and method.upper())] * count)
+
+    def _injected_status(self, method: str):
+        with self._lock:
+            for index, (status, only) in enumerate(self._injected):
+                if only is None or only == method:
+                    del self._injected[index]
+                    return status
+        for status, rate in self.error_rates.items():
+            if self._random.random() < rate:
+                return status
+        return None
+
+    def _app(self):
+        from aiohttp import web
+
+        def _json(data, status=200, headers=None):
+            # like haste-server, without a charset: v1 only accepts exactly "application/json".
+            return web.Response(body=json.dumps(data).encode(), status=status, headers=headers,
+                                content_type="application/json")
+
+        @web.middleware
+        async def simulate(request, handler):
+            latency = self.latency(request) if callable(self.latency) else self.latency
+            if latency:
+                await asyncio.sleep(latency)
+            status = self._injected_status(request.method)
+            if status is not None:
+                headers = {"Retry-After": str(self.retry_after)} if status in (429, 503) else {}
+                response = _json({"message": "Injected error."}, status=status, headers=headers)
+            else:
+                response = await handler(request)
+            self.requests[(request.method, response.status)] += 1
+            return response
+
+        async def index(request):
+            return web.Response(text="PostBin test server")
+
+        async def post_document(request):
+            gzipped = request.headers.get("Content-Encoding", "").lower() == "gzip"
+            if gzipped and self.gzip_bodies == "refuse":
+                return _json({"message": "Unsupported Content-Encoding."}, status=415)
+            body = bytearray()
+            async for chunk in request.content.iter_chunked(2 ** 16):
+                body += chunk
+                if self.max_size is not None and len(body) > self.max_size:
+                    return _json({"message": "Document exceeds maximum length."}, status=413)
+            key = uuid.uuid4().hex[:10]
+            # aiohttp decodes the body as it is read, so a server that doesn't is imitated by encoding it again.
+            self.documents[key] = gzip.compress(body) if gzipped and self.gzip_bodies == "store" else bytes(body)
+            return _json({"key": key})
+
+        async def get_raw(request):
+            document = self.documents.get(request.match_info["key"])
+            if document is None:
+                return _json({"message": "Document not found."}, status=404)
+            response = web.Response(body=document, content_type="text/plain", charset="utf-8")
+            if self.compress:
+                response.enable_compression()  # only if the request's Accept-Encoding allows it.
+            return response
+
+        async def get_document(request):
+            key = request.match_info["key"]
+            document = self.documents.get(key)
+            if document is None:
+                return _json({"message": "Document not found."}, status=404)
+            return _json({"key": key, "data": document.decode("utf-8", "replace")})
+
+        app = web.Application(middlewares=[simulate])
+        app.router.add_get("/", index)
+        app.router.add_post("/documents", post_document)
+        app.router.add_get("/raw/{key}", get_raw)
+        app.router.add_get("/documents/{key}", get_document)
+        return app
+
+    async def _serve(self):
+        from aiohttp import web
+
+        self._runner = web.AppRunner(self._app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.url = "http://%s:%d" % self._runner.addresses[0][:2]
+
+    def start(self) -> str:
+        """Starts the server on a background thread, returning its URL."""
+        if self._thread is not None:
+            return self.url
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="PostBin-HasteServer", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._serve(), self._loop).result()
+        return self.url
+
+    def stop(self):
+        """Stops the server. Its documents are kept."""
+        if self._thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._thread = self._loop = self._runner = None
+
+    def reset(self):
+        """Forgets every document, request count and injected error."""
+        with self._lock:
+            self._injected.clear()
+        self.documents.clear()
+        self.requests.clear()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def __repr__(self):
+        return "<HasteServer url=%r documents=%d>" % (self.url, len(self.documents))
@@ -0,0 +1,53 @@
+import asyncio
+import json
+
+import pytest
+import requests
+
+from postbin import postSync, benchmark
+from postbin.testing import HasteServer
+from postbin.v2 import AsyncHaste
+from postbin.v2.errors import TextTooLarge
+
+
+def test_haste_server():
+    with HasteServer(max_size=64) as server:
+        url = postSync("Hello, wörld", url=server.url)
+        assert requests.get(url.replace(server.url, server.url + "/raw")).text == "Hello, wörld"
+        assert requests.head(server.url).status_code == 200
+        assert requests.post(server.url + "/documents", data="." * 65).status_code == 413
+
+        server.inject(429, 2, method="GET")
+        assert requests.post(server.url + "/documents", data="posts are not affected").status_code == 200
+        limited = requests.get(url)
+        assert limited.status_code == 429 and limited.headers["Retry-After"] == "1.0"
+        assert requests.get(url).status_code == 429
+        assert requests.get(url).status_code == 404  # only the API is served, not the HTML page at /<key>.
+
+        server.error_rates = {503: 1.0}
+        assert requests.get(server.url).status_code == 503
+        assert server.requests[("GET", 429)] == 2 and server.requests[("POST", 413)] == 1
+
+
+def test_v2_too_large():
+    async def post():
+        async with AsyncHaste() as paster:
+            await paster.post("." * 2048, url=server.url)
+
+    with HasteServer(max_size=1024) as server:
+        with pytest.raises(TextTooLarge):
+            asyncio.new_event_loop().run_until_complete(post())
+
+
+def test_benchmark_report(tmp_path):
+    names = ["v1.postSync", "v2.AsyncHaste.raw"]
+    output = tmp_path / "results.json"
+    report = benchmark.run(names, count=20, concurrency=4, size=256, output=str(output))
+    saved = json.loads(output.read_text())
+    assert saved == report and list(saved["results"]) == names
+    for result in saved["results"].values():
+        assert result["operations"] == 20 and result["throughput"] > 0 and result["peak_memory"] > 0
+        assert 0 < result["latency"]["p50"] <= result["latency"]["p99"] <= result["latency"]["max"]
+
+    ratios = benchmark.compare(saved, report)
+    assert ratios["v1.postSync"] == {"throughput": 1.0, "p50": 1.0, "p99": 1.0, "peak_memory": 1.0}
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from postbin import PayloadTooLarge, capabilities, postSync
+from postbin.capabilities import CapabilityRegistry
+from postbin.sync import SyncHaste
+from postbin.testing import HasteServer
+from postbin.v2 import AsyncHaste
+from postbin.v2.errors import TextTooLarge
+
+
+def test_registry():
+    registry = CapabilityRegistry({"https://haste.example": {"max_size": 100}})
+    assert registry.fits("https://haste.example/", 100) and not registry.fits("HTTPS://haste.example", 101)
+    assert registry.fits("https://other.example", 10 ** 9) and registry.fits("https://haste.example", None)
+    registry.record_too_large("https://other.example", 50)
+    registry.record_accepted("https://haste.example", 200)
+    assert registry.refusing(["https://haste.example", "https://other.example"], 60) == ["https://other.example"]
+    registry.record_no_head("https://haste.example")
+    assert registry.snapshot()["https://haste.example"] == {"max_size": 200, "head": False, "raw_path": "/raw/",
+                                                            "format": "json", "gzip": None}
+    with pytest.raises(TypeError):
+        registry.update("https://haste.example", max_length=1)
+
+
+def test_preflight():
+    with HasteServer(max_size=1024) as server, SyncHaste() as paster:
+        with pytest.raises(PayloadTooLarge) as refused:
+            paster.post(b"." * 2048, url=server.url)
+        assert refused.value.raw_response is not None and refused.value.size == 2048
+        assert capabilities.registry.get(server.url).max_size == 2047
+
+        # now the limit is known, nothing is sent: not from SyncHaste, v1 or v2.
+        posts = server.requests[("POST", 413)]
+        with pytest.raises(PayloadTooLarge) as refused:
+            paster.post("." * 4096, url=server.url)
+        assert refused.value.raw_response is None and refused.value.limit == 2047
+        with pytest.raises(PayloadTooLarge):
+            postSync("." * 4096, url=server.url, find_fallback_on_unavailable=False)
+
+        async def post():
+            async with AsyncHaste() as v2:
+                return await v2.post("." * 4096, url=server.url)
+        with pytest.raises(TextTooLarge) as refused:
+            asyncio.new_event_loop().run_until_complete(post())
+        assert server.requests[("POST", 413)] == posts
+        # errors keep the size and the start of the text, never the text itself.
+        assert refused.value.size == 4096 and len(str(refused.value)) < 200
+
+        assert paster.post("." * 1024, url=server.url).startswith(server.url)
+        capabilities.registry.reset(server.url)
+
+
+def test_no_head():
+    with HasteServer() as server, SyncHaste() as paster:
+        capabilities.registry.update(server.url, head=False)
+        assert paster._head(server.url) is True
+        assert server.requests[("GET", 200)] == 1 and not server.requests[("HEAD", 200)]
+        capabilities.registry.reset(server.url)
@@ -0,0 +1,42 @@
+import json
+import subprocess
+import sys
+
+from postbin.__main__ import EXIT_FAILED, EXIT_OK, EXIT_PARTIAL, main
+from postbin.testing import HasteServer
+
+
+def test_upload_files(tmp_path, capsys):
+    (tmp_path / "logs" / "nested").mkdir(parents=True)
+    (tmp_path / "logs" / "a.log").write_text("first")
+    (tmp_path / "logs" / "nested" / "b.log").write_text("second")
+    (tmp_path / "report.xml").write_text("<third/>")
+    with HasteServer() as server:
+        code = main([str(tmp_path / "logs"), str(tmp_path / "*.xml"), str(tmp_path / "missing-*.txt"),
+                     "--url", server.url, "--json", "--concurrency", "2"])
+        records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        uploaded = {record["source"]: record["url"] for record in records if "url" in record}
+        posted = {source: server.documents[url.rsplit("/", 1)[1]] for source, url in uploaded.items()}
+    assert code == EXIT_PARTIAL
+    assert posted == {
+        str(tmp_path / "logs" / "a.log"): b"first",
+        str(tmp_path / "logs" / "nested" / "b.log"): b"second",
+        str(tmp_path / "report.xml"): b"<third/>",
+    }
+    assert [record["source"] for record in records if "error" in record] == [str(tmp_path / "missing-*.txt")]
+
+
+def test_stdin_and_raw(tmp_path):
+    with HasteServer() as server:
+        command = [sys.executable, "-m", "postbin", "--url", server.url, "--no-browser"]
+        result = subprocess.run(command, input=b"streamed\n" * 1000, stdout=subprocess.PIPE, check=True)
+        url = result.stdout.decode().split()[-1]
+        assert server.documents[url.rsplit("/", 1)[1]] == b"streamed\n" * 1000
+
+        assert main(["--raw", url, "-o", str(tmp_path / "out.txt")]) == EXIT_OK
+        assert (tmp_path / "out.txt").read_bytes() == b"streamed\n" * 1000
+        assert main(["--raw", "missing", "--url", server.url]) == EXIT_FAILED
+        assert main(["why?", "--url", server.url, "--json"]) == EXIT_OK  # not a glob: nothing matches it.
+        assert b"why?" in server.documents.values()
+        server.inject(503, 100)
+        assert main(["hello", "world", "--url", server.url, "--retries", "0", "--no-browser"]) == EXIT_FAILED
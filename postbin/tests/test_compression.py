@@ -0,0 +1,81 @@
+import asyncio
+import gzip
+
+import pytest
+
+from postbin import capabilities, tracing
+from postbin.compression import CompressionPolicy, Decoder, DecodedStream
+from postbin.sync import SyncHaste
+from postbin.testing import HasteServer
+from postbin.v2 import AsyncHaste
+
+_TEXT = "Traceback (most recent call last):\n  File \"app.py\", line 1, in <module>\n" * 500
+
+
+def test_decoded_stream():
+    class Content:
+        def __init__(self, body):
+            self.body = body
+
+        async def read(self, n):
+            chunk, self.body = self.body[:n], self.body[n:]
+            return chunk
+
+    async def read(stream):
+        return await stream.read(7) + b"".join([chunk async for chunk in stream.iter_chunked(1000)])
+
+    body = _TEXT.encode()
+    stream = DecodedStream(Content(gzip.compress(body)), "gzip", chunk_size=100)
+    assert asyncio.new_event_loop().run_until_complete(read(stream)) == body
+    assert stream.saved == len(body) - len(gzip.compress(body))
+    assert Decoder(None).feed(b"as is") == b"as is"
+    with pytest.raises(ValueError):
+        Decoder("compress")
+
+
+def test_compressed_downloads():
+    traces = []
+    tracing.add_observer(traces.append)
+
+    async def fetch(url, key):
+        async with AsyncHaste() as paster:
+            return await paster.raw(key, url=url), b"".join([chunk async for chunk in paster.iter_raw(key, url=url)])
+
+    try:
+        with HasteServer(compress=True) as server, SyncHaste() as paster:
+            server.documents["log"] = _TEXT.encode()
+            text, streamed = asyncio.new_event_loop().run_until_complete(fetch(server.url, "log"))
+            assert text == _TEXT and streamed == _TEXT.encode()
+            assert paster.raw("log", url=server.url) == _TEXT
+    finally:
+        tracing.remove_observer(traces.append)
+    raw = [trace for trace in traces if trace.method == "GET"]
+    assert len(raw) == 3 and all(trace.saved_received > len(_TEXT) // 2 for trace in raw)
+    assert raw[0].bytes_received < len(_TEXT) // 2  # what came over the wire, before it was decoded.
+
+
+@pytest.mark.parametrize("bodies, accepted", [("decode", True), ("store", False), ("refuse", False)])
+def test_compressed_uploads(bodies, accepted):
+    traces = []
+    tracing.add_observer(traces.append)
+
+    async def post(url):
+        policy = CompressionPolicy(threshold=100, executor_threshold=10000)
+        async with AsyncHaste(compression=policy) as paster:
+            return await asyncio.gather(paster.post(_TEXT, url=url), paster.post(_TEXT + "again", url=url),
+                                        paster.post("too small to compress", url=url))
+
+    try:
+        with HasteServer(gzip_bodies=bodies) as server:
+            urls = asyncio.new_event_loop().run_until_complete(post(server.url))
+            assert [server.documents[url.rsplit("/", 1)[1]].decode() for url in urls] == [
+                _TEXT, _TEXT + "again", "too small to compress"
+            ]
+            assert capabilities.registry.get(server.url).gzip is accepted
+            # the two posts that could be compressed shared one probe (which a refusing server didn't store).
+            assert len(server.documents) == len(urls) + (bodies != "refuse")
+            capabilities.registry.reset(server.url)
+    finally:
+        tracing.remove_observer(traces.append)
+    saved = [trace.saved_sent for trace in traces if trace.method == "POST" and trace.saved_sent]
+    assert len(saved) == (2 if accepted else 0) and all(value > len(_TEXT) // 2 for value in saved)
@@ -0,0 +1,79 @@
+import threading
+import time
+
+from postbin.dedupe import DedupeCache, digest
+
+
+def test_digest_is_streaming_friendly(tmp_path):
+    source = tmp_path / "doc.txt"
+    source.write_bytes("hëllo".encode())
+    assert digest("hëllo") == digest("hëllo".encode()) == digest(source)
+    assert digest(iter([b"one-shot"])) is None
+
+
+def test_coalesces_and_persists(tmp_path):
+    cache = DedupeCache(path=str(tmp_path / "dedupe.sqlite3"))
+    key = DedupeCache.key("same text")
+    uploads = []
+
+    def upload():
+        uploads.append(1)
+        time.sleep(0.1)
+        return "https://haste.example/key"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.run(key, upload))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["https://haste.example/key"] * 8
+    assert len(uploads) == 1
+    cache.close()
+
+    reopened = DedupeCache(path=str(tmp_path / "dedupe.sqlite3"))
+    assert reopened.get(key) == "https://haste.example/key"
+    assert reopened.get(DedupeCache.key("same text", "https://other.example")) is None
+
+
+def test_async_io_is_off_the_loop(tmp_path):
+    import asyncio
+    import hashlib
+
+    class Recorded(DedupeCache):
+        def get(self, key):
+            threads.add(threading.get_ident())
+            return super().get(key)
+
+    async def upload():
+        return "https://haste.example/key"
+
+    async def main():
+        key = await DedupeCache.key_async(tmp_path / "large.txt")
+        return key, await cache.run_async(key, upload), await cache.run_async(key, upload)
+
+    threads = set()
+    (tmp_path / "large.txt").write_bytes(b"x" * 2 ** 20)
+    cache = Recorded(path=str(tmp_path / "dedupe.sqlite3"))
+    key, first, second = asyncio.new_event_loop().run_until_complete(main())
+    assert key.startswith(hashlib.sha256(b"x" * 2 ** 20).hexdigest()) and first == second
+    assert threads and threading.get_ident() not in threads  # the database was only used from worker threads.
+    cache.close()
+
+
+def test_payloads_are_deduplicated():
+    import asyncio
+    from postbin import postAsync, postSync
+    from postbin.payload import Payload
+    from postbin.testing import HasteServer
+
+    cache = DedupeCache()
+    with HasteServer() as server:
+        first = postSync(Payload("same"), url=server.url, dedupe=cache)
+        assert postSync(Payload(b"same"), url=server.url, dedupe=cache) == first
+        loop = asyncio.new_event_loop()
+        assert loop.run_until_complete(postAsync(Payload("same"), url=server.url, dedupe=cache)) == first
+        # a one-shot stream can't be hashed, so it is posted as it is.
+        assert postSync(Payload(iter([b"same"])), url=server.url, dedupe=cache) != first
+        loop.close()
+        assert len(server.documents) == 2
@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+
+from postbin.handlers import HasteHandler
+from postbin.testing import HasteServer
+
+
+def _logger(handler):
+    logger = logging.getLogger("postbin.tests.handlers.%d" % id(handler))
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    return logger
+
+
+def _document(server, url):
+    return server.documents[url.rsplit("/", 1)[1]].decode()
+
+
+def test_flush_triggers():
+    flushed = []
+    posted = threading.Event()
+
+    def on_flush(url, count):
+        flushed.append((url, count))
+        posted.set()
+
+    with HasteServer() as server:
+        handler = HasteHandler(url=server.url, batch_size=3, flush_interval=None, flush_level=logging.ERROR,
+                               on_flush=on_flush)
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        logger = _logger(handler)
+        logger.info("one")
+        logger.info("two")
+        assert not posted.wait(0.2)  # below the batch size, and not severe enough.
+        logger.info("three")
+        assert posted.wait(5)
+        assert _document(server, flushed[0][0]) == "INFO one\nINFO two\nINFO three\n" and flushed[0][1] == 3
+
+        posted.clear()
+        logger.error("severe")
+        assert posted.wait(5)
+        assert _document(server, handler.last_url) == "ERROR severe\n"
+
+        logger.debug("left over")
+        handler.close()  # posts what is still buffered.
+        assert handler.batches == 3 and _document(server, handler.last_url) == "DEBUG left over\n"
+
+
+def test_back_pressure():
+    # a slow server, and a buffer much smaller than what is logged while a batch is being posted.
+    with HasteServer(latency=0.5) as server:
+        handler = HasteHandler(url=server.url, capacity=5, batch_size=5, flush_interval=None, flush_level=None)
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        logger = _logger(handler)
+        started = time.perf_counter()
+        for i in range(5):
+            logger.info("first %d", i)
+        time.sleep(0.1)  # the worker is now posting the first batch.
+        for i in range(20):
+            logger.log(logging.WARNING if i % 2 else logging.INFO, "second %d", i)
+        assert time.perf_counter() - started < 0.5  # logging never waited for the slow server.
+
+        url = handler.flush()
+        assert handler.dropped == 15 and handler.pending == 0
+        lines = _document(server, url).splitlines()
+        assert lines[0] == "[postbin] 15 records were dropped before this batch (INFO: 8, WARNING: 7)"
+        assert lines[1:] == ["%s second %d" % ("WARNING" if i % 2 else "INFO", i) for i in range(15, 20)]
+        handler.close()
+        assert handler.batches == 2 and handler.failed == 0
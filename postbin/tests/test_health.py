@@ -0,0 +1,68 @@
+import time
+
+from postbin.health import HealthRegistry
+
+
+def test_circuit_opens_and_recovers():
+    registry = HealthRegistry(failure_threshold=2, cooldown=0.05)
+    url = "https://haste.example"
+    assert registry.allow(url)
+    registry.record_failure(url)
+    assert registry.allow(url)
+    registry.record_failure(url)
+    assert not registry.allow(url)
+    time.sleep(0.06)
+    assert registry.allow(url)  # half-open probe
+    assert not registry.allow(url)  # only one probe at a time
+    registry.record_success(url + "/")
+    assert registry.allow(url)
+    assert registry.is_healthy(url)
+
+
+def test_offline_opens_immediately():
+    registry = HealthRegistry(failure_threshold=5, cooldown=60)
+    registry.record_failure("https://a.example", offline=True)
+    registry.record_success("https://b.example")
+    urls = ["https://a.example", "https://b.example", "https://c.example"]
+    assert registry.candidates(urls) == urls[1:]
+    assert registry.healthy(urls) == ["https://b.example"]
+    assert registry.snapshot()["https://a.example"]["state"] == "open"
+
+
+def test_candidates_claim_nothing():
+    registry = HealthRegistry(cooldown=0.05)
+    a, b = "https://a.example", "https://b.example"
+    registry.record_failure(a, offline=True)
+    registry.record_failure(b, offline=True)
+    time.sleep(0.06)
+    assert registry.candidates([a, b]) == [a, b]
+    assert registry.allow(a)  # only a is sent a request...
+    registry.record_success(a)
+    assert registry.candidates([a, b]) == [a, b]  # ...so b's probe is still up for grabs.
+    assert registry.snapshot()[b]["state"] == "open"
+    assert registry.allow(b) and not registry.available(b)
+
+
+def test_selection_strategies():
+    from collections import Counter
+    from postbin.selection import BestOfTwo, RoundRobin, WeightedRandom
+    registry = HealthRegistry(alpha=0.5)
+    slow, fast, flaky = "https://slow.example", "https://fast.example", "https://flaky.example"
+    urls = [slow, fast, flaky]
+    for _ in range(5):
+        registry.record_success(slow, latency=1.0)
+        registry.record_success(fast, latency=0.1)
+        registry.record_success(flaky, latency=0.1)
+    registry.record_failure(flaky)
+    registry.record_success(flaky, latency=0.1)
+    assert registry.get(fast).latency == 0.1 and 0 < registry.get(flaky).error_rate < 0.5
+    assert registry.healthy(urls) == urls  # the default keeps the fallback order.
+
+    for strategy in (BestOfTwo(), WeightedRandom()):
+        registry.strategy = strategy
+        firsts = Counter(registry.healthy(urls)[0] for _ in range(1000))
+        assert sorted(registry.candidates(urls)) == sorted(urls)
+        assert firsts[fast] > firsts[flaky] > firsts[slow], (strategy, firsts)
+
+    registry.strategy = RoundRobin()
+    assert [registry.healthy(urls) for _ in range(4)] == [urls, [fast, flaky, slow], [flaky, slow, fast], urls]
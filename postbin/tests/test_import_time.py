@@ -0,0 +1,47 @@
+import subprocess
+import sys
+
+from postbin.lazy import LazyModule
+
+# microseconds. Importing postbin took ~350ms with both backends imported eagerly, and takes ~40ms without.
+_BUDGET = 150_000
+
+
+def _import_times(statement):
+    """Runs :param:`statement` in a fresh interpreter, returning the cumulative import time of every module."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_import_time():
+    times = _import_times("from postbin import postSync")
+    assert not {"requests", "aiohttp", "asyncio"} & set(times), "a backend was imported eagerly"
+    assert times["postbin"] < _BUDGET, "importing postbin took %.1fms" % (times["postbin"] / 1000)
+
+
+def test_cli_import_time():
+    # what the CLI imports before it knows whether it will upload, download, or just print its --help.
+    times = _import_times("import postbin.__main__")
+    assert not {"requests", "aiohttp", "asyncio"} & set(times), "a backend was imported eagerly"
+    total = times["postbin"] + times["postbin.__main__"]
+    assert total < _BUDGET, "importing the CLI took %.1fms" % (total / 1000)
+
+
+def test_v2_import_time():
+    times = _import_times("import postbin.v2")
+    assert "aiohttp" not in times and "requests" not in times
+    assert times["postbin.v2"] < _BUDGET + times.get("asyncio", 0)
+
+
+def test_lazy_module():
+    missing = LazyModule("postbin_no_such_module")
+    assert not missing and not missing.loaded
+    json = LazyModule("json")
+    assert json and json.loads("[1]") == [1] and json.loaded
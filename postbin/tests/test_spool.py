@@ -0,0 +1,68 @@
+import asyncio
+import os
+
+import pytest
+
+from postbin import ResponseError, health, postSync
+from postbin.spool import Drainer, Spool, Ticket
+from postbin.sync import SyncHaste
+from postbin.testing import HasteServer
+from postbin.v2 import AsyncHaste
+
+
+def test_spool_and_drain(tmp_path):
+    with HasteServer() as server, SyncHaste() as haste:
+        spool = Spool(str(tmp_path), fsync="never")
+        server.inject(500, count=10, method="POST")  # a 503 would send v1 looking for fallbacks.
+        ticket = postSync("spooled", url=server.url, retry=1, find_fallback_on_unavailable=False, spool=spool)
+        assert isinstance(ticket, Ticket) and not ticket.posted and len(spool) == 1
+
+        paster = SyncHaste(spool=spool)
+        second = paster.post(b"also spooled", url=server.url)
+        assert isinstance(second, Ticket) and [t.id for t in spool.pending()] == [ticket.id, second.id]
+        with pytest.raises(ResponseError):
+            paster.post(iter([b"one-shot"]), url=server.url)  # can't be replayed, so the error is raised.
+
+        server.reset()
+        health.registry.reset(server.url)
+        drainer = Drainer(spool, rate=100, haste=haste)
+        assert drainer.drain_once() == 2 and not spool.pending()
+        url = spool.wait(ticket.id, timeout=1)
+        assert server.documents[url.rsplit("/", 1)[1]] == b"spooled"
+        assert spool.lookup(second).url.endswith("/" + next(k for k, v in server.documents.items()
+                                                           if v == b"also spooled"))
+        # drained and compacted: the posted tickets' URLs are kept, their payloads aren't.
+        assert len(os.listdir(str(tmp_path))) == 1
+        spool.close()
+
+        with Spool(str(tmp_path)) as reopened:
+            assert reopened.lookup(ticket.id).url == url and not reopened.pending()
+
+
+def test_async_spool(tmp_path):
+    async def main(spool):
+        async with AsyncHaste(spool=spool) as paster:
+            return await paster.post("offline", url="http://127.0.0.1:9", retries=0, timeout=2)
+
+    with Spool(str(tmp_path), fsync="interval") as spool:
+        ticket = asyncio.new_event_loop().run_until_complete(main(spool))
+        health.registry.reset("http://127.0.0.1:9")
+        assert isinstance(ticket, Ticket) and ticket.host == "http://127.0.0.1:9"
+        with spool.read(ticket) as payload:
+            assert bytes(payload.body) == b"offline"
+
+
+def test_torn_tail(tmp_path):
+    with Spool(str(tmp_path)) as spool:
+        first = spool.put("complete")
+        spool.put("torn" * 100)
+    segment = os.path.join(str(tmp_path), sorted(os.listdir(str(tmp_path)))[-1])
+    with open(segment, "r+b") as file:
+        file.truncate(os.path.getsize(segment) - 50)  # as if the process died mid-write.
+
+    with Spool(str(tmp_path)) as spool:
+        assert [ticket.id for ticket in spool.pending()] == [first.id]
+        third = spool.put("after recovery")
+        assert [ticket.id for ticket in spool.pending()] == [first.id, third.id]
+    with Spool(str(tmp_path)) as spool:
+        assert len(spool) == 2
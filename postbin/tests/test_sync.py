@@ -22,3 +22,23 @@ def test_sync():
 #         return True
 #     else:
 #         assert not result.startswith("http")
+
+
+def test_race_fallbacks_deadline():
+    import time
+    import postbin
+    original = postbin._FALLBACKS[:]
+    postbin._FALLBACKS[:] = ["http://127.0.0.1:9", "http://10.255.255.1"]
+    postbin.health.registry.reset()
+    try:
+        started = time.monotonic()
+        try:
+            postbin.findFallBackSync(False, concurrent=True, deadline=1)
+        except postbin.NoFallbacks:
+            pass
+        else:
+            raise AssertionError("found a fallback in an unroutable list")
+        assert time.monotonic() - started < 3
+    finally:
+        postbin._FALLBACKS[:] = original
+        postbin.health.registry.reset()
@@ -0,0 +1,233 @@
+import json
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from postbin import SyncHaste, postSync
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so connection re-use is visible.
+    documents = {}
+    connections = set()
+
+    def setup(self):
+        super().setup()
+        # headers and body are written separately, so Nagle would add a delayed-ACK stall to kept-alive posts.
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections.add(self.client_address)
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding") != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b""
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            body += self.rfile.read(size)
+            self.rfile.readline()
+            if not size:
+                return body
+
+    def do_POST(self):
+        body = self._read_body()
+        key = "k%d" % len(self.documents)
+        self.documents[key] = body
+        payload = json.dumps({"key": key}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        body = self.documents.get(self.path.rsplit("/", 1)[-1])
+        self.send_response(200 if body is not None else 404)
+        self.send_header("Content-Length", str(len(body or b"")))
+        self.end_headers()
+        self.wfile.write(body or b"")
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):  # http.server.ThreadingHTTPServer is new in 3.7.
+    daemon_threads = True
+    request_queue_size = 128  # postSync opens a connection per call, which overflows the default backlog.
+
+
+def _serve(handler=_Handler):
+    server = _Server(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d" % server.server_address[1]
+
+
+def _post_concurrently(post, count=256, workers=32):
+    with ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(post, ["document %d" % i for i in range(count)]))
+    assert all(result.startswith("http") for result in results)
+
+
+def test_post_and_raw():
+    server, url = _serve()
+    try:
+        with SyncHaste() as paster:
+            key = paster.post("Hello, wörld", url=url, return_full_url=False)
+            assert paster.raw(key, url=url) == "Hello, wörld"
+            assert paster.raw(url + "/raw/" + key + ".txt") == "Hello, wörld"  # a full URL, like v2 takes.
+            assert paster.raw("missing", url=url) is None
+    finally:
+        server.shutdown()
+
+
+def test_pooled_connection_reuse():
+    # only the connections are compared: throughput depends too much on the machine running the tests.
+    server, url = _serve()
+    try:
+        _Handler.connections.clear()
+        _post_concurrently(lambda text: postSync(text, url=url))
+        per_call_connections = len(_Handler.connections)
+
+        _Handler.connections.clear()
+        with SyncHaste(pool_maxsize=8) as paster:
+            _post_concurrently(lambda text: paster.post(text, url=url))
+        pooled_connections = len(_Handler.connections)
+    finally:
+        server.shutdown()
+    assert pooled_connections <= 8 < per_call_connections
+
+
+def test_streamed_payloads(tmp_path):
+    import io
+    server, url = _serve()
+    source = tmp_path / "log.txt"
+    source.write_bytes(b"line\n" * 10000)
+    try:
+        with SyncHaste() as paster:
+            assert paster.raw(paster.post(source, url=url, return_full_url=False), url=url) == "line\n" * 10000
+            chunks = (b"chunk %d\n" % i for i in range(100))
+            key = paster.post(chunks, url=url, return_full_url=False)
+            assert paster.raw(key, url=url) == "".join("chunk %d\n" % i for i in range(100))
+            key = paster.post(memoryview(b"view"), url=url, return_full_url=False)
+            assert paster.raw(key, url=url) == "view"
+        with open(source, "rb") as rfile:
+            assert postSync(rfile, url=url).startswith(url)
+        assert postSync(io.BytesIO(b"abc"), url=url).startswith(url)
+    finally:
+        server.shutdown()
+
+
+def test_dedupe():
+    from postbin.dedupe import DedupeCache
+    server, url = _serve()
+    try:
+        cache = DedupeCache()
+        with SyncHaste(dedupe=cache) as paster:
+            first = paster.post("the same traceback", url=url)
+            assert paster.post("the same traceback", url=url) == first
+        assert postSync("the same traceback", url=url, dedupe=cache) == first
+        assert postSync("another traceback", url=url, dedupe=cache) != first
+        assert cache.hits == 2
+    finally:
+        server.shutdown()
+
+
+class _FlakyHandler(_Handler):
+    failures = 0  # how many more posts to answer with 500.
+
+    def do_POST(self):
+        if _FlakyHandler.failures > 0:
+            _FlakyHandler.failures -= 1
+            self._read_body()
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        super().do_POST()
+
+
+def test_retry_policy():
+    from postbin import NoMoreRetries
+    from postbin.retry import RetryPolicy
+    server, url = _serve(_FlakyHandler)
+    policy = RetryPolicy(max_attempts=5, max_attempts_per_host=3, backoff=0.01)
+    try:
+        _FlakyHandler.failures = 2
+        state = policy.start()
+        assert postSync("flaky", url=url, retry_policy=state).startswith(url)
+        assert state.attempts == 3 and state.hosts == {url: 3}
+
+        _FlakyHandler.failures = 100
+        try:
+            postSync("down", url=url, retry_policy=policy)
+        except NoMoreRetries as e:
+            assert e.retry_state.attempts == 3  # the per-host limit, not the per-call one.
+        else:
+            raise AssertionError("posted to a host that only returns errors")
+
+        # the deadline covers the backoff too, so a call can't outlive it however long the waits are.
+        started = time.monotonic()
+        try:
+            postSync("down", url=url, retry_policy=policy.replace(deadline=0.3, backoff=10, jitter=False))
+        except NoMoreRetries as e:
+            assert e.retry_state.spent == 1.0
+        assert time.monotonic() - started < 1
+    finally:
+        _FlakyHandler.failures = 0
+        server.shutdown()
+
+
+def test_rate_limited():
+    from postbin import RateLimitedError
+    from postbin.testing import HasteServer
+    with HasteServer(retry_after=0.05) as server, SyncHaste() as paster:
+        server.inject(429, count=2, method="POST")
+        started = time.monotonic()
+        assert paster.post("eventually", url=server.url).startswith(server.url)
+        assert time.monotonic() - started >= 0.1  # it waited as long as Retry-After said, each time.
+
+        paster.max_rate_limited_retries = 1
+        server.inject(429, count=2, method="POST")
+        try:
+            paster.post("never", url=server.url)
+        except RateLimitedError as e:
+            assert e.status == 429
+        else:
+            raise AssertionError("posted while rate limited")
+        assert server.requests[("POST", 429)] == 4
+
+        # a one-shot stream can't be sent again, so it isn't retried.
+        paster.max_rate_limited_retries = 5
+        server.inject(429, count=1, method="POST")
+        try:
+            paster.post(iter([b"one ", b"shot"]), url=server.url)
+        except RateLimitedError:
+            pass
+        else:
+            raise AssertionError("posted while rate limited")
+        assert server.requests[("POST", 429)] == 5
+
+
+def test_retry_argument():
+    import asyncio
+    from postbin import NoMoreRetries, postAsync
+    from postbin.testing import HasteServer
+    with HasteServer() as server:
+        # retry counts the retries of each host, so it isn't capped by the default policy's per-host limit.
+        server.inject(500, count=4, method="POST")
+        assert postSync("fifth time lucky", url=server.url, retry=4).startswith(server.url)
+        server.inject(500, count=4, method="POST")
+        loop = asyncio.new_event_loop()
+        assert loop.run_until_complete(postAsync("async", url=server.url, retry=4)).startswith(server.url)
+        loop.close()
+        assert server.requests[("POST", 500)] == 8
+
+        server.inject(500, count=1, method="POST")
+        try:
+            postSync("no retries", url=server.url, retry=-1)
+        except NoMoreRetries as e:
+            assert e.retry_state.attempts == 1
+        else:
+            raise AssertionError("retried with retry=-1")
@@ -0,0 +1,42 @@
+import asyncio
+
+from postbin import SyncHaste, postAsync, tracing
+from postbin.v2 import AsyncHaste
+
+from .test_sync_client import _serve
+
+
+def test_traces_and_metrics():
+    server, url = _serve()
+    traces = []
+    tracing.add_observer(traces.append)
+    tracing.metrics.reset()
+
+    async def post_async():
+        async with AsyncHaste() as paster:
+            return await paster.post("v2 document", url=url), await paster.raw("k0", url=url)
+
+    try:
+        with SyncHaste() as paster:
+            paster.post("sync document", url=url)
+        asyncio.new_event_loop().run_until_complete(postAsync("v1 document", url=url))
+        asyncio.new_event_loop().run_until_complete(post_async())
+    finally:
+        tracing.remove_observer(traces.append)
+        server.shutdown()
+
+    posts = [trace for trace in traces if trace.method == "POST"]
+    assert len(posts) == 3 and all(trace.status == 200 and trace.host == url for trace in posts)
+    assert [trace.bytes_sent for trace in posts] == [13, 11, 11]
+    assert all(trace.ttfb is not None and trace.total >= trace.ttfb for trace in posts)
+    # aiohttp also times the connection, which requests can't.
+    assert posts[0].connect is None and posts[1].connect is not None
+    raw = [trace for trace in traces if trace.method == "GET"]
+    assert raw and raw[-1].bytes_received == len("sync document")
+
+    exported = tracing.metrics.to_prometheus()
+    assert '# TYPE postbin_request_seconds histogram' in exported
+    assert 'postbin_requests_total{host="%s",method="POST",status="200"} 3' % url in exported
+    assert 'postbin_request_seconds_count{host="%s",method="POST",phase="total"} 3' % url in exported
+    series = tracing.metrics.to_dict()["postbin_bytes_total"]
+    assert {"labels": {"host": url, "direction": "sent"}, "value": 35} in series
@@ -0,0 +1,382 @@
+"""
+Tracing and metrics for every HTTP request PostBin makes.
+
+Each request is described by a :class:`RequestTrace`: how long DNS, connecting, TLS, the first byte and the whole
+request took, how many bytes went each way, and which retry (and fallback hop) of its call it was. Finished
+traces are passed to every observer added with :func:`add_observer`, and added to :data:`metrics`, which can be
+exported as Prometheus text or as a dict::
+
+    from postbin import tracing
+    tracing.add_observer(lambda trace: print(trace.as_dict()))
+    print(tracing.metrics.to_prometheus())
+
+aiohttp requests are timed through a ``TraceConfig`` (see :func:`aiohttp_trace_config`). requests does not
+expose connection timings, so for it only the time to the response headers (``ttfb``) is known.
+"""
+import contextlib
+import logging
+import threading
+import time
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+try:
+    import contextvars
+except ImportError:  # new in Python 3.7.
+    contextvars = None
+
+__all__ = ("RequestTrace", "Histogram", "MetricsRegistry", "metrics", "trace", "attempt", "add_observer",
+           "remove_observer", "aiohttp_trace_config")
+
+logger = logging.getLogger("postbin.tracing")
+
+enabled = True  # set to False to stop recording traces (and metrics) altogether.
+_observers = []
+
+
+class _ThreadLocalVar(threading.local):
+    """Stands in for a ContextVar on Python 3.6. Tasks sharing a thread share its value, so retries may be mislabelled."""
+    def __init__(self, default):
+        self.value = default
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        token, self.value = self.value, value
+        return token
+
+    def reset(self, token):
+        self.value = token
+
+
+if contextvars is not None:
+    _attempt = contextvars.ContextVar("postbin_attempt", default=(0, 0))
+else:
+    _attempt = _ThreadLocalVar((0, 0))
+
+
+class RequestTrace:
+    """
+    The timings and outcome of one HTTP request. Timings are in seconds, and None if they were not measured.
+
+    Attributes:
+        method - str: the HTTP method.
+        url - str: the requested URL.
+        host - str: the scheme and host of the URL.
+        status - Optional[int]: the response status, or None if no response arrived.
+        error - Optional[str]: the name of the exception the request failed with, if any.
+        dns - Optional[float]: time spent resolving the host name.
+        connect - Optional[float]: time spent opening the connection (including TLS, for aiohttp).
+        tls - Optional[float]: time spent on the TLS handshake, if it could be measured on its own.
+        ttfb - Optional[float]: time until the response headers arrived.
+        total - Optional[float]: time until the request was done with, body included.
+        bytes_sent - int: request body bytes sent.
+        bytes_received - int: response body bytes received.
+        saved_sent - int: request body bytes that compression saved.
+        saved_received - int: response body bytes that compression saved.
+        reused - bool: whether a kept-alive connection was re-used.
+        retries - int: how many earlier attempts of the same call went to this host.
+        hops - int: how many other hosts the same call tried before this one.
+    """
+    __slots__ = ("method", "url", "host", "status", "error", "dns", "connect", "tls", "ttfb", "total",
+                 "bytes_sent", "bytes_received", "saved_sent", "saved_received", "reused", "retries", "hops",
+                 "started", "_marks")
+
+    def __init__(self, method: str, url: str, *, retries: int = None, hops: int = None):
+        parts = urlsplit(url)
+        current = _attempt.get()
+        self.method = method.upper()
+        self.url = url
+        self.host = (parts.scheme + "://" + parts.netloc).lower()
+        self.status = None
+        self.error = None
+        self.dns = self.connect = self.tls = self.ttfb = self.total = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.saved_sent = 0
+        self.saved_received = 0
+        self.reused = False
+        self.retries = current[0] if retries is None else retries
+        self.hops = current[1] if hops is None else hops
+        self.started = time.perf_counter()
+        self._marks = {}
+
+    def _start(self, phase: str):
+        self._marks[phase] = time.perf_counter()
+
+    def _end(self, phase: str):
+        started = self._marks.pop(phase, None)
+        if started is not None:
+            setattr(self, phase, time.perf_counter() - started)
+
+    def finish(self, error: BaseException = None):
+        """Stops the clock and hands the trace to every observer. Only the first call does anything."""
+        if self.total is not None:
+            return
+        self.total = time.perf_counter() - self.started
+        if error is not None and self.error is None:
+            self.error = type(error).__name__
+        _emit(self)
+
+    def requests_hook(self, response, *args, **kwargs):
+        """A requests response hook (``hooks={"response": trace.requests_hook}``) that fills in this trace."""
+        self.status = response.status_code
+        self.ttfb = response.elapsed.total_seconds()
+        body = response.request.body
+        if isinstance(body, (bytes, str)):
+            self.bytes_sent = len(body)
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit():
+            self.bytes_received = int(length)
+        return response
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__ if not name.startswith("_")}
+
+    def __repr__(self):
+        return "<RequestTrace {0.method} {0.url} status={0.status} total={0.total}>".format(self)
+
+
+@contextlib.contextmanager
+def trace(method: str, url: str, **kwargs):
+    """
+    Traces the request made inside the ``with`` block, finishing the trace when the block exits.
+
+    Pass the trace to aiohttp as ``trace_request_ctx``, or its :meth:`RequestTrace.requests_hook` to requests,
+    so the connection timings are filled in.
+    """
+    request = RequestTrace(method, url, **kwargs)
+    try:
+        yield request
+    except BaseException as e:
+        request.finish(e)
+        raise
+    request.finish()
+
+
+@contextlib.contextmanager
+def attempt(retries: int = 0, hops: int = 0):
+    """Marks every request traced inside the ``with`` block as a retry and/or a fallback hop of its call."""
+    token = _attempt.set((retries, hops))
+    try:
+        yield
+    finally:
+        _attempt.reset(token)
+
+
+def add_observer(callback):
+    """Calls ``callback(trace)`` with every finished :class:`RequestTrace`."""
+    _observers.append(callback)
+
+
+def remove_observer(callback):
+    """Stops calling a callback added with :func:`add_observer`."""
+    _observers.remove(callback)
+
+
+def _emit(request: RequestTrace):
+    if not enabled:
+        return
+    metrics.observe(request)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s %s -> %s in %.3fs", request.method, request.url, request.status or request.error,
+                     request.total, extra={"trace": request.as_dict()})
+    for callback in list(_observers):
+        try:
+            callback(request)
+        except Exception:
+            logger.exception("Trace observer %r failed.", callback)
+
+
+class Histogram:
+    """A cumulative histogram, in the shape Prometheus expects."""
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def as_dict(self) -> dict:
+        return {"buckets": dict(zip(self.buckets, self.counts)), "sum": self.sum, "count": self.count}
+
+
+def _labels(labels) -> str:
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace('"', '\\"')) for name, value in labels) + "}"
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms built from finished traces, labelled by host (and method, phase or status).
+
+    Metrics:
+        postbin_request_seconds - histogram, by host, method and phase (dns, connect, tls, ttfb, total).
+        postbin_requests_total - counter, by host, method and status ("error" for requests without a response).
+        postbin_bytes_total - counter, by host and direction (sent or received).
+        postbin_compression_saved_bytes_total - counter, by host and direction: body bytes compression saved.
+        postbin_retries_total - counter, by host: requests that were retries of an earlier attempt.
+        postbin_fallback_hops_total - counter, by host: requests that were sent after giving up on another host.
+    """
+    PHASES = ("dns", "connect", "tls", "ttfb", "total")
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+    HELP = {
+        "postbin_request_seconds": ("histogram", "Time spent on each phase of a request."),
+        "postbin_requests_total": ("counter", "Requests made, by response status."),
+        "postbin_bytes_total": ("counter", "Body bytes sent and received."),
+        "postbin_compression_saved_bytes_total": ("counter", "Body bytes that compression saved sending or receiving."),
+        "postbin_retries_total": ("counter", "Requests that retried a host."),
+        "postbin_fallback_hops_total": ("counter", "Requests sent to a fallback host."),
+    }
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._metrics = {name: {} for name in self.HELP}
+        self._lock = threading.Lock()
+
+    def _add(self, name: str, labels: tuple, value: float = 1):
+        counters = self._metrics[name]
+        counters[labels] = counters.get(labels, 0) + value
+
+    def observe(self, request: RequestTrace):
+        """Adds a finished trace to the metrics."""
+        host = (("host", request.host),)
+        with self._lock:
+            histograms = self._metrics["postbin_request_seconds"]
+            for phase in self.PHASES:
+                value = getattr(request, phase)
+                if value is not None:
+                    labels = host + (("method", request.method), ("phase", phase))
+                    histogram = histograms.get(labels)
+                    if histogram is None:
+                        histogram = histograms[labels] = Histogram(self.buckets)
+                    histogram.observe(value)
+            status = request.status if request.status is not None else "error"
+            self._add("postbin_requests_total", host + (("method", request.method), ("status", status)))
+            self._add("postbin_bytes_total", host + (("direction", "sent"),), request.bytes_sent)
+            self._add("postbin_bytes_total", host + (("direction", "received"),), request.bytes_received)
+            if request.saved_sent:
+                self._add("postbin_compression_saved_bytes_total", host + (("direction", "sent"),), request.saved_sent)
+            if request.saved_received:
+                self._add("postbin_compression_saved_bytes_total", host + (("direction", "received"),),
+                          request.saved_received)
+            if request.retries:
+                self._add("postbin_retries_total", host)
+            if request.hops:
+                self._add("postbin_fallback_hops_total", host)
+
+    def to_dict(self) -> dict:
+        """Returns every metric as ``{name: [{"labels": {...}, "value": ...}]}``. Histograms are dicts."""
+        with self._lock:
+            return {
+                name: [
+                    {"labels": dict(labels), "value": value.as_dict() if isinstance(value, Histogram) else value}
+                    for labels, value in series.items()
+                ]
+                for name, series in self._metrics.items()
+            }
+
+    def to_prometheus(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, series in self._metrics.items():
+                kind, description = self.HELP[name]
+                lines.append("# HELP %s %s" % (name, description))
+                lines.append("# TYPE %s %s" % (name, kind))
+                for labels, value in series.items():
+                    if not isinstance(value, Histogram):
+                        lines.append("%s%s %s" % (name, _labels(labels), value))
+                        continue
+                    for bound, count in zip(value.buckets, value.counts):
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append("%s_bucket%s %d" % (name, _labels(labels + (("le", le),)), count))
+                    lines.append("%s_sum%s %s" % (name, _labels(labels), value.sum))
+                    lines.append("%s_count%s %d" % (name, _labels(labels), value.count))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """Forgets every metric."""
+        with self._lock:
+            for series in self._metrics.values():
+                series.clear()
+
+
+metrics = MetricsRegistry()
+
+
+def _request_trace(context) -> RequestTrace:
+    # requests we make pass their own trace. Any other request through our sessions gets one here.
+    request = context.trace_request_ctx
+    if isinstance(request, RequestTrace):
+        return request
+    return getattr(context, "request", None)
+
+
+def aiohttp_trace_config():
+    """
+    Returns an ``aiohttp.TraceConfig`` that fills in the :class:`RequestTrace` given as ``trace_request_ctx``.
+
+    Requests made without one are traced too, but they finish when their headers arrive, as aiohttp has no
+    hook for when a body has been read.
+    """
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        if not isinstance(context.trace_request_ctx, RequestTrace):
+            context.request = RequestTrace(params.method, str(params.url))
+
+    async def on_dns_start(session, context, params):
+        _request_trace(context)._start("dns")
+
+    async def on_dns_end(session, context, params):
+        _request_trace(context)._end("dns")
+
+    async def on_connection_start(session, context, params):
+        _request_trace(context)._start("connect")
+
+    async def on_connection_end(session, context, params):
+        _request_trace(context)._end("connect")
+
+    async def on_connection_reused(session, context, params):
+        _request_trace(context).reused = True
+
+    async def on_chunk_sent(session, context, params):
+        _request_trace(context).bytes_sent += len(params.chunk)
+
+    async def on_chunk_received(session, context, params):
+        _request_trace(context).bytes_received += len(params.chunk)
+
+    async def on_request_end(session, context, params):
+        request = _request_trace(context)
+        request.status = params.response.status
+        request.ttfb = time.perf_counter() - request.started
+        if request is not context.trace_request_ctx:
+            request.finish()
+
+    async def on_request_exception(session, context, params):
+        request = _request_trace(context)
+        request.error = type(params.exception).__name__
+        if request is not context.trace_request_ctx:
+            request.finish()
+
+    config = aiohttp.TraceConfig(trace_config_ctx_factory=lambda trace_request_ctx=None: SimpleNamespace(
+        trace_request_ctx=trace_request_ctx, request=None
+    ))
+    config.on_request_start.append(on_request_start)
+    config.on_dns_resolvehost_start.append(on_dns_start)
+    config.on_dns_resolvehost_end.append(on_dns_end)
+    config.on_connection_create_start.append(on_connection_start)
+    config.on_connection_create_end.append(on_connection_end)
+    config.on_connection_reuseconn.append(on_connection_reused)
+    config.on_request_chunk_sent.append(on_chunk_sent)
+    config.on_response_chunk_received.append(on_chunk_received)
+    config.on_request_end.append(on_request_end)
+    config.on_request_exception.append(on_request_exception)
+    return config
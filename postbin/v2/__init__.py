@@ -1,8 +1,20 @@
 import asyncio
+import codecs
+import gzip
 import logging
+import os
+import time
+import typing
+from collections import OrderedDict, deque
 
-import aiohttp
-
+from postbin import aiohttp, capabilities, health, ratelimit, tracing, _split_key
+from postbin.cache import DocumentCache, NOT_FOUND
+from postbin.compression import ACCEPT_ENCODING, CompressionPolicy, DecodedStream
+from postbin.dedupe import DedupeCache
+from postbin.hedge import HedgePolicy
+from postbin.payload import Payload, preview, size_of
+from postbin.retry import RetryPolicy, RetryState, start as retry_start
+from postbin.spool import Spool
 from postbin.v2 import errors
 from postbin.v2.errors import FailedTest, HTTPException
 
@@ -18,6 +30,46 @@ _FALLBACKS = [
     "https://hst.sh",
     "https://hasteb.in"
 ]
+# raw documents are decoded by DecodedStream (they are requested with auto_decompress=False), to count the bytes saved.
+_RAW_HEADERS = {**_HEADERS, "Accept-Encoding": ACCEPT_ENCODING}
+_MAX_LENGTH = 400_000  # the default document size limit of haste-server, in characters.
+_CHUNKED_HEADER = "postbin-chunked-document/1\n"
+
+
+def _split_text(text: str, limit: int) -> list:
+    """Splits text into parts of at most :param:`limit` characters, on line boundaries where possible."""
+    parts, current, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        if size + len(line) > limit and current:
+            parts.append("".join(current))
+            current, size = [], 0
+        while len(line) > limit:  # a single line longer than the limit has to be cut.
+            parts.append(line[:limit])
+            line = line[limit:]
+        if line:
+            current.append(line)
+            size += len(line)
+    if current:
+        parts.append("".join(current))
+    return parts
+
+
+def _part_urls(index: str, host: str) -> list:
+    """
+    The URLs of the parts a chunked document's index lists.
+
+    Anyone can post an index, so parts are only fetched from the index's own host or a fallback, never from
+    whatever host the index names.
+
+    :raise IncompleteDocument: a part isn't on a host parts may be fetched from.
+    """
+    allowed = {_URL.lower() for _URL in _FALLBACKS} | {host.rstrip("/").lower()}
+    part_urls = index[len(_CHUNKED_HEADER):].split()
+    for part_url in part_urls:
+        if "/" not in part_url or part_url.rsplit("/", 1)[0].rstrip("/").lower() not in allowed:
+            raise errors.IncompleteDocument(None, message="Refusing to fetch part %s, which isn't on %s or a "
+                                                          "fallback." % (part_url, host))
+    return part_urls
 
 
 class ConfigOptions:
@@ -26,6 +78,11 @@ class ConfigOptions:
         self.test_urls_first = kwargs.pop("test_urls_first", False)
         self.return_full_url = kwargs.pop("return_full_url", True)
         self.ignore_http_errors = kwargs.pop("ignore_http_errors", False)
+        self.race_fallbacks = kwargs.pop("race_fallbacks", False)
+        self.probe_concurrency = kwargs.pop("probe_concurrency", None)
+        self.probe_deadline = kwargs.pop("probe_deadline", None)
+        self.chunked = kwargs.pop("chunked", False)
+        self.chunk_size = kwargs.pop("chunk_size", _MAX_LENGTH)
 
 
 class AsyncHaste:
@@ -33,47 +90,181 @@ class AsyncHaste:
     Haste operations, centralised.
 
     All methods of this class, that need to be, are async.
+
+    The class owns one long-lived session (and connection pool), so connections are kept alive between posts.
+    Use it as an async context manager (``async with AsyncHaste() as paster:``) or call :meth:`close` when done.
     """
-    def __init__(self, t: str = None, session: aiohttp.ClientSession = None):
-        """Creates the class. You shouldn't provide arguments (other than [t]ext)"""
+    def __init__(self, t: str = None, session: "aiohttp.ClientSession" = None, *, limit: int = 100,
+                 limit_per_host: int = 10, keepalive_timeout: float = 30.0, ttl_dns_cache: int = 300,
+                 prewarm: list = None, dedupe: DedupeCache = None, cache: DocumentCache = None,
+                 retry_policy: RetryPolicy = None, hedge: HedgePolicy = None, spool: Spool = None,
+                 compression: CompressionPolicy = None):
+        """
+        Creates the class. You shouldn't provide arguments (other than [t]ext)
+
+        :param t: The text to post by default.
+        :param session: A session to use instead of the one the class would create. It will not be closed by us.
+        :param limit: The maximum number of open connections in total.
+        :param limit_per_host: The maximum number of open connections to a single host.
+        :param keepalive_timeout: How long (in seconds) to keep an idle connection open for re-use.
+        :param ttl_dns_cache: How long (in seconds) to cache DNS lookups for.
+        :param prewarm: Base URLs to open connections to when entering the context manager.
+        :param dedupe: A cache of content already posted. If given, posting the same content twice returns the
+            first URL (without any network I/O), and concurrent posts of the same content are only uploaded once.
+        :param cache: A cache of fetched documents. If given, :meth:`raw` (and friends) read through it, so a
+            document is only ever downloaded once.
+        :param retry_policy: How many attempts (in total and per host) a post may make. Defaults to
+            ``RetryPolicy(deadline=timeout)`` for each post, so ``timeout`` bounds the whole post.
+        :param hedge: If given, posts and raw lookups to url="auto" that are slow to answer are also sent to the
+            next healthy host, and the first answer wins. Off by default.
+        :param spool: A :class:`postbin.spool.Spool` to write posts to when no host can take them (every host is
+            offline, timing out or failing with a 5xx). :meth:`post` then returns a :class:`postbin.spool.Ticket`
+            instead of raising.
+        :param compression: If given, posts are gzipped (see :class:`postbin.compression.CompressionPolicy`) to
+            hosts that decode gzipped bodies. A host that isn't known to (or known not to) is sent a small gzipped
+            probe document first, which is read back to check it was decoded. Off by default.
+        """
         self.text = t
         self.session = session
+        self._owns_session = session is None
+        self.connector_options = {
+            "limit": limit,
+            "limit_per_host": limit_per_host,
+            "keepalive_timeout": keepalive_timeout,
+            "ttl_dns_cache": ttl_dns_cache,
+        }
+        self.prewarm_urls = prewarm or []
+        self.dedupe = dedupe
+        self.cache = cache
+        self.retry_policy = retry_policy
+        self.hedge = hedge
+        self.spool = spool
+        self.compression = compression
+        self.max_rate_limited_retries = 5
+        self.key_hosts = OrderedDict()  # key -> the host it was last found on, most recent last.
+        self._raw_in_flight = {}  # (host, key, encoding, concurrent, reassemble) -> the task downloading it.
+        self._gzip_probes = {}  # host -> the task finding out whether it decodes gzipped bodies.
+        self.max_remembered_keys = 4096
 
-    async def find_working_fallback(self, retries_per_url: int = 3):
-        for url in _FALLBACKS:
-            try:
-                await self._head(url)
-            except aiohttp.ClientResponseError:
-                continue
-            else:
+    async def __aenter__(self):
+        await self._get_session()
+        if self.prewarm_urls:
+            await self.prewarm(self.prewarm_urls)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """Closes the session (and with it, every pooled connection) if this class created it."""
+        if self._owns_session and self.session and not self.session.closed:
+            await self.session.close()
+
+    async def prewarm(self, urls: list = None):
+        """
+        Opens a connection to each URL ahead of time, so the first post to them skips the TCP and TLS handshake.
+
+        :param urls: The base URLs to connect to. Defaults to every fallback.
+        :return: a dict of URL to whether the connection succeeded.
+        """
+        urls = urls or _FALLBACKS
+        results = await asyncio.gather(*(self._head(url, 0) for url in urls))
+        return {url: result is True for url, result in zip(urls, results)}
+
+    async def find_working_fallback(self, retries_per_url: int = 3, *, concurrent: bool = False,
+                                    max_concurrency: int = None, deadline: float = None, exclude: list = ()):
+        """
+        Finds the first fallback URL that responds to a HEAD (or GET) request.
+
+        :param retries_per_url: How many times to retry each URL before moving on.
+        :param concurrent: If True, probe every fallback at once and return the first one to answer.
+        :param max_concurrency: The maximum number of probes in flight at once. Defaults to all of them.
+        :param deadline: How long (in seconds) to look for a working URL before giving up. Defaults to no limit.
+        :param exclude: URLs not to return, even if they work.
+        :return: the working URL.
+        :raise ConnectionError: no URL could be contacted (or the deadline was hit).
+        """
+        urls = [url for url in _FALLBACKS if url not in exclude]
+        healthy = health.registry.healthy(urls)
+        if healthy:
+            return healthy[0]
+        candidates = health.registry.candidates(urls)
+        if not candidates:
+            raise ConnectionError("Every fallback is marked offline. Are you sure you're online?")
+        if concurrent:
+            return await self._race_fallbacks(candidates, retries_per_url, max_concurrency, deadline)
+        try:
+            return await asyncio.wait_for(self._first_fallback(candidates, retries_per_url), timeout=deadline)
+        except asyncio.TimeoutError:
+            raise ConnectionError("Unable to find a working URL within %s seconds." % deadline)
+
+    async def _first_fallback(self, urls, retries_per_url):
+        for url in urls:
+            if health.registry.allow(url) and await self._head(url, retries_per_url) is True:
                 return url
         raise ConnectionError("Unable to connect anywhere. Are you sure you're online?")
 
-    async def _get_session(self) -> aiohttp.ClientSession:
+    async def _race_fallbacks(self, urls, retries_per_url, max_concurrency=None, deadline=None):
+        semaphore = asyncio.Semaphore(max_concurrency or len(urls))
+
+        async def probe(url):
+            async with semaphore:
+                if not health.registry.allow(url):
+                    return None  # another caller is already probing it.
+                return url if await self._head(url, retries_per_url) is True else None
+
+        loop = asyncio.get_event_loop()
+        end = loop.time() + deadline if deadline is not None else None
+        # tasks are created in priority order, so a limited fan-out still tries the preferred hosts first.
+        pending = {asyncio.ensure_future(probe(url)) for url in urls}
+        try:
+            while pending:
+                timeout = None if end is None else max(0, end - loop.time())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise ConnectionError("Unable to find a working URL within %s seconds." % deadline)
+                for task in done:
+                    if not task.cancelled() and task.exception() is None and task.result():
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise ConnectionError("Unable to connect anywhere. Are you sure you're online?")
+
+    async def _get_session(self) -> "aiohttp.ClientSession":
         if not self.session or self.session.closed:
-            self.session = aiohttp.ClientSession()
+            connector = aiohttp.TCPConnector(**self.connector_options)
+            self.session = aiohttp.ClientSession(connector=connector, trace_configs=[tracing.aiohttp_trace_config()])
+            self._owns_session = True
         return self.session
 
     async def _head(self, url, retries=3):
         last_response = None
         for i in range(retries+1):
             try:
-                async with await self._get_session() as session:
-                    async with session.head(url) as response:
-                        # some services may not support HEAD requests,so we can just GET if not.
-                        # We never download the content anyway, its more saving the server's bandwidth.
-                        # Because we're not assholes.
-                        if response.status == 405:
-                            async with session.get(url) as embedded_response:
-                                last_response = embedded_response
-                                response.raise_for_status()
-                                return True
-                        else:
-                            last_response = response
-                            response.raise_for_status()
+                # The session is shared between concurrent probes, so it must not be closed here.
+                session = await self._get_session()
+                sent = time.monotonic()
+                head = capabilities.registry.get(url).head
+                async with (session.head(url) if head else session.get(url)) as response:
+                    # some services may not support HEAD requests,so we can just GET if not.
+                    # We never download the content anyway, its more saving the server's bandwidth.
+                    # Because we're not assholes.
+                    if response.status == 405 and head:
+                        capabilities.registry.record_no_head(url)
+                        async with session.get(url) as embedded_response:
+                            last_response = embedded_response
+                            embedded_response.raise_for_status()
+                            health.registry.record_success(url, latency=time.monotonic() - sent)
                             return True
+                    else:
+                        last_response = response
+                        response.raise_for_status()
+                        health.registry.record_success(url, latency=time.monotonic() - sent)
+                        return True
             except (aiohttp.ClientError, ConnectionError):
                 continue
+        health.registry.record_failure(url, offline=last_response is None)
         return last_response
 
     def __del__(self):
@@ -81,116 +272,829 @@ class AsyncHaste:
 
     def close_session(self):
         """
-        Simple method that performs cleanup of the class.
+        Simple method that performs cleanup of the class, from sync code (or any thread).
 
         This is called automatically by garbage collection (__del__)
 
-        :return: Optional[asyncio.Task] - if task is provided, it is closing the aiohttp session.
+        :return: Optional[Union[asyncio.Task, concurrent.futures.Future]] - if given, it is closing the aiohttp
+            session (on the session's own loop, which is running elsewhere).
         """
-        if not hasattr(self, "session") or not self.session or self.session.closed:
+        if not getattr(self, "_owns_session", False) or not self.session or self.session.closed:
             return
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
+        # the session can only be closed on the loop it was created on, which isn't always the current one.
+        loop = getattr(self.session, "_loop", None)
+        if loop is None or loop.is_closed():
+            return  # nothing can run the close any more; aiohttp warns about the unclosed session.
+        # asyncio.get_running_loop() is new in Python 3.7.
+        running = asyncio._get_running_loop()
+        if running is loop:
             return loop.create_task(self.session.close(), name="PostBin cleanup task")
-        loop.run_until_complete(self.session.close())  # this could cause issues with other async apps
-        # if the edge-case where it tries to do the same as us
-        # but we got the loop first
-        return
+        if loop.is_running():
+            return asyncio.run_coroutine_threadsafe(self.session.close(), loop)
+        if running is not None:
+            # another loop is running on this thread, so the session's can't be run until it stops.
+            return
+        loop.run_until_complete(self.session.close())
 
     async def _post(self, url, text, **kwargs):
+        payload = Payload.wrap(text)
+        base = url[:-len("/documents")]
+        limiter = ratelimit.scheduler.limiter(url)
         try:
-            async with await self._get_session() as session:
-                async with session.post(url,data=text, **kwargs) as response:
-                    retry_after = response.headers.get("retry_after") or response.headers.get("x-retry-after")
-                    if response.status == 429 and retry_after:
-                        await asyncio.sleep(float(retry_after))
-                        return await self._post(url, text, **kwargs)
-                    if response.status == 400:
-                        data = await response.json()
-                        if data["message"].lower() == "document exceeds maximum length.":
-                            raise errors.TextTooLarge(response, message=data["message"] + "\nText: " + text)
-                    elif response.status == 413:
-                        raise errors.TextTooLarge(response, message="Text: " + text)
-                    if response.status not in [200, 201]:  # removed 202: That is processing, not complete.
-                        raise HTTPException(response)
-                    return (await response.json())["key"]
+            session = await self._get_session()
+            gzipped = await self._gzipped(base, payload)
+            for _ in range(self.max_rate_limited_retries + 1):
+                await limiter.acquire()
+                data, options = payload.for_aiohttp(), kwargs
+                if gzipped is not None:
+                    data = gzipped
+                    options = {**kwargs, "headers": {**kwargs.get("headers", {}), "Content-Encoding": "gzip"}}
+                with tracing.trace("POST", url) as trace:
+                    if gzipped is not None:
+                        trace.saved_sent = payload.size - len(gzipped)
+                    async with session.post(url, data=data, trace_request_ctx=trace, **options) as response:
+                        trace.status = response.status
+                        if response.status == 429:
+                            # every request to this host now queues behind the cooldown, including our retry.
+                            limiter.record_limited(response.headers)
+                            if not payload.replayable:
+                                # a one-shot stream was used up by this attempt, so it can't be sent again.
+                                raise errors.RateLimitedError(response, message="Rate limited, and the payload "
+                                                                                "can't be sent again.")
+                            continue
+                        too_large = response.status == 413
+                        if response.status == 400 and response.content_type == "application/json":
+                            message = (await response.json()).get("message", "")
+                            too_large = message.lower() == "document exceeds maximum length."
+                        if too_large:
+                            capabilities.registry.record_too_large(base, payload.size)
+                            raise errors.TextTooLarge(response, size=payload.size, preview=payload.preview())
+                        if gzipped is not None and response.status in (400, 415):
+                            capabilities.registry.record_gzip(base, False)
+                            gzipped = None
+                            continue  # the host doesn't take gzipped bodies, so send it as it is.
+                        if response.status not in [200, 201]:  # removed 202: That is processing, not complete.
+                            raise HTTPException(response)
+                        limiter.record_success(response.headers)
+                        capabilities.registry.record_accepted(base, payload.size)
+                        if capabilities.registry.get(base).format == "text":
+                            return (await response.text()).strip().rsplit("/", 1)[-1]
+                        return (await response.json())["key"]
+            raise errors.RateLimitedError(response, message="Still rate limited after %d retries."
+                                                            % self.max_rate_limited_retries)
         except (aiohttp.ServerDisconnectedError, aiohttp.ClientConnectorError, aiohttp.ClientOSError) as e:
             raise errors.OfflineServer(None, message="Exception while connecting - assuming dead host.") from e
 
+    async def _gzipped(self, base: str, payload: Payload):
+        """Returns the payload gzipped, if compression is on and the host decodes gzipped bodies, otherwise None."""
+        policy = self.compression
+        if policy is None or not payload.in_memory or not policy.wants(payload.size):
+            return None
+        accepts = capabilities.registry.get(base).gzip
+        if accepts is None:
+            accepts = await self._probe_gzip(base)
+        return await policy.compress_async(payload.body) if accepts else None
+
+    async def _probe_gzip(self, base: str) -> bool:
+        """Finds out whether a host decodes gzipped bodies. Concurrent posts to the same host share one probe."""
+        task = self._gzip_probes.get(base)
+        if task is None:
+            task = self._gzip_probes[base] = asyncio.ensure_future(self._run_gzip_probe(base))
+            task.add_done_callback(lambda _: self._gzip_probes.pop(base, None))
+        return await asyncio.shield(task)
+
+    async def _run_gzip_probe(self, base: str) -> bool:
+        # a host that ignores Content-Encoding stores the gzipped bytes as they are, and still answers 200, so
+        # the only way to tell is to read the probe back.
+        probe = "PostBin gzip probe %r" % time.time()
+        session = await self._get_session()
+        try:
+            with tracing.trace("POST", base + "/documents") as trace:
+                async with session.post(base + "/documents", data=gzip.compress(probe.encode()),
+                                        headers={**_HEADERS, "Content-Encoding": "gzip"},
+                                        trace_request_ctx=trace) as response:
+                    trace.status = response.status
+                    if response.status >= 500 or response.status == 429:
+                        return False  # not an answer about gzip, so nothing is recorded.
+                    key = (await response.json())["key"] if response.status in (200, 201) else None
+            accepted = key is not None and await self._get_raw(base, key, check_cache=False) == probe
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError):
+            return False
+        capabilities.registry.record_gzip(base, accepted)
+        return accepted
+
     async def post(self, text: str = None, config: ConfigOptions = ConfigOptions(), *, timeout: float = 30.0,
-                   retries: int = 3, url: str = "auto"):
+                   retries: int = 3, url: str = "auto", retry_policy: typing.Union[RetryPolicy, RetryState] = None):
         """
         Creates a haste URL, returning the URL of the new haste.
 
-        :param text: The text to post. Defaults to the text provided/set in self.__init__.
-        :param config: The configuration.
-        :param timeout: After how long to stop trying to post to a certain URL, and find a fallback.
-        :param retries: How many times to attempt to post to the current URL before finding a fallback.
+        :param text: The text to post. Defaults to the text provided/set in self.__init__. Bytes, memoryviews,
+            paths, file objects and (async) iterators of chunks are streamed instead of being read into memory.
+        :param config: The configuration. If ``config.chunked`` is set, text longer than ``config.chunk_size`` is
+            posted in parts, plus an index document that ``raw(..., reassemble=True)`` reassembles.
+        :param timeout: How long (in seconds) the whole post may take, including finding a fallback and retrying.
+            Ignored if the retry policy has its own deadline.
+        :param retries: How many times to attempt to contact each URL when looking for a fallback.
         :param url: The BASE url to post to. If "auto" (default), this will try each url until it works.
-        :return: the completed URL or just the key if specified in Config.
+        :param retry_policy: How many attempts the post may make, in total and per host. Defaults to the class's.
+            Pass a started :class:`postbin.retry.RetryState` to read the attempts used and time spent afterwards.
+        :return: the completed URL or just the key if specified in Config. If the class has a spool and no host
+            could take the post, the :class:`postbin.spool.Ticket` it was spooled as.
         """
-        if url != "auto" and config.test_urls_first:
-            response = await self._head(url, retries)
-            if not response:
-                raise FailedTest(response)
-        elif url == "auto":
-            url = await self.find_working_fallback(retries)
+        text = text or self.text
+        policy = retry_policy or self.retry_policy
+        if isinstance(policy, RetryPolicy) and policy.deadline is None:
+            policy = policy.replace(deadline=timeout)
+        state = retry_start(policy, deadline=timeout)
+        if not isinstance(text, (str, bytes, bytearray, memoryview, Payload)):
+            # files we open have to be closed again, whatever happens to the post.
+            with Payload(text) as payload:
+                return await self.post(payload, config, timeout=timeout, retries=retries, url=url, retry_policy=state)
+        try:
+            return await self._post_deduped(text, config, retries=retries, url=url, state=state)
+        except (ConnectionError, asyncio.TimeoutError, HTTPException) as e:
+            status = getattr(e, "status", 0) or 0
+            if self.spool is None or (isinstance(text, Payload) and not text.replayable):
+                raise
+            if isinstance(e, HTTPException) and not isinstance(e, errors.OfflineServer) and status < 500:
+                raise
+            # the journal is synced to disk, which mustn't block the loop.
+            return await asyncio.get_event_loop().run_in_executor(None, self.spool.put, text, url)
+
+    async def _post_deduped(self, text, config: ConfigOptions, *, retries: int, url: str, state: RetryState):
+        key = await DedupeCache.key_async(text, url) if self.dedupe is not None else None
+        if key is None:
+            return await self._post_document(text, config, retries=retries, url=url, state=state)
+        full_config = ConfigOptions(**{**vars(config), "return_full_url": True, "ignore_http_errors": False})
+        try:
+            res = await self.dedupe.run_async(key, lambda: self._post_document(text, full_config, retries=retries,
+                                                                               url=url, state=state))
+        except Exception:
+            if config.ignore_http_errors:
+                return ""
+            raise
+        return res if config.return_full_url else res.rsplit("/", 1)[1]
+
+    async def _post_document(self, text, config: ConfigOptions, *, retries: int, url: str, state: RetryState):
+        if config.chunked and isinstance(text, str) and len(text) > config.chunk_size:
+            return await self._post_chunked(text, config, retries=retries, url=url, state=state)
         try:
-            res = await asyncio.wait_for(self._post(url + "/documents", text or self.text, headers=_HEADERS),
-                                         timeout=timeout)
-        except Exception as e:
+            self._preflight(text, url, state)
+        except errors.TextTooLarge:
             if config.ignore_http_errors:
                 return ""
-            raise e
-        return res if not config.return_full_url else url + "/" + res
+            raise
+        if url != "auto" and not health.registry.allow(url):
+            raise errors.OfflineServer(None, message=url + " recently failed and is cooling off.")
+        if url != "auto" and config.test_urls_first and not health.registry.is_healthy(url):
+            response = await self._head(url, retries)
+            if response is not True:
+                raise FailedTest(response)
+        while True:
+            target = url
+            hosts = self._hedge_hosts(text, url, state)
+            try:
+                if hosts:
+                    res, target = await asyncio.wait_for(self._hedged_post(text, hosts, state),
+                                                         timeout=state.remaining())
+                else:
+                    if url == "auto":
+                        target = await self.find_working_fallback(
+                            retries, concurrent=config.race_fallbacks, max_concurrency=config.probe_concurrency,
+                            deadline=state.remaining(config.probe_deadline), exclude=state.exhausted()
+                        )
+                    await state.wait_async(target)
+                    state.record(target)
+                    sent = time.monotonic()
+                    with tracing.attempt(state.retries(target), state.hops):
+                        res = await asyncio.wait_for(self._post(target + "/documents", text, headers=_HEADERS),
+                                                     timeout=state.remaining())
+            except Exception as e:
+                if not hosts:  # hedged posts record each host's result themselves.
+                    self._record_post_failure(target, e)
+                status = getattr(e, "status", 0) or 0
+                retryable = (hosts or target != "auto") and (
+                    isinstance(e, (errors.OfflineServer, asyncio.TimeoutError)) or status >= 500
+                )
+                if retryable and state.allows(None if url == "auto" else url):
+                    continue  # "auto" moves on to another host, as this one was just marked as failing.
+                if config.ignore_http_errors:
+                    return ""
+                raise e
+            if not hosts:
+                health.registry.record_success(target, latency=time.monotonic() - sent)
+            self._remember_host(res, target)
+            return res if not config.return_full_url else target + "/" + res
+
+    @staticmethod
+    def _preflight(text, url: str, state: RetryState):
+        """Refuses text that is larger than the host (or, for "auto", every fallback) is known to accept."""
+        size = size_of(text)
+        hosts = _FALLBACKS if url == "auto" else [url]
+        refusing = capabilities.registry.refusing(hosts, size)
+        if len(refusing) == len(hosts):
+            limit = max(capabilities.registry.get(host).max_size for host in hosts)
+            raise errors.TextTooLarge(None, size=size, limit=limit, preview=preview(text))
+        for host in refusing:
+            state.give_up(host)  # "auto" never picks (or hedges to) a fallback that would refuse it.
+
+    @staticmethod
+    def _record_post_failure(url: str, error: Exception):
+        status = getattr(error, "status", 0) or 0
+        if isinstance(error, errors.OfflineServer) or status == 503:
+            health.registry.record_failure(url, offline=True)
+        elif isinstance(error, asyncio.TimeoutError) or status >= 500:
+            health.registry.record_failure(url)
+
+    def _hedge_hosts(self, text, url: str, state: RetryState):
+        """The hosts a post may be hedged across, or None if it can't (or shouldn't) be hedged."""
+        if self.hedge is None or url != "auto":
+            return None
+        # a file or iterator can only be read by one request at a time, so only bodies in memory are hedged.
+        if not isinstance(text, (str, bytes, bytearray, memoryview)) and not (
+                isinstance(text, Payload) and text.in_memory):
+            return None
+        hosts = [host for host in health.registry.healthy(_FALLBACKS) if state.allows(host)]
+        hosts = hosts[:state.policy.max_attempts - state.attempts]
+        return hosts if len(hosts) >= 2 else None
+
+    async def _hedged_post(self, text, hosts: list, state: RetryState):
+        """Posts to the first host, hedging to the next if it is slow. Returns ``(key, host)``."""
+        async def attempt(host):
+            state.record(host)
+            sent = time.monotonic()
+            try:
+                with tracing.attempt(state.retries(host), state.hops):
+                    key = await self._post(host + "/documents", text, headers=_HEADERS)
+            except Exception as e:
+                self._record_post_failure(host, e)
+                raise
+            health.registry.record_success(host, latency=time.monotonic() - sent)
+            return key
+
+        key, host, losers = await self._hedged("post", attempt, hosts)
+        for loser, task in losers:
+            duplicate = None
+            if task.done() and not task.cancelled() and task.exception() is None:
+                duplicate = loser + "/" + task.result()
+            self.hedge.report_duplicate(host + "/" + key, duplicate, loser)
+        return key, host
+
+    async def _hedged(self, kind: str, call, urls: list):
+        """
+        Calls ``call(url)`` for each URL in turn until one returns something truthy, returning
+        ``(result, url, losers)``.
+
+        If a call takes longer than the hedge delay (and the budget allows), the next URL is called too, and the
+        first to answer wins. ``losers`` lists ``(url, task)`` for the other call, if one was still running (it is
+        cancelled) or answered at the same time. If every call fails, the last exception is raised.
+        """
+        self.hedge.earn()
+        urls = list(urls)
+        running = {}  # task -> (url, started, whether it is a hedge)
+        hedged = False
+        error = None
+        try:
+            while urls or running:
+                if not running:
+                    url = urls.pop(0)
+                    running[asyncio.ensure_future(call(url))] = (url, time.monotonic(), False)
+                    hedged = False
+                timeout = None
+                if urls and not hedged:
+                    started = min(started for _, started, _ in running.values())
+                    timeout = max(0.0, self.hedge.delay_for(kind) - (time.monotonic() - started))
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True  # whether or not the budget allows it, a request is only hedged once.
+                    if self.hedge.spend():
+                        url = urls.pop(0)
+                        running[asyncio.ensure_future(call(url))] = (url, time.monotonic(), True)
+                    continue
+                winner, losers = None, []
+                for task in done:
+                    url, started, is_hedge = running.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif task.result() and winner is None:
+                        winner = (task.result(), url, started, is_hedge)
+                    elif task.result():
+                        losers.append((url, task))
+                if winner is not None:
+                    result, url, started, is_hedge = winner
+                    self.hedge.observe(kind, time.monotonic() - started)
+                    if is_hedge:
+                        self.hedge.record_win()
+                    losers.extend((loser, task) for task, (loser, _, _) in running.items())
+                    return result, url, losers
+        finally:
+            for task in running:
+                task.cancel()
+        if error is not None:
+            raise error
+        return None, None, []
+
+    def _remember_host(self, key: str, url: str):
+        self.key_hosts[key] = url
+        self.key_hosts.move_to_end(key)
+        while len(self.key_hosts) > self.max_remembered_keys:
+            self.key_hosts.popitem(last=False)
+
+    async def _post_chunked(self, text: str, config: ConfigOptions, *, retries: int, url: str, state: RetryState):
+        """
+        Posts each part of an oversized text concurrently, then posts an index document listing the parts.
+
+        ``raw(..., reassemble=True)`` recognises the index document and reassembles the original text.
+        """
+        part_config = ConfigOptions(**{**vars(config), "chunked": False, "return_full_url": True,
+                                       "ignore_http_errors": False})
+        # every part gets its own attempts, but all of them share the deadline of the whole post.
+        part_policy = state.policy.replace(deadline=state.remaining())
+        parts = await self.post_many(_split_text(text, config.chunk_size), config=part_config, retries=retries,
+                                     url=url, retry_policy=part_policy)
+        for part in parts:
+            if isinstance(part, Exception):
+                if config.ignore_http_errors:
+                    return ""
+                raise part
+        index = _CHUNKED_HEADER + "\n".join(parts)
+        return await self.post(index, ConfigOptions(**{**vars(config), "chunked": False}), retries=retries,
+                               url=url, retry_policy=state)
+
+    async def post_iter(self, texts, *, concurrency: int = 8, config: ConfigOptions = ConfigOptions(),
+                        timeout: float = 30.0, retries: int = 3, url: str = "auto", retry_policy: RetryPolicy = None):
+        """
+        Posts many texts at once, yielding ``(index, result)`` tuples as each one completes.
+
+        At most :param:`concurrency` posts are in flight at a time, all through this class's session. If url is
+        "auto", each post picks its host (and falls back) as :meth:`post` does; to spread them across every healthy
+        host, set ``postbin.health.registry.strategy = postbin.selection.RoundRobin()``.
+        A failed post does not stop the others: its result is the exception that was raised.
+
+        :param texts: An iterable of texts to post. It is consumed lazily, so it can be a generator.
+        :param concurrency: The maximum number of posts in flight at once.
+        :param config: The configuration, applied to every post.
+        :param timeout: The timeout for each post.
+        :param retries: How many times to attempt each URL when looking for a fallback.
+        :param url: The BASE url to post to. If "auto" (default), each post tries each url until it works.
+        :param retry_policy: The retry policy of each post. Each post starts its own attempts (and deadline).
+        """
+        queue = asyncio.Queue()
+        items = enumerate(texts)
+
+        async def worker():
+            try:
+                # every worker shares one iterator, so no two workers ever post the same item.
+                for index, text in items:
+                    try:
+                        result = await self.post(text, config, timeout=timeout, retries=retries, url=url,
+                                                 retry_policy=retry_policy)
+                    except Exception as e:
+                        result = e
+                    await queue.put((index, result))
+            finally:
+                await queue.put(None)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(max(1, concurrency))]
+        running = len(workers)
+        try:
+            while running:
+                item = await queue.get()
+                if item is None:
+                    running -= 1
+                    continue
+                yield item
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def post_many(self, texts, *, concurrency: int = 8, config: ConfigOptions = ConfigOptions(),
+                        timeout: float = 30.0, retries: int = 3, url: str = "auto",
+                        retry_policy: RetryPolicy = None) -> list:
+        """
+        Posts many texts at once, returning their results in the same order as the input.
+
+        This takes the same arguments as :meth:`post_iter`. Each result is either the URL (or key) of the new
+        haste, or the exception that was raised while posting it.
+        """
+        results = {}
+        async for index, result in self.post_iter(texts, concurrency=concurrency, config=config, timeout=timeout,
+                                                  retries=retries, url=url, retry_policy=retry_policy):
+            results[index] = result
+        return [results[index] for index in range(len(results))]
 
     async def raw(self, key: str, *, url: str = "auto", timeout: float = 30.0, retries_per_url: int = 3,
-                  encoding: str = "utf-8"):
+                  encoding: str = "utf-8", concurrent: bool = False, reassemble: bool = False):
         """
         Gets the raw text of a haste.
 
         Note that the parameters are different from post, in that they apply per URL fetched (if url is auto)
+        Concurrent calls for the same haste share one download.
 
-        :param key: the key (after .tld/, e.g hastebin.com/{key})
+        :param key: the key (after .tld/, e.g hastebin.com/{key}), or the haste's full URL.
         :param url: the URL to find the haste from. if "auto" (default), will search all fallbacks for it.
         :param timeout: The timeout to request a document from the servers. If this is hit, instead of raising timeout error, just skips to the next one.
         :param retries_per_url: how may times to retry a URL (unless it returned 404). set to 0 to disable.
         :param encoding: The encoding to encode the text in. Defaults to utf-8. | Version added: 2.0.2a
+        :param concurrent: If True (and url is "auto"), ask every fallback at once and use the first to answer.
+            Either way, the host a key was found on is remembered, and asked first next time.
+        :param reassemble: If True, a haste posted in chunks (see ``ConfigOptions.chunked``) is reassembled from
+            its parts. Parts are only fetched from the index's own host or a fallback. Otherwise, the index document
+            is returned as it is.
         :return: the found text, __or None if not found__.
+        :raise IncompleteDocument: reassemble is True and the haste was posted in chunks, and some of them could not
+            be found (or aren't on a host parts may be fetched from).
+        :raise RateLimitedError: url isn't "auto", and the host was still rate limiting us after every retry.
         """
-        async def get(URL):
-            async with session.get(URL + "/raw/" + key) as response:
-                if response.status == 404:
+        url, key = _split_key(key, url)
+        flight = (url.rstrip("/").lower(), key, encoding, concurrent, reassemble)
+        task = self._raw_in_flight.get(flight)
+        if task is None:
+            task = asyncio.ensure_future(self._raw(key, url, encoding, concurrent, reassemble))
+            self._raw_in_flight[flight] = task
+            task.add_done_callback(lambda _: self._raw_in_flight.pop(flight, None))
+        # shielded, so one caller giving up doesn't cancel the download for everyone else waiting on it.
+        return await asyncio.shield(task)
+
+    async def _raw(self, key: str, url: str, encoding: str, concurrent: bool, reassemble: bool):
+        owner = url
+        if url.lower() != "auto":
+            res = await self._get_raw(url, key, encoding, raise_errors=True)
+        else:
+            res = owner = None
+            if self.cache is not None:
+                # a document found on any host will do, so every host is checked before the network is used.
+                owner, body = self.cache.find(self._search_order(key, _FALLBACKS), key)
+                if body is NOT_FOUND:
                     return None
-                if response.status == 200:
-                    return await response.text(encoding=encoding or "utf-8", errors="replace")
+                if body is not None:
+                    res = body.decode(encoding or "utf-8", errors="replace")
+            if res is None and self.hedge is not None and not concurrent:
+                # hosts are still asked one at a time, but one that is slow to answer is hedged with the next.
+                async def get(base):
+                    if not health.registry.allow(base):
+                        return None
+                    return await self._get_raw(base, key, encoding, check_cache=False)
+
+                urls = self._search_order(key, health.registry.candidates(_FALLBACKS))
+                res, owner, _ = await self._hedged("raw", get, urls)
+            elif res is None:
+                owner = self.key_hosts.get(key)
+                res = await self._get_raw(owner, key, encoding, check_cache=False) if owner else None
+                if not res and concurrent:
+                    res, owner = await self._race_raw(key, encoding)
+                elif not res:
+                    for owner in health.registry.candidates(_FALLBACKS):
+                        if not health.registry.allow(owner):
+                            continue
+                        res = await self._get_raw(owner, key, encoding, check_cache=False)
+                        if res:
+                            break
+            if not res:
+                self._record_missing(key)
+                return None
+            self._remember_host(key, owner)
+        if reassemble and res and res.startswith(_CHUNKED_HEADER):
+            return await self._join_chunks(res, owner, encoding)
+        return res
+
+    async def raw_iter(self, keys, *, concurrency: int = 8, url: str = "auto", encoding: str = "utf-8",
+                       concurrent: bool = False, reassemble: bool = False):
+        """
+        Fetches many hastes at once, yielding ``(index, result)`` tuples as each one completes.
+
+        At most :param:`concurrency` fetches are in flight at a time. The same haste asked for more than once is
+        only downloaded once. A failed fetch does not stop the others: its result is the exception that was raised.
+
+        :param keys: An iterable of keys or full haste URLs (which may be on different services). It is consumed
+            lazily, so it can be a generator.
+        :param concurrency: The maximum number of fetches in flight at once.
+        :param url: The URL to find bare keys on. If "auto" (default), every fallback is searched.
+        :param encoding: The encoding to decode the text with.
+        :param concurrent: Passed to :meth:`raw`.
+        :param reassemble: Passed to :meth:`raw`.
+        """
+        queue = asyncio.Queue()
+        items = enumerate(keys)
+
+        async def worker():
+            try:
+                for index, key in items:
+                    try:
+                        result = await self.raw(key, url=url, encoding=encoding, concurrent=concurrent,
+                                                reassemble=reassemble)
+                    except Exception as e:
+                        result = e
+                    await queue.put((index, result))
+            finally:
+                await queue.put(None)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(max(1, concurrency))]
+        running = len(workers)
+        try:
+            while running:
+                item = await queue.get()
+                if item is None:
+                    running -= 1
+                    continue
+                yield item
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def raw_many(self, keys, *, concurrency: int = 8, url: str = "auto", encoding: str = "utf-8",
+                       concurrent: bool = False, reassemble: bool = False) -> list:
+        """
+        Fetches many hastes at once, returning their results in the same order as the input.
+
+        This takes the same arguments as :meth:`raw_iter`. Each result is the haste's text, None if it wasn't
+        found, or the exception that was raised while fetching it.
+        """
+        results = {}
+        async for index, result in self.raw_iter(keys, concurrency=concurrency, url=url, encoding=encoding,
+                                                 concurrent=concurrent, reassemble=reassemble):
+            results[index] = result
+        return [results[index] for index in range(len(results))]
+
+    async def _race_raw(self, key: str, encoding: str = "utf-8"):
+        """Asks every fallback for a haste at once, returning ``(text, url)`` from the first that has it."""
+        tasks = {asyncio.ensure_future(self._get_raw(_URL, key, encoding, check_cache=False)): _URL
+                 for _URL in health.registry.candidates(_FALLBACKS) if health.registry.allow(_URL)}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.cancelled() and task.exception() is None and task.result():
+                        return task.result(), tasks[task]
+        finally:
+            for task in pending:
+                task.cancel()
+        return None, None
+
+    def _search_order(self, key: str, urls: list) -> list:
+        """Puts the host a key is known to be on (if any) first."""
+        owner = self.key_hosts.get(key)
+        if not owner:
+            return list(urls)
+        return [owner] + [_URL for _URL in urls if _URL != owner]
 
+    async def _get_raw(self, url: str, key: str, encoding: str = "utf-8", raise_errors: bool = False,
+                       check_cache: bool = True):
+        if self.cache is not None and check_cache:
+            body = self.cache.get(url, key)
+            if body is NOT_FOUND:
+                return None
+            if body is not None:
+                return body.decode(encoding or "utf-8", errors="replace")
         session = await self._get_session()
-        if url.lower() == "auto":
-            for _URL in _FALLBACKS:
-                res = await get(_URL)
-                if res:
-                    return res
-            return None
-        return await get(url + "/raw/" + key)
+        limiter = ratelimit.scheduler.limiter(url)
+        raw_url = url + capabilities.registry.get(url).raw_path + key
+        try:
+            for _ in range(self.max_rate_limited_retries + 1):
+                await limiter.acquire()
+                sent = time.monotonic()
+                with tracing.trace("GET", raw_url) as trace:
+                    async with session.get(raw_url, headers=_RAW_HEADERS, auto_decompress=False,
+                                           trace_request_ctx=trace) as response:
+                        trace.status = response.status
+                        if response.status == 429:
+                            limiter.record_limited(response.headers)
+                            continue
+                        if response.status >= 500:
+                            health.registry.record_failure(url, offline=response.status == 503)
+                            return None
+                        health.registry.record_success(url, latency=time.monotonic() - sent)
+                        if response.status == 404:
+                            if self.cache is not None:
+                                self.cache.put_missing(url, key)
+                            return None
+                        if response.status == 200:
+                            limiter.record_success(response.headers)
+                            stream = DecodedStream(response.content, response.headers.get("Content-Encoding"))
+                            body = await stream.read()
+                            # the body is read from response.content, which (unlike read()) isn't traced.
+                            trace.bytes_received += stream.received
+                            trace.saved_received = stream.saved
+                            if self.cache is not None:
+                                self.cache.put(url, key, body)
+                            return body.decode(encoding or "utf-8", errors="replace")
+                        return None
+            if raise_errors:
+                raise errors.RateLimitedError(response, message="Still rate limited after %d retries."
+                                                                % self.max_rate_limited_retries)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            health.registry.record_failure(url, offline=True)
+            if raise_errors:
+                raise
+
+    async def iter_raw(self, key: str, *, url: str = "auto", chunk_size: int = 2 ** 16, encoding: str = None,
+                       reassemble: bool = False):
+        """
+        Streams the raw content of a haste, without holding all of it in memory.
+
+        Hosts are searched the same way as :meth:`raw`. With :param:`reassemble`, chunked documents are streamed
+        part by part (see :meth:`raw`).
+
+        :param key: the key (after .tld/, e.g hastebin.com/{key})
+        :param url: the URL to find the haste from. if "auto" (default), will search all fallbacks for it.
+        :param chunk_size: the maximum size of each chunk, in bytes.
+        :param encoding: if given, chunks are decoded (incrementally) and yielded as str instead of bytes.
+        :param reassemble: whether to reassemble a haste posted in chunks, as :meth:`raw` does.
+        :raise NotFound: no host had the haste.
+        :raise RateLimitedError: a host that may have had the haste was still rate limiting us after every retry.
+        :raise IncompleteDocument: reassemble is True and the haste was posted in chunks, and some of them could not
+            be found (or aren't on a host parts may be fetched from).
+        """
+        decoder = codecs.getincrementaldecoder(encoding)(errors="replace") if encoding else None
+        async for chunk in self._iter_raw_bytes(key, url, chunk_size, reassemble):
+            if decoder is None:
+                yield chunk
+                continue
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        if decoder is not None:
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                yield tail
+
+    async def _iter_raw_bytes(self, key: str, url: str, chunk_size: int, reassemble: bool = False):
+        session = await self._get_session()
+        # an empty header never matches, so documents are streamed as they are unless they should be reassembled.
+        header = _CHUNKED_HEADER.encode() if reassemble else b""
+        auto = url.lower() == "auto"
+        if self.cache is not None:
+            owner = url
+            if auto:
+                owner, body = self.cache.find(self._search_order(key, _FALLBACKS), key)
+            else:
+                body = self.cache.get(url, key)
+            if body is NOT_FOUND:
+                raise errors.NotFound(None, message="Unable to find a haste with the key " + key)
+            if body is not None:
+                if header and body.startswith(header):
+                    async for chunk in self._iter_chunks(body.decode(), owner, chunk_size):
+                        yield chunk
+                    return
+                for start in range(0, len(body), chunk_size):
+                    yield body[start:start + chunk_size]
+                return
+        urls = deque(self._search_order(key, health.registry.candidates(_FALLBACKS)) if auto else [url])
+        limited, last_limited = {}, None  # host -> how many times it answered 429, and the last such response.
+        while urls:
+            base = urls.popleft()
+            if auto and base not in limited and not health.registry.allow(base):
+                continue  # another caller is already probing it (a host that answered 429 was let through).
+            limiter = ratelimit.scheduler.limiter(base)
+            try:
+                await limiter.acquire()
+                sent = time.monotonic()
+                raw_url = base + capabilities.registry.get(base).raw_path + key
+                with tracing.trace("GET", raw_url) as trace:
+                    async with session.get(raw_url, headers=_RAW_HEADERS, auto_decompress=False,
+                                           trace_request_ctx=trace) as response:
+                        trace.status = response.status
+                        if response.status == 429:
+                            limiter.record_limited(response.headers)
+                            limited[base], last_limited = limited.get(base, 0) + 1, response
+                            if limited[base] <= self.max_rate_limited_retries:
+                                urls.appendleft(base)  # asked again once the limiter lets us.
+                            continue
+                        if response.status >= 500:
+                            health.registry.record_failure(base, offline=response.status == 503)
+                            continue
+                        health.registry.record_success(base, latency=time.monotonic() - sent)
+                        if response.status == 404 and self.cache is not None:
+                            self.cache.put_missing(base, key)
+                        if response.status != 200:
+                            continue
+                        if auto:
+                            self._remember_host(key, base)
+                        stream = DecodedStream(response.content, response.headers.get("Content-Encoding"),
+                                               chunk_size)
+                        # peek at the start of the body, to tell whether this is a chunked document's index.
+                        first = b""
+                        while len(first) < len(header):
+                            data = await stream.read(len(header) - len(first))
+                            if not data:
+                                break
+                            first += data
+                        if header and first == header:
+                            index = await stream.read()
+                            trace.bytes_received += stream.received
+                            trace.saved_received = stream.saved
+                            if self.cache is not None:
+                                self.cache.put(base, key, first + index)
+                            async for chunk in self._iter_chunks((first + index).decode(), base, chunk_size):
+                                yield chunk
+                            return
+                        # the body is only kept (to be cached) while it is small enough to be cached.
+                        kept, size = ([] if self.cache is not None else None), 0
+                        if first:
+                            kept, size = self._keep(kept, size, first)
+                            yield first
+                        async for chunk in stream.iter_chunked(chunk_size):
+                            kept, size = self._keep(kept, size, chunk)
+                            yield chunk
+                        trace.bytes_received += stream.received
+                        trace.saved_received = stream.saved
+                        if kept is not None:
+                            self.cache.put(base, key, b"".join(kept))
+                        return
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                health.registry.record_failure(base, offline=True)
+                if not auto:
+                    raise
+        if any(count > self.max_rate_limited_retries for count in limited.values()):
+            # a host that kept rate limiting us may well have had it, so it isn't reported (or cached) as missing.
+            raise errors.RateLimitedError(last_limited, message="Still rate limited after %d retries."
+                                                                % self.max_rate_limited_retries)
+        if auto:
+            self._record_missing(key)
+        raise errors.NotFound(None, message="Unable to find a haste with the key " + key)
+
+    def _record_missing(self, key: str):
+        """
+        Remembers a haste as missing from every host, once each fallback has answered 404 for it. A host that
+        failed (or was skipped) may still have it, so the search isn't skipped for it.
+        """
+        if self.cache is not None and all(self.cache.is_missing(_URL, key) for _URL in _FALLBACKS):
+            self.cache.put_missing("*", key)
+
+    def _keep(self, kept, size: int, chunk: bytes):
+        if kept is None or size + len(chunk) > self.cache.max_item_bytes:
+            return None, size
+        kept.append(chunk)
+        return kept, size + len(chunk)
+
+    async def _iter_chunks(self, index: str, host: str, chunk_size: int):
+        for part_url in _part_urls(index, host):
+            part_base, part_key = part_url.rsplit("/", 1)
+            try:
+                async for chunk in self._iter_raw_bytes(part_key, part_base, chunk_size):
+                    yield chunk
+            except errors.NotFound:
+                raise errors.IncompleteDocument(None, message="Unable to fetch part " + part_url)
+
+    async def raw_to_file(self, key: str, path, *, url: str = "auto", chunk_size: int = 2 ** 16,
+                          reassemble: bool = False) -> int:
+        """
+        Downloads the raw content of a haste straight to a file, without holding all of it in memory.
+
+        The file is only created once the download completes, so a failed download leaves nothing behind.
+
+        :param key: the key (after .tld/, e.g hastebin.com/{key})
+        :param path: the path of the file to write.
+        :param url: the URL to find the haste from. if "auto" (default), will search all fallbacks for it.
+        :param chunk_size: the maximum size of each chunk, in bytes.
+        :param reassemble: whether to reassemble a haste posted in chunks, as :meth:`raw` does.
+        :return: the number of bytes written.
+        :raise NotFound: no host had the haste.
+        """
+        loop = asyncio.get_event_loop()
+        temp = os.fspath(path) + ".part"
+        written = 0
+        try:
+            with open(temp, "wb") as wfile:
+                async for chunk in self.iter_raw(key, url=url, chunk_size=chunk_size, reassemble=reassemble):
+                    await loop.run_in_executor(None, wfile.write, chunk)
+                    written += len(chunk)
+            os.replace(temp, path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        return written
+
+    async def _join_chunks(self, index: str, host: str, encoding: str = "utf-8") -> str:
+        """Fetches every part listed in a chunked index document in parallel, and joins them back together."""
+        part_urls = _part_urls(index, host)
+        parts = await asyncio.gather(*(self._get_raw(*part_url.rsplit("/", 1), encoding=encoding)
+                                       for part_url in part_urls))
+        missing = [part_url for part_url, part in zip(part_urls, parts) if part is None]
+        if missing:
+            raise errors.IncompleteDocument(None, message="Unable to fetch part(s) " + ", ".join(missing))
+        return "".join(parts)
 
 
 async def postAsync(text: str, *, url: str = "auto", config: ConfigOptions = ConfigOptions(), timeout: float = 30.0,
                     retries: int = 3):
     """Alias function for AsyncHaste().post(...)"""
-    return await AsyncHaste().post(text, url=url, config=config, timeout=timeout, retries=retries)
+    async with AsyncHaste() as paster:
+        return await paster.post(text, url=url, config=config, timeout=timeout, retries=retries)
 
 
 def postSync(text: str, *, url: str = "auto", config: ConfigOptions = ConfigOptions(), timeout: float = 30.0,
              retries: int = 3):
     """
-    Alias function for SyncHaste().post(...).
+    Alias function for AsyncHaste().post(...), for sync code.
 
-    WARNING! This relies on the asyncio event loop NOT being in use. If it is, this returns an asyncio.Task
+    The post runs on a shared background event loop (see :class:`postbin.v2.runner.ThreadedHaste`), so this can be
+    called from any thread, every call shares one connection pool, and it always returns the URL. From async code,
+    await :func:`postAsync` instead: this blocks the calling thread (and with it, any loop running on it).
     """
-    paster = AsyncHaste(text)
-    f = paster.post(None, config, timeout=timeout, retries=retries, url=url)
-    loop = asyncio.get_event_loop()
-    if loop.is_running():
-        return loop.create_task(f, name="Paste-" + str(id(paster)))
-    return loop.run_until_complete(f)
+    return ThreadedHaste.default().post(text, config, url=url, timeout=timeout, retries=retries)
+
+
+from postbin.v2.runner import LoopRunner, ThreadedHaste  # noqa: E402 (needs AsyncHaste)
@@ -1,14 +1,9 @@
-from typing import Union
-try:
-    from requests import Response
-except ImportError:
-    Response = None
-
-try:
-    from aiohttp import ClientResponse
-except ImportError:
-    ClientResponse = None
-#
+from typing import TYPE_CHECKING, Union
+
+if TYPE_CHECKING:  # imported for the annotations only; requests and aiohttp are imported on first use.
+    import aiohttp
+    import requests
+
 
 class HTTPException(Exception):
     """
@@ -19,7 +14,7 @@ class HTTPException(Exception):
         message - Optional[str]: A custom message as to why the error was raised.
         status - int: The resolved status (so you don't have to dig between the two classes)
     """
-    def __init__(self, response: Union[Response, None, ClientResponse], *args, message: str = None, **kwargs):
+    def __init__(self, response: Union["requests.Response", None, "aiohttp.ClientResponse"], *args, message: str = None, **kwargs):
         """
         Creates the HTTPException
 
@@ -32,7 +27,8 @@ class HTTPException(Exception):
         self.response = response
         self.message = message
         try:
-            self.status = response.status if isinstance(response, ClientResponse) else response.status_code
+            # requests has status_code, aiohttp has status. Telling them apart this way needs neither imported.
+            self.status = response.status_code if hasattr(response, "status_code") else response.status
         except AttributeError:
             self.status = -1  # response was None.
 
@@ -58,4 +54,34 @@ class OfflineServer(HTTPException):
 class TextTooLarge(HTTPException):
     """Raised when the text provided to post was too large.
 
-    Bear in mind most template haste services have a paste size limit of 1mb."""
+    Bear in mind most template haste services have a paste size limit of 1mb.
+
+    The text itself isn't kept (it may be hundreds of megabytes), only its size and the start of it.
+
+    Attributes:
+        size - Optional[int]: the size of the text in bytes, if it was known.
+        limit - Optional[int]: the host's size limit in bytes, if it was known (and the text was refused locally).
+        preview - Optional[str]: the start of the text (see :meth:`postbin.payload.Payload.preview`).
+    """
+    def __init__(self, response, *args, message: str = None, size: int = None, limit: int = None,
+                 preview: str = None, **kwargs):
+        if message is None and size is not None:
+            message = "%d bytes is too large%s. Text: %s" % (
+                size, "" if limit is None else " (the limit is %d bytes)" % limit, preview
+            )
+        super().__init__(response, *args, message=message, **kwargs)
+        self.size = size
+        self.limit = limit
+        self.preview = preview
+
+
+class RateLimitedError(HTTPException):
+    """Raised when a host was still rate limiting us (429) after every retry we were allowed."""
+
+
+class IncompleteDocument(HTTPException):
+    """Raised when one or more parts of a chunked document could not be fetched."""
+
+
+class NotFound(HTTPException):
+    """Raised when a haste could not be found on any host that was searched."""
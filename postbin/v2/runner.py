@@ -0,0 +1,196 @@
+"""
+Running v2 from sync (and threaded) code.
+
+A :class:`LoopRunner` owns an event loop on a background thread, and any thread can run coroutines on it. A
+:class:`ThreadedHaste` keeps one :class:`postbin.v2.AsyncHaste` (so one session, and one connection pool) on such
+a loop, so every thread that uses it shares the same kept-alive connections, instead of each call building (and
+tearing down) its own loop, session and connections.
+"""
+import asyncio
+import atexit
+import threading
+from concurrent.futures import Future
+
+__all__ = ("LoopRunner", "ThreadedHaste")
+
+
+class LoopRunner:
+    """An event loop running forever on a daemon thread, started when it is first used."""
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, name: str = "PostBin-loop"):
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def default(cls) -> "LoopRunner":
+        """The runner shared by every :class:`ThreadedHaste` that isn't given its own. It stops at exit."""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+                atexit.register(cls._default.stop)
+            return cls._default
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """The runner's event loop, starting it if it isn't running."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._run, args=(self._loop,), name=self.name, daemon=True)
+                self._thread.start()
+            return self._loop
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def ident(self):
+        """The identifier of the loop's thread (see :func:`threading.get_ident`), or None if it isn't running."""
+        thread = self._thread
+        return thread.ident if thread is not None else None
+
+    @staticmethod
+    def _run(loop: asyncio.AbstractEventLoop):
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+            # asyncio.all_tasks() is new in Python 3.7 (and Task.all_tasks() was removed in 3.9).
+            all_tasks = getattr(asyncio, "all_tasks", None) or asyncio.Task.all_tasks
+            tasks = all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+    def in_loop_thread(self) -> bool:
+        """Whether the caller is running on the runner's own thread (where blocking on it would deadlock)."""
+        return self._thread is threading.current_thread()
+
+    def submit(self, coroutine) -> Future:
+        """Schedules :param:`coroutine` on the loop, returning a :class:`concurrent.futures.Future` of its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine, timeout: float = None):
+        """
+        Runs :param:`coroutine` on the loop, blocking until it is done, and returns its result.
+
+        :param timeout: how long (in seconds) to wait. The coroutine is cancelled if it takes longer.
+        :raise RuntimeError: called from the runner's own thread, which would never finish.
+        :raise concurrent.futures.TimeoutError: the timeout passed.
+        """
+        if self.in_loop_thread():
+            coroutine.close()
+            raise RuntimeError("Can't block on the runner's loop from its own thread. Await the coroutine instead.")
+        future = self.submit(coroutine)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def stop(self, timeout: float = None):
+        """Stops the loop, cancelling whatever is still running on it, and waits for its thread to finish."""
+        with self._lock:
+            thread, loop = self._thread, self._loop
+            self._thread = self._loop = None
+        if thread is None or not thread.is_alive():
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        if not self.in_loop_thread():
+            thread.join(timeout)
+
+    def __repr__(self):
+        return "<LoopRunner name=%r running=%r>" % (self.name, self.running)
+
+
+class ThreadedHaste:
+    """
+    A blocking, thread-safe front to :class:`postbin.v2.AsyncHaste`.
+
+    Every call runs on a background event loop (see :class:`LoopRunner`) through the same AsyncHaste, so any
+    number of threads share one session and connection pool. The blocking methods return their results; use
+    :meth:`submit` to get a :class:`concurrent.futures.Future` instead.
+
+    Example:
+        with ThreadedHaste() as paster:
+            url = paster.post("Hello, world")
+            futures = [paster.submit("post", text) for text in texts]
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, *, runner: LoopRunner = None, **options):
+        """
+        :param runner: the loop to run on. Defaults to one shared by every ThreadedHaste.
+        :param options: passed to :class:`postbin.v2.AsyncHaste`.
+        """
+        from postbin.v2 import AsyncHaste
+
+        self.runner = runner or LoopRunner.default()
+        self.haste = AsyncHaste(**options)
+
+    @classmethod
+    def default(cls) -> "ThreadedHaste":
+        """The instance used by :func:`postbin.v2.postSync`. It is closed at exit."""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+                # registered after the default runner's stop, so it runs (and closes its session) first.
+                atexit.register(cls._default.close)
+            return cls._default
+
+    def submit(self, method: str, *args, **kwargs) -> Future:
+        """
+        Calls ``AsyncHaste.<method>(*args, **kwargs)`` on the loop, without waiting for it.
+
+        :return: a :class:`concurrent.futures.Future` of the result.
+        """
+        return self.runner.submit(getattr(self.haste, method)(*args, **kwargs))
+
+    def _call(self, method: str, *args, **kwargs):
+        return self.runner.run(getattr(self.haste, method)(*args, **kwargs))
+
+    def post(self, text, *args, **kwargs):
+        """The same as :meth:`postbin.v2.AsyncHaste.post`, but blocking."""
+        return self._call("post", text, *args, **kwargs)
+
+    def post_many(self, texts, **kwargs) -> list:
+        """The same as :meth:`postbin.v2.AsyncHaste.post_many`, but blocking."""
+        return self._call("post_many", texts, **kwargs)
+
+    def raw(self, key: str, **kwargs):
+        """The same as :meth:`postbin.v2.AsyncHaste.raw`, but blocking."""
+        return self._call("raw", key, **kwargs)
+
+    def raw_many(self, keys, **kwargs) -> list:
+        """The same as :meth:`postbin.v2.AsyncHaste.raw_many`, but blocking."""
+        return self._call("raw_many", keys, **kwargs)
+
+    def raw_to_file(self, key: str, path, **kwargs) -> int:
+        """The same as :meth:`postbin.v2.AsyncHaste.raw_to_file`, but blocking."""
+        return self._call("raw_to_file", key, path, **kwargs)
+
+    def find_working_fallback(self, *args, **kwargs) -> str:
+        """The same as :meth:`postbin.v2.AsyncHaste.find_working_fallback`, but blocking."""
+        return self._call("find_working_fallback", *args, **kwargs)
+
+    def close(self):
+        """Closes the session. The loop is left running for anything else that uses it."""
+        if self.runner.running:
+            self.runner.run(self.haste.close())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return "<ThreadedHaste runner=%r>" % self.runner
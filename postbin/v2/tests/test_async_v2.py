@@ -8,6 +8,34 @@ from ..errors import OfflineServer, TextTooLarge
 loop = get_event_loop()
 
 
+@pytest.fixture
+def mirrors(monkeypatch):
+    """
+    Starts local haste servers, and makes them the fallbacks url="auto" uses: ``mirrors(2, latency=0.1)`` starts
+    two more, returning them. They are stopped (and what the registries learnt about them forgotten) afterwards.
+    """
+    from postbin import capabilities, health, ratelimit, v2
+    from postbin.testing import HasteServer
+
+    started = []
+
+    def start(count, **options):
+        servers = [HasteServer(**options) for _ in range(count)]
+        for server in servers:
+            server.start()
+        started.extend(servers)
+        monkeypatch.setattr(v2, "_FALLBACKS", [server.url for server in started])
+        return servers
+
+    health.registry.reset()
+    yield start
+    for server in started:
+        server.stop()
+        capabilities.registry.reset(server.url)
+    health.registry.reset()
+    ratelimit.scheduler.reset()
+
+
 def post_test():
     from random import shuffle
     chars = list("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
@@ -69,3 +97,434 @@ def test_large_payload():
             assert not result.startswith("http")
         except UnboundLocalError:
             assert exec_info.errisinstance(TextTooLarge)
+
+
+def test_race_fallbacks(mirrors):
+    from ...health import registry
+    # a dead primary that only times out, a mirror that answers with errors, and a (slower) one that works.
+    dead, failing, working = mirrors(1, latency=1) + mirrors(1, error_rates={500: 1}) + mirrors(1, latency=0.1)
+    cls = AsyncHaste()
+    result = loop.run_until_complete(cls.find_working_fallback(concurrent=True, deadline=0.5, retries_per_url=0))
+    assert result == working.url
+    assert failing.requests[("HEAD", 500)] == 1
+    registry.reset()
+    with pytest.raises(ConnectionError):
+        loop.run_until_complete(cls.find_working_fallback(concurrent=True, max_concurrency=1, deadline=0.1))
+    loop.run_until_complete(cls.close())
+
+
+def test_session_is_reused():
+    async def main():
+        async with AsyncHaste(limit_per_host=2, keepalive_timeout=5) as paster:
+            session = await paster._get_session()
+            assert session is await paster._get_session()
+            assert session.connector.limit_per_host == 2
+        assert session.closed
+    loop.run_until_complete(main())
+
+
+def test_close_session_from_another_loop(recwarn):
+    from asyncio import new_event_loop
+
+    other = new_event_loop()
+    paster = AsyncHaste()
+    session = other.run_until_complete(paster._get_session())
+
+    async def main():
+        paster.close_session()  # the session's loop isn't running, and can't be run from inside this one.
+
+    loop.run_until_complete(main())
+    assert not session.closed and not [w for w in recwarn if "never awaited" in str(w.message)]
+    paster.close_session()
+    assert session.closed
+    other.close()
+
+
+def _peak(traces) -> int:
+    """The most requests that were in flight at once, from their traces."""
+    events = sorted([(trace.started, 1) for trace in traces] + [(trace.started + trace.total, -1) for trace in traces])
+    peak = current = 0
+    for _, change in events:
+        current += change
+        peak = max(peak, current)
+    return peak
+
+
+def test_post_many(mirrors):
+    from ... import tracing
+
+    server, = mirrors(1, latency=0.02, max_size=1000)
+    traces = []
+    texts = ["a", "b", "too large" * 1000, "c", "d", "e"]
+
+    async def main():
+        async with AsyncHaste() as cls:
+            results = await cls.post_many(texts, concurrency=2, url=server.url)
+            backup, = mirrors(1)
+            server.inject(503, count=10, method="POST")
+            # with url="auto", every post can still fall back.
+            return results, backup, await cls.post_many(["f", "g"], url="auto")
+
+    tracing.add_observer(traces.append)
+    try:
+        results, backup, fallen_back = loop.run_until_complete(main())
+    finally:
+        tracing.remove_observer(traces.append)
+    assert isinstance(results[2], TextTooLarge)
+    assert [server.documents[url.rsplit("/", 1)[1]] for url in results[:2] + results[3:]] == [b"a", b"b", b"c",
+                                                                                              b"d", b"e"]
+    assert _peak([trace for trace in traces if trace.method == "POST" and trace.host == server.url]) == 2
+    assert all(url.startswith(backup.url + "/") for url in fallen_back)
+
+
+def test_chunked_round_trip():
+    from postbin.testing import HasteServer
+    from ..errors import IncompleteDocument
+
+    text = "".join("line %d\n" % i for i in range(1000)) + "x" * 2500
+    config = ConfigOptions(chunked=True, chunk_size=1000, return_full_url=False)
+
+    async def main(url):
+        async with AsyncHaste() as cls:
+            key = await cls.post(text, config, url=url)
+            streamed = b"".join([chunk async for chunk in cls.iter_raw(key, url=url, reassemble=True)])
+            return await cls.raw(key, url=url), await cls.raw(key, url=url, reassemble=True), streamed
+
+    async def reassemble(url, key):
+        async with AsyncHaste() as cls:
+            return await cls.raw(key, url=url, reassemble=True)
+
+    with HasteServer(max_size=1000) as server:
+        index, joined, streamed = loop.run_until_complete(main(server.url))
+        assert len(server.documents) > 10
+        assert index.startswith("postbin-chunked-document/1\n")  # only reassembled when asked to.
+        assert joined == text and streamed == text.encode()
+
+        # an index can't send us to any other host.
+        server.documents["elsewhere"] = b"postbin-chunked-document/1\nhttp://169.254.169.254/latest"
+        gets = server.requests[("GET", 200)]
+        with pytest.raises(IncompleteDocument):
+            loop.run_until_complete(reassemble(server.url, "elsewhere"))
+        assert server.requests[("GET", 200)] == gets + 1
+
+
+async def _serve_documents(documents):
+    from aiohttp import web
+
+    async def get_raw(request):
+        if request.match_info["key"] not in documents:
+            return web.Response(status=404)
+        return web.Response(body=documents[request.match_info["key"]])
+
+    app = web.Application()
+    app.router.add_get("/raw/{key}", get_raw)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, "http://127.0.0.1:%d" % runner.addresses[0][1]
+
+
+def test_streamed_raw(tmp_path):
+    from ..errors import NotFound
+    text = "ünïcode line\n" * 5000
+
+    async def main():
+        runner, url = await _serve_documents({"doc": text.encode()})
+        try:
+            async with AsyncHaste() as cls:
+                chunks = [chunk async for chunk in cls.iter_raw("doc", url=url, chunk_size=1000, encoding="utf-8")]
+                assert len(chunks) > 1 and "".join(chunks) == text
+                written = await cls.raw_to_file("doc", tmp_path / "doc.txt", url=url)
+                assert written == len(text.encode())
+                with pytest.raises(NotFound):
+                    await cls.raw_to_file("missing", tmp_path / "missing.txt", url=url)
+        finally:
+            await runner.cleanup()
+
+    loop.run_until_complete(main())
+    assert (tmp_path / "doc.txt").read_text("utf-8") == text
+    assert not list(tmp_path.glob("missing*"))
+
+
+def test_concurrent_raw_lookup(mirrors):
+    from time import perf_counter
+
+    arrived = []
+
+    def latency(request):
+        arrived.append(request.host)  # counted as it arrives: the race's losers may still be answered later.
+        return 0.2
+
+    servers = mirrors(4, latency=latency)
+    servers[-1].documents["key"] = b"found"
+
+    async def main():
+        async with AsyncHaste() as cls:
+            started = perf_counter()
+            assert await cls.raw("key", concurrent=True) == "found"
+            elapsed = perf_counter() - started
+            assert cls.key_hosts["key"] == servers[-1].url
+            del arrived[:]
+            assert await cls.raw("key") == "found"
+            return elapsed
+
+    assert loop.run_until_complete(main()) < 0.2 * len(servers) / 2
+    # went straight to the remembered host.
+    assert ["http://" + host for host in arrived] == [servers[-1].url]
+
+
+def test_dedupe_coalesces():
+    from asyncio import gather
+    from postbin.testing import HasteServer
+    from ...dedupe import DedupeCache
+
+    async def main(url):
+        async with AsyncHaste(dedupe=DedupeCache()) as cls:
+            results = await gather(*(cls.post("same", url=url) for _ in range(5)))
+            return results, await cls.post("same", ConfigOptions(return_full_url=False), url=url)
+
+    with HasteServer(latency=0.01) as server:
+        results, key = loop.run_until_complete(main(server.url))
+        assert len(set(results)) == 1 and list(server.documents) == [key]
+        assert results[0] == server.url + "/" + key and server.requests[("POST", 200)] == 1
+
+
+def test_document_cache(tmp_path):
+    from ...cache import DocumentCache
+
+    async def main():
+        runner, url = await _serve_documents({"doc": b"cached"})
+        try:
+            cache = DocumentCache(directory=str(tmp_path))
+            async with AsyncHaste(cache=cache) as cls:
+                assert await cls.raw("doc", url=url) == "cached"
+                assert await cls.raw("missing", url=url) is None
+        finally:
+            await runner.cleanup()
+        # the server is gone, so these can only be answered from the cache.
+        async with AsyncHaste(cache=cache) as cls:
+            assert await cls.raw("doc", url=url) == "cached"
+            assert await cls.raw("missing", url=url) is None
+            assert b"".join([chunk async for chunk in cls.iter_raw("doc", url=url)]) == b"cached"
+        assert cache.hits == 3 and cache.misses == 2
+        async with AsyncHaste(cache=DocumentCache(directory=str(tmp_path))) as cls:
+            assert await cls.raw("doc", url=url) == "cached"  # from disk
+
+    loop.run_until_complete(main())
+
+
+def test_negative_cache(mirrors):
+    from ...cache import DocumentCache
+    one, two = mirrors(2)
+    two.documents["key"] = b"found"
+
+    async def main():
+        async with AsyncHaste(cache=DocumentCache()) as cls:
+            two.inject(500, method="GET")
+            # two failed rather than answering 404, so the key isn't remembered as missing everywhere.
+            assert await cls.raw("key") is None
+            assert await cls.raw("key") == "found"
+            assert await cls.raw("other") is None
+            gets = sum(one.requests.values()) + sum(two.requests.values())
+            assert await cls.raw("other") is None
+            assert b"".join([chunk async for chunk in cls.iter_raw("key")]) == b"found"
+            return gets
+
+    gets = loop.run_until_complete(main())
+    assert sum(one.requests.values()) + sum(two.requests.values()) == gets  # every host said 404 the first time.
+
+
+def test_rate_limit_scheduler():
+    from asyncio import gather, sleep
+    from time import monotonic
+    from aiohttp import web
+    from ...ratelimit import scheduler
+    scheduler.reset()
+    bucket = {"tokens": 5.0, "at": monotonic(), "limited": 0, "posted": 0}
+
+    async def create(request):
+        # a server-side token bucket of 20 requests a second, with a burst of 5.
+        now = monotonic()
+        bucket["tokens"] = min(5.0, bucket["tokens"] + (now - bucket["at"]) * 20)
+        bucket["at"] = now
+        if bucket["tokens"] < 1:
+            bucket["limited"] += 1
+            return web.json_response({"message": "Slow down."}, status=429, headers={
+                "Retry-After": "0.1", "X-RateLimit-Limit": "20", "X-RateLimit-Reset-After": "1"
+            })
+        bucket["tokens"] -= 1
+        bucket["posted"] += 1
+        return web.json_response({"key": "key%d" % bucket["posted"]})
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/documents", create)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = "http://127.0.0.1:%d" % runner.addresses[0][1]
+        depths = []
+
+        async def watch():
+            while bucket["posted"] < 30:
+                depths.append(scheduler.queue_depth(url))
+                await sleep(0.01)
+
+        try:
+            async with AsyncHaste() as cls:
+                # the first burst runs into the (not yet known) limit, and the 429s teach the scheduler it.
+                first, _ = await gather(gather(*(cls.post("text", url=url) for _ in range(30))), watch())
+                learned = bucket["limited"]
+                second = await gather(*(cls.post("text", url=url) for _ in range(30)))
+        finally:
+            await runner.cleanup()
+        return first + second, depths, learned
+
+    results, depths, learned = loop.run_until_complete(main())
+    assert len(set(results)) == 60
+    assert max(depths) > 0  # requests queued for the host, instead of bouncing off it.
+    assert bucket["limited"] - learned < 5
+    scheduler.reset()
+
+
+def test_rate_limited_raw():
+    from postbin.testing import HasteServer
+    from ...ratelimit import scheduler
+    from ..errors import RateLimitedError
+
+    async def fetch(url, retries, streamed=True):
+        async with AsyncHaste() as cls:
+            cls.max_rate_limited_retries = retries
+            if not streamed:
+                return await cls.raw("k", url=url)
+            return b"".join([chunk async for chunk in cls.iter_raw("k", url=url)])
+
+    scheduler.reset()
+    with HasteServer(retry_after=0.05) as server:
+        server.documents["k"] = b"limited, not missing"
+        server.inject(429, count=1, method="GET")
+        assert loop.run_until_complete(fetch(server.url, 1)) == b"limited, not missing"
+        for streamed in (True, False):
+            server.inject(429, count=2, method="GET")
+            with pytest.raises(RateLimitedError):
+                loop.run_until_complete(fetch(server.url, 1, streamed))
+    scheduler.reset()
+
+
+def test_rate_limited_stream():
+    from postbin.testing import HasteServer
+    from ...ratelimit import scheduler
+    from ..errors import RateLimitedError
+
+    async def post(url):
+        async with AsyncHaste() as cls:
+            return await cls.post(iter([b"one ", b"shot"]), url=url)
+
+    scheduler.reset()
+    with HasteServer(retry_after=0.01) as server:
+        server.inject(429, count=1, method="POST")
+        # a one-shot stream was used up by the first attempt, so it can't be retried.
+        with pytest.raises(RateLimitedError):
+            loop.run_until_complete(post(server.url))
+        assert server.requests[("POST", 429)] == 1
+    scheduler.reset()
+
+
+def test_retry_policy():
+    from time import monotonic
+    from postbin.testing import HasteServer
+    from ...health import registry
+    from ...retry import RetryPolicy
+    registry.reset()
+
+    async def post(url, **kwargs):
+        async with AsyncHaste() as cls:
+            return await cls.post("text", url=url, **kwargs)
+
+    state = RetryPolicy(backoff=0.01).start()
+    with HasteServer() as server:
+        server.inject(500, count=2, method="POST")
+        result = loop.run_until_complete(post(server.url, retry_policy=state))
+        assert result == server.url + "/" + list(server.documents)[0]
+        assert state.attempts == 3 and server.requests[("POST", 500)] == 2
+
+    # the timeout bounds the whole post, however many attempts fit in it.
+    registry.reset()
+    with HasteServer(latency=1) as server:
+        started = monotonic()
+        with pytest.raises(Exception):
+            loop.run_until_complete(post(server.url, timeout=0.2))
+        assert monotonic() - started < 1
+    registry.reset()
+
+
+def test_hedged_requests(mirrors):
+    from time import monotonic
+    from ...health import registry
+    from ...hedge import HedgePolicy
+    slow, fast = mirrors(1, latency=0.5) + mirrors(1, latency=0.01)
+    for n in range(4):
+        slow.documents["key%d" % n] = fast.documents["key%d" % n] = b"text"
+
+    duplicates = []
+    policy = HedgePolicy(0.05, budget=0.5, on_duplicate=lambda *args: duplicates.append(args))
+
+    async def timed(request):
+        started = monotonic()
+        return await request, monotonic() - started
+
+    async def main():
+        results = []
+        async with AsyncHaste(hedge=policy) as cls:
+            for n in range(4):
+                registry.reset()
+                registry.record_success(slow.url)
+                registry.record_success(fast.url)
+                requests = [cls.post("text"), cls.raw("key%d" % n)]
+                for request in requests if n % 2 else reversed(requests):
+                    results.append(await timed(request))
+        return results
+
+    results = loop.run_until_complete(main())
+    # a budget of 0.5 pays for one hedge every two requests, which alternate between raw and post.
+    assert policy.hedges == 4 and policy.wins == 4
+    hedged = sorted(result for result, elapsed in results if elapsed < 0.25)
+    assert hedged[2:] == ["text"] * 2 and all(url.startswith(fast.url + "/") for url in hedged[:2])
+    # the slow posts were cancelled, but may exist.
+    assert sorted(duplicates) == sorted((url, None, slow.url) for url in hedged[:2])
+
+
+def test_raw_many(mirrors):
+    from collections import Counter
+    from ... import tracing
+
+    fetched = Counter()
+
+    def latency(request):
+        fetched["http://" + request.host, request.path.rsplit("/", 1)[1]] += 1
+        return 0.02
+
+    one, two = mirrors(2, latency=latency)
+    one.documents.update(a=b"one a", b=b"one b")
+    two.documents["a"] = b"two a"
+    dead = "http://127.0.0.1:9"
+    keys = ["a", one.url + "/raw/b.py", "a", two.url + "/a", "missing", dead + "/broken", "a"]
+    traces = []
+
+    async def main():
+        async with AsyncHaste() as cls:
+            return await cls.raw_many(keys, concurrency=4, url=one.url)
+
+    tracing.add_observer(traces.append)
+    try:
+        results = loop.run_until_complete(main())
+    finally:
+        tracing.remove_observer(traces.append)
+    assert results[:5] == ["one a", "one b", "one a", "two a", None]
+    assert isinstance(results[5], Exception) and results[6] == "one a"
+    # the first two requests for one's "a" were in flight at once, so they shared one download.
+    assert fetched[(one.url, "a")] == 2 and sum(fetched.values()) == len(keys) - 2
+    # four fetches in flight, two of which shared a download.
+    assert _peak([trace for trace in traces if trace.host in (one.url, two.url)]) == 3
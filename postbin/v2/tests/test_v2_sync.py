@@ -50,3 +50,44 @@ def test_large_payload():
 #     assert _FALLBACKS == srted
 #     set_fallbacks(original)
 #     assert _FALLBACKS == original
+
+
+def test_threaded_haste():
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from ...testing import HasteServer
+    from .. import AsyncHaste, LoopRunner, ThreadedHaste
+
+    with HasteServer() as server:
+        with ThreadPoolExecutor(16) as executor:
+            urls = list(executor.map(lambda i: postSync("document %d" % i, url=server.url), range(64)))
+        assert len(set(urls)) == 64 and all(url.startswith(server.url) for url in urls)
+        shared = ThreadedHaste.default()
+        assert shared.haste.session is not None and not shared.haste.session.closed  # one session for every call.
+
+        async def inside_a_running_loop():
+            return postSync("from a coroutine", url=server.url)
+        assert asyncio.new_event_loop().run_until_complete(inside_a_running_loop()).startswith(server.url)
+
+        runner = LoopRunner(name="test-loop")
+        with ThreadedHaste(runner=runner) as paster:
+            futures = [paster.submit("post", "future %d" % i, url=server.url) for i in range(8)]
+            assert all(future.result(10).startswith(server.url) for future in futures)
+            key = futures[0].result().rsplit("/", 1)[1]
+            assert paster.raw(key, url=server.url) == "future 0"
+
+        async def block_on_own_loop():
+            return runner.run(asyncio.sleep(0))
+        with pytest.raises(RuntimeError):
+            runner.run(block_on_own_loop())
+
+        # a session created on the runner's loop can be closed from this thread.
+        async def open_session():
+            haste = AsyncHaste()
+            await haste._get_session()
+            return haste
+        haste = runner.run(open_session())
+        haste.close_session().result(5)
+        assert haste.session.closed
+        runner.stop()
+        assert not runner.running